@@ -3,69 +3,510 @@ Packet loss and packet loss rate (PLR) calculator.
 
 Tracks frame counts per device and computes packet loss and PLR over a configurable
 time interval. Used by the shared publish pipeline for signal metrics (signal.pl, signal.plr).
+
+Per-device state is kept in parallel typed arrays indexed by a slot number, with a
+devEui -> slot map. Idle devices are evicted and the number of devices is capped, so
+memory stays bounded on gateways that hear many foreign devices. The state can be
+snapshotted to disk and restored at startup so restarts keep baselines and PLR windows.
+
+fCnt rollover (16 and 32 bit) and counter resets are recognized, PLR can be emitted on a
+timer for every device whose interval elapsed (emit_due), and batch_packet_loss computes
+PLR over archived uplinks with NumPy. ShardedPacketLossTracker is the single lock-striped
+instance shared by the ChirpStack client and the Loriot watcher, keyed on (lns, devEui).
 """
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
 import time
-from typing import Any, Dict, Optional, Tuple
+from array import array
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+
+# LoRaWAN 1.0 MAX_FCNT_GAP: a larger jump is treated as a counter reset, not as loss.
+MAX_FCNT_GAP = 16384
+# Stored in place of fCnt until a device's first frame counter is known.
+_NO_FCNT = -1
+
+# Snapshot file: header (magic, version, record count, wall time of the snapshot), then per
+# device a length-prefixed JSON-encoded key, its counters and (version 2) its length-prefixed
+# JSON-encoded signal metadata, so timer-emitted PLR can be published after a restart.
+# Times are stored as wall-clock seconds since they must survive a restart; in memory they
+# are monotonic. Version 1 snapshots (no metadata) are still read.
+_SNAPSHOT_MAGIC = b"PLRS"
+_SNAPSHOT_VERSION = 2
+_SNAPSHOT_VERSIONS = (1, 2)
+_SNAPSHOT_HEADER = struct.Struct("<4sHId")
+_SNAPSHOT_KEY_LEN = struct.Struct("<H")
+# fCnt, totalpl, pckcount, last PLR calculation (wall), last seen (wall)
+_SNAPSHOT_RECORD = struct.Struct("<qqqdd")
+_SNAPSHOT_META_LEN = struct.Struct("<I")
+# Serializes snapshot() calls (the periodic snapshot thread and the one at shutdown), so an
+# older snapshot cannot replace a newer one.
+_snapshot_lock = threading.Lock()
+
+# (devEui, fcnt, totalpl, pckcount, last_calc, last_seen, signal metadata) with wall-clock times
+SnapshotRecord = Tuple[Any, int, int, int, float, float, Optional[Mapping[str, Any]]]
 
 
 class PacketLossCalculator:
     """Computes packet loss and PLR per device over a sliding time window."""
 
-    def __init__(self, plr_sec: int) -> None:
+    def __init__(
+        self,
+        plr_sec: int,
+        max_devices: int = 10000,
+        idle_ttl_sec: float = 86400,
+        max_fcnt_gap: int = MAX_FCNT_GAP,
+    ) -> None:
         """
         plr_sec: Time interval in seconds over which PLR is computed (e.g. 3600 for hourly).
+        max_devices: Max devices tracked; the least recently seen device is evicted when full (0: no limit).
+        idle_ttl_sec: Devices not seen for this many seconds are evicted (0: never).
+        max_fcnt_gap: Largest fCnt jump counted as loss; larger jumps or decreases that are not
+            a 16/32-bit rollover are treated as a counter reset (device rejoin).
         """
-        self.devices: Dict[Any, Dict[str, Any]] = {}
         self.plr_sec = plr_sec
+        self.max_fcnt_gap = max_fcnt_gap
+        self.max_devices = max_devices
+        self.idle_ttl_sec = idle_ttl_sec
+        self._slots: Dict[Any, int] = {}  # devEui -> slot
+        self._free: List[int] = []
+        self._fcnt = array("q")  # Last frame count
+        self._totalpl = array("q")  # Total packet loss in the current interval
+        self._pckcount = array("q")  # Packets received in the current interval
+        self._last_calc = array("d")  # Last PLR calculation time (monotonic)
+        self._last_seen = array("d")  # Last packet time (monotonic)
+        self._meta: List[Optional[Mapping[str, Any]]] = []  # Last signal metadata, for timer-emitted PLR
+        self._next_sweep = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, deveui: Any) -> bool:
+        return deveui in self._slots
+
+    def _evict(self, now: float) -> None:
+        """
+        Drop idle devices (at most every idle_ttl_sec / 4), then, if still full, the least
+        recently seen tenth of max_devices so the sort is amortized over many new devices.
+        """
+        if self.idle_ttl_sec > 0 and now >= self._next_sweep:
+            self._next_sweep = now + self.idle_ttl_sec / 4
+            cutoff = now - self.idle_ttl_sec
+            last_seen = self._last_seen
+            for deveui in [d for d, slot in self._slots.items() if last_seen[slot] <= cutoff]:
+                self._release(deveui)
+        if self.max_devices > 0 and len(self._slots) >= self.max_devices:
+            last_seen = self._last_seen
+            oldest = sorted(self._slots, key=lambda d: last_seen[self._slots[d]])
+            for deveui in oldest[: max(1, self.max_devices // 10)]:
+                self._release(deveui)
+
+    def _release(self, deveui: Any) -> None:
+        self._free.append(self._slots.pop(deveui))
+
+    def _allocate(self, deveui: Any, now: float) -> int:
+        """Assign a slot to a new device, reusing freed slots."""
+        self._evict(now)
+        if self._free:
+            slot = self._free.pop()
+            self._fcnt[slot] = _NO_FCNT
+            self._meta[slot] = None
+            self._totalpl[slot] = 0
+            self._pckcount[slot] = 0
+            self._last_calc[slot] = now
+            self._last_seen[slot] = now
+        else:
+            slot = len(self._fcnt)
+            self._fcnt.append(_NO_FCNT)
+            self._meta.append(None)
+            self._totalpl.append(0)
+            self._pckcount.append(0)
+            self._last_calc.append(now)
+            self._last_seen.append(now)
+        self._slots[deveui] = slot
+        return slot
 
     def process_packet(
-        self, deveui: Any, fCnt: Optional[int]
+        self, deveui: Any, fCnt: Optional[int], meta: Optional[Mapping[str, Any]] = None
     ) -> Tuple[int, Optional[float]]:
         """
         Process a packet from a device and update packet loss state.
 
         Returns (pl, plr): pl is packet loss for this packet; plr is the current
         PLR percentage for the interval if the interval has elapsed, else None.
+        meta is remembered as the device's signal metadata for emit_due().
         """
-        # Initialize device data if not already present
-        if deveui not in self.devices:
-            self.devices[deveui] = {
-                "fCnt": 0,  # Last frame count
-                "totalpl": 0,  # Total packet loss
-                "pckcount": 0,  # Total packets received
-                "last_calculation_time": time.time()  # Last PLR calculation time
-            }
+        with self._lock:
+            return self._process_packet(deveui, fCnt, meta, time.monotonic())
 
-        # Reference device data
-        device = self.devices[deveui]
+    def _fcnt_gap(self, last_fcnt: int, fCnt: int) -> Optional[int]:
+        """
+        Frames lost between last_fcnt and fCnt, allowing for 16- and 32-bit rollover.
+        Returns None if fCnt cannot follow last_fcnt (counter reset or rejoin).
+        """
+        delta = fCnt - last_fcnt
+        if delta <= 0:
+            if last_fcnt <= 0xFFFF and fCnt <= 0xFFFF:
+                delta += 0x10000
+            else:
+                delta += 0x100000000
+        gap = delta - 1
+        return gap if 0 <= gap <= self.max_fcnt_gap else None
 
-        # Initialize fCnt if not already set
-        if fCnt and device["fCnt"] == 0:
-            device["fCnt"] = fCnt
+    def _process_packet(
+        self,
+        deveui: Any,
+        fCnt: Optional[int],
+        meta: Optional[Mapping[str, Any]],
+        current_time: float,
+    ) -> Tuple[int, Optional[float]]:
+        """process_packet with the lock held and the current monotonic time."""
+        # Initialize device data if not already present
+        slot = self._slots.get(deveui)
+        if slot is None:
+            slot = self._allocate(deveui, current_time)
+        self._last_seen[slot] = current_time
+        if meta is not None:
+            self._meta[slot] = meta
 
         # Calculate packet loss for this packet
         pl = 0
-        if fCnt > device["fCnt"]:
-            pl = (fCnt - device["fCnt"] - 1)
-            device["totalpl"] += pl
+        last_fcnt = self._fcnt[slot]
+        if isinstance(fCnt, int) and fCnt >= 0:
+            if fCnt == last_fcnt:
+                # Retransmission or duplicate delivery of the last frame: not a new packet.
+                return (0, None)
+            if last_fcnt != _NO_FCNT:
+                gap = self._fcnt_gap(last_fcnt, fCnt)
+                if gap is None:
+                    logging.debug("PLR: fCnt of %s went from %d to %d; treating as counter reset", deveui, last_fcnt, fCnt)
+                else:
+                    pl = gap
+                    self._totalpl[slot] += pl
 
-        # Update the last received fCnt
-        device["fCnt"] = fCnt
+            # Update the last received fCnt
+            self._fcnt[slot] = fCnt
 
         # Increment packet count
-        device["pckcount"] += 1
+        self._pckcount[slot] += 1
 
         # Calculate PLR for this device if the time interval has passed
-        current_time = time.time()
-        if current_time - device["last_calculation_time"] >= self.plr_sec:
-            total_packets = device["pckcount"] + device["totalpl"]
-            plr = (device["totalpl"] / total_packets * 100) if total_packets > 0 else 0
-            plr = round(plr, 2)#Format PLR to two decimal places
-
-            # Reset the counters for the next interval
-            device["totalpl"] = 0
-            device["pckcount"] = 0
-            device["last_calculation_time"] = current_time
-
-            return (pl, plr)
+        if current_time - self._last_calc[slot] >= self.plr_sec:
+            return (pl, self._close_window(slot, current_time))
         return (pl, None)
+
+    def _close_window(self, slot: int, current_time: float) -> float:
+        """Return the PLR of the slot's interval and start a new interval."""
+        totalpl = self._totalpl[slot]
+        total_packets = self._pckcount[slot] + totalpl
+        plr = (totalpl / total_packets * 100) if total_packets > 0 else 0
+        plr = round(plr, 2)#Format PLR to two decimal places
+
+        # Reset the counters for the next interval
+        self._totalpl[slot] = 0
+        self._pckcount[slot] = 0
+        self._last_calc[slot] = current_time
+        return plr
+
+    def emit_due(self) -> List[Tuple[Any, float, Optional[Mapping[str, Any]]]]:
+        """
+        Close the PLR interval of every device whose interval has elapsed and that received
+        packets in it, including devices that went silent. Returns [(devEui, plr, meta), ...].
+        """
+        due = []
+        with self._lock:
+            current_time = time.monotonic()
+            cutoff = current_time - self.plr_sec
+            for deveui, slot in self._slots.items():
+                if self._last_calc[slot] <= cutoff and self._pckcount[slot] > 0:
+                    due.append((deveui, self._close_window(slot, current_time), self._meta[slot]))
+        return due
+
+    def snapshot(self, path: str) -> int:
+        """
+        Write all device state to path atomically (temp file, fsync, rename).
+        Returns the number of devices written.
+        """
+        with _snapshot_lock:
+            records = self._snapshot_records()
+            _write_snapshot(path, records)
+        return len(records)
+
+    def restore(self, path: str) -> int:
+        """
+        Load device state written by snapshot(). Devices already tracked are kept as they are.
+        Returns the number of devices restored (0 if the file is missing or unreadable).
+        """
+        return self._restore_records(_read_snapshot(path))
+
+    def _snapshot_records(self) -> List[SnapshotRecord]:
+        """Device state as (devEui, fcnt, totalpl, pckcount, last_calc, last_seen, meta) with wall-clock times."""
+        with self._lock:
+            mono_now = time.monotonic()
+            wall_now = time.time()
+            return [
+                (
+                    deveui,
+                    self._fcnt[slot],
+                    self._totalpl[slot],
+                    self._pckcount[slot],
+                    wall_now - (mono_now - self._last_calc[slot]),
+                    wall_now - (mono_now - self._last_seen[slot]),
+                    self._meta[slot],
+                )
+                for deveui, slot in self._slots.items()
+            ]
+
+    def _restore_records(self, records: List[SnapshotRecord]) -> int:
+        """Load records from _snapshot_records(), skipping devices already tracked. Returns the count loaded."""
+        restored = 0
+        with self._lock:
+            mono_now = time.monotonic()
+            wall_now = time.time()
+            for deveui, fcnt, totalpl, pckcount, last_calc_wall, last_seen_wall, meta in records:
+                if deveui in self._slots:
+                    continue
+                slot = self._allocate(deveui, mono_now)
+                self._fcnt[slot] = fcnt
+                self._totalpl[slot] = totalpl
+                self._pckcount[slot] = pckcount
+                self._last_calc[slot] = mono_now - (wall_now - last_calc_wall)
+                self._last_seen[slot] = mono_now - (wall_now - last_seen_wall)
+                self._meta[slot] = meta
+                restored += 1
+        return restored
+
+
+class ShardedPacketLossTracker:
+    """
+    Packet loss state shared by all front ends (ChirpStack, Loriot), keyed on (lns, devEui).
+
+    Devices are spread over shards, each a PacketLossCalculator with its own lock, so
+    concurrent workers only contend when their devices share a shard.
+    """
+
+    def __init__(
+        self,
+        plr_sec: int,
+        shards: int = 16,
+        max_devices: int = 10000,
+        idle_ttl_sec: float = 86400,
+        max_fcnt_gap: int = MAX_FCNT_GAP,
+    ) -> None:
+        """
+        plr_sec, idle_ttl_sec, max_fcnt_gap: see PacketLossCalculator.
+        shards: number of independently locked shards.
+        max_devices: Max devices tracked in total (0: no limit), split evenly over the shards.
+        """
+        self.plr_sec = plr_sec
+        shards = max(1, int(shards))
+        per_shard = -(-max_devices // shards) if max_devices > 0 else 0
+        self._shards = [
+            PacketLossCalculator(
+                plr_sec,
+                max_devices=per_shard,
+                idle_ttl_sec=idle_ttl_sec,
+                max_fcnt_gap=max_fcnt_gap,
+            )
+            for _ in range(shards)
+        ]
+
+    def _shard(self, key: Any) -> PacketLossCalculator:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self._shard(key)
+
+    def process_packet(
+        self, key: Any, fCnt: Optional[int], meta: Optional[Mapping[str, Any]] = None
+    ) -> Tuple[int, Optional[float]]:
+        """PacketLossCalculator.process_packet for key, usually (lns, devEui)."""
+        return self._shard(key).process_packet(key, fCnt, meta)
+
+    def emit_due(self) -> List[Tuple[Any, float, Optional[Mapping[str, Any]]]]:
+        """PacketLossCalculator.emit_due over all shards."""
+        due = []
+        for shard in self._shards:
+            due.extend(shard.emit_due())
+        return due
+
+    def snapshot(self, path: str) -> int:
+        """Write the state of all shards to one snapshot file. Returns the number of devices written."""
+        records = []
+        with _snapshot_lock:
+            for shard in self._shards:
+                records.extend(shard._snapshot_records())
+            _write_snapshot(path, records)
+        return len(records)
+
+    def restore(self, path: str) -> int:
+        """Load a snapshot written by snapshot(), placing each device in its shard. Returns the count."""
+        by_shard: Dict[int, List[SnapshotRecord]] = {}
+        for record in _read_snapshot(path):
+            by_shard.setdefault(hash(record[0]) % len(self._shards), []).append(record)
+        return sum(self._shards[i]._restore_records(records) for i, records in by_shard.items())
+
+
+def plr_tracker_from_args(args: Any) -> ShardedPacketLossTracker:
+    """Build the shared packet loss tracker from --plr and --plr-* args."""
+    return ShardedPacketLossTracker(
+        args.plr,
+        shards=getattr(args, "plr_shards", 16),
+        max_devices=getattr(args, "plr_max_devices", 10000),
+        idle_ttl_sec=getattr(args, "plr_idle_ttl_sec", 86400),
+    )
+
+
+def _write_snapshot(path: str, records: List[SnapshotRecord]) -> None:
+    """Write snapshot records to path atomically (temp file, fsync, rename)."""
+    chunks = [_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION, len(records), time.time())]
+    for deveui, *fields, meta in records:
+        key = json.dumps(deveui).encode("utf-8")
+        chunks.append(_SNAPSHOT_KEY_LEN.pack(len(key)))
+        chunks.append(key)
+        chunks.append(_SNAPSHOT_RECORD.pack(*fields))
+        encoded = json.dumps(dict(meta) if meta is not None else None, default=str).encode("utf-8")
+        chunks.append(_SNAPSHOT_META_LEN.pack(len(encoded)))
+        chunks.append(encoded)
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"".join(chunks))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _read_snapshot(path: str) -> List[SnapshotRecord]:
+    """Read snapshot records from path; [] if the file is missing, unreadable or corrupt."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    except OSError as e:
+        logging.warning("PLR state: could not read %s: %s", path, e)
+        return []
+    try:
+        magic, version, count, _written = _SNAPSHOT_HEADER.unpack_from(data, 0)
+        if magic != _SNAPSHOT_MAGIC or version not in _SNAPSHOT_VERSIONS:
+            logging.warning("PLR state: %s is not a version %d snapshot; ignoring it", path, _SNAPSHOT_VERSION)
+            return []
+        offset = _SNAPSHOT_HEADER.size
+        records = []
+        for _ in range(count):
+            (key_len,) = _SNAPSHOT_KEY_LEN.unpack_from(data, offset)
+            offset += _SNAPSHOT_KEY_LEN.size
+            deveui = json.loads(data[offset : offset + key_len].decode("utf-8"))
+            if isinstance(deveui, list):
+                deveui = tuple(deveui)
+            offset += key_len
+            fields = _SNAPSHOT_RECORD.unpack_from(data, offset)
+            offset += _SNAPSHOT_RECORD.size
+            meta = None
+            if version >= 2:
+                (meta_len,) = _SNAPSHOT_META_LEN.unpack_from(data, offset)
+                offset += _SNAPSHOT_META_LEN.size
+                meta = json.loads(data[offset : offset + meta_len].decode("utf-8"))
+                offset += meta_len
+                if not isinstance(meta, dict):
+                    meta = None
+            records.append((deveui,) + fields + (meta,))
+    except (struct.error, ValueError) as e:
+        logging.warning("PLR state: %s is corrupt; ignoring it: %s", path, e)
+        return []
+    return records
+
+
+def start_snapshot_daemon(
+    calc: Union[PacketLossCalculator, ShardedPacketLossTracker], path: str, interval_sec: float
+) -> threading.Thread:
+    """Snapshot calc to path every interval_sec seconds in a daemon thread. Returns the thread."""
+
+    def run() -> None:
+        while True:
+            time.sleep(interval_sec)
+            try:
+                count = calc.snapshot(path)
+                logging.debug("PLR state: saved %d device(s) to %s", count, path)
+            except Exception as e:
+                logging.warning("PLR state: snapshot to %s failed: %s", path, e)
+
+    thread = threading.Thread(target=run, daemon=True, name="plr-snapshot")
+    thread.start()
+    return thread
+
+
+def batch_packet_loss(
+    deveuis: Sequence[Any],
+    fcnts: Sequence[int],
+    times: Sequence[float],
+    plr_sec: float,
+    max_fcnt_gap: int = MAX_FCNT_GAP,
+) -> Dict[str, Any]:
+    """
+    Vectorized packet loss over archived uplinks (requires NumPy), e.g. to backfill PLR.
+
+    deveuis, fcnts, times (seconds) describe one uplink each, in any order. Each device's
+    uplinks are split into plr_sec windows starting at its first uplink, and loss follows the
+    same rules as PacketLossCalculator (rollover, resets, duplicates). Returns columns as
+    NumPy arrays: deveui, window_start, received, lost, plr (percent, 2 decimals).
+    """
+    import numpy as np
+
+    keys, dev = np.unique(np.asarray(deveuis), return_inverse=True)
+    fcnt = np.asarray(fcnts, dtype=np.int64)
+    t = np.asarray(times, dtype=np.float64)
+    order = np.lexsort((fcnt, t, dev))
+    dev, fcnt, t = dev[order], fcnt[order], t[order]
+
+    same = np.empty(len(dev), dtype=bool)
+    same[:1] = False
+    same[1:] = dev[1:] == dev[:-1]
+    prev = np.empty_like(fcnt)
+    prev[:1] = 0
+    prev[1:] = fcnt[:-1]
+    delta = fcnt - prev
+    duplicate = same & (delta == 0)
+    small = (prev <= 0xFFFF) & (fcnt <= 0xFFFF)
+    delta = np.where(delta <= 0, delta + np.where(small, 0x10000, 0x100000000), delta)
+    gap = delta - 1
+    lost = np.where(same & ~duplicate & (gap >= 0) & (gap <= max_fcnt_gap), gap, 0)
+
+    # Window index of each uplink, counted from its device's first uplink.
+    first = np.flatnonzero(~same)
+    start = t[first][np.cumsum(~same) - 1]
+    window = np.floor((t - start) / plr_sec).astype(np.int64)
+    group = dev * (int(window.max(initial=0)) + 1) + window
+    groups, inverse = np.unique(group, return_inverse=True)
+    received = np.bincount(inverse, weights=~duplicate).astype(np.int64)
+    lost_sum = np.bincount(inverse, weights=lost).astype(np.int64)
+    total = received + lost_sum
+    plr = np.round(np.where(total > 0, lost_sum / np.maximum(total, 1) * 100, 0.0), 2)
+
+    group_dev = groups // (int(window.max(initial=0)) + 1)
+    group_window = groups % (int(window.max(initial=0)) + 1)
+    first_time = np.zeros(len(keys))
+    first_time[dev[first]] = t[first]
+    return {
+        "deveui": keys[group_dev],
+        "window_start": first_time[group_dev] + group_window * plr_sec,
+        "received": received,
+        "lost": lost_sum,
+        "plr": plr,
+    }
@@ -2,47 +2,62 @@
 ChirpStack MQTT client and shared publish pipeline.
 
 Subscribes to ChirpStack MQTT, parses payloads (with optional codec fallback when object
-is missing), and publishes measurements and optional signal metrics via the Waggle plugin.
-Supports --dry to log messages without publishing.
+is missing), and publishes measurements and optional signal metrics via the shared
+Publisher (one long-lived Waggle plugin session, see publisher.py).
+Messages are handed from the paho network thread to a worker pipeline (see pipeline.py)
+unless --workers is 0. Supports --dry to log messages without publishing.
+
+Several plugin processes can share a node's traffic: with --mqtt-shared-group they join
+an MQTT shared subscription ($share/<group>/<topic>) and the broker spreads messages
+over them; with --mqtt-partition i/N each process subscribes to all uplinks but only
+handles devices whose devEui (from the topic) hashes to partition i, so all uplinks of a
+device, and its packet loss state, stay in one process.
 """
 from __future__ import annotations
 
 import logging
 import os
-from typing import Any, List, Dict, Optional
+import threading
+import time
+from typing import Any, Callable, List, Dict, Mapping, Optional, Tuple
 
 import paho.mqtt.client as mqtt
-from waggle.plugin import Plugin
 from parse import (
     parse_message_payload,
     convert_time,
-    Get_Measurement_metadata,
+    Get_Metadata,
     Get_Signal_Performance_values,
     Get_Signal_Performance_metadata,
     clean_message_measurement,
 )
-from calc import PacketLossCalculator
+from measurement_filter import measurement_filter
+from dedup import uplink_deduplicator, uplink_keys
+import metrics
+import profiling
+import logutil
+from calc import ShardedPacketLossTracker, plr_tracker_from_args
+from publisher import get_publisher
+from pipeline import MessagePipeline, BACKPRESSURE_BLOCK, device_key_from_topic, shard_for_key
 
 
 def process_and_publish(
     measurements: List[Dict[str, Any]],
     timestamp_ns: Optional[int],
-    measurement_metadata: Dict[str, Any],
+    measurement_metadata: Mapping[str, Any],
     signal_values: Optional[Dict[str, Any]],
-    signal_metadata: Optional[Dict[str, Any]],
+    signal_metadata: Optional[Mapping[str, Any]],
     args: Any,
-    plr_calc: PacketLossCalculator,
+    plr_calc: ShardedPacketLossTracker,
 ) -> None:
     """
     Shared publish pipeline for ChirpStack and Loriot.
 
-    Applies --collect/--ignore, cleans measurement names, publishes each measurement,
+    Applies --collect/--ignore (see measurement_filter.py), cleans measurement names, publishes each measurement,
     and optionally signal metrics (spreading factor, pl, plr, rssi, snr per gateway).
     """
+    allows = measurement_filter(args).allows
     for measurement in measurements:
-        if measurement["name"] in args.ignore:
-            continue
-        if args.collect and measurement["name"] not in args.collect:
+        if not allows(measurement["name"]):
             continue
         _publish_measurement(measurement, timestamp_ns, measurement_metadata)
 
@@ -50,28 +65,72 @@ def process_and_publish(
         return
 
     perf = signal_values
-    meta = signal_metadata.copy()
+    meta = dict(signal_metadata)
     _publish_signal(
         {"name": "signal.spreadingfactor", "value": perf.get("spreadingfactor")},
         timestamp_ns,
         meta,
     )
     pl, plr = plr_calc.process_packet(
-        meta["devEui"], perf.get("fCnt")
+        (meta.get("lns"), meta["devEui"]), perf.get("fCnt"), signal_metadata
     )
     _publish_signal({"name": "signal.pl", "value": pl}, timestamp_ns, meta)
     if plr is not None:
         _publish_signal({"name": "signal.plr", "value": plr}, timestamp_ns, meta)
     for val in perf.get("rxInfo") or []:
-        meta["gatewayId"] = val.get("gatewayId")
+        gateway_id = val.get("gatewayId")
+        if gateway_id is None:
+            meta.pop("gatewayId", None)
+        else:
+            meta["gatewayId"] = str(gateway_id)
         _publish_signal({"name": "signal.rssi", "value": val.get("rssi")}, timestamp_ns, meta)
         _publish_signal({"name": "signal.snr", "value": val.get("snr")}, timestamp_ns, meta)
 
 
+def _plr_key_metadata(key: Any) -> Optional[Dict[str, Any]]:
+    """Signal metadata from a packet loss key (lns, devEui), for devices with no metadata (e.g. an old snapshot)."""
+    if not isinstance(key, tuple) or len(key) != 2 or not key[1]:
+        return None
+    lns, deveui = key
+    meta = {"devEui": str(deveui)}
+    if lns:
+        meta["lns"] = str(lns)
+    return meta
+
+
+def publish_due_plr(plr_calc: ShardedPacketLossTracker) -> int:
+    """Publish signal.plr for every device whose PLR interval elapsed. Returns the count."""
+    due = plr_calc.emit_due()
+    for key, plr, meta in due:
+        if meta is None:
+            meta = _plr_key_metadata(key)
+        if meta is not None:
+            _publish_signal({"name": "signal.plr", "value": plr}, None, meta)
+    return len(due)
+
+
+def start_plr_emitter(plr_calc: ShardedPacketLossTracker, interval_sec: float) -> threading.Thread:
+    """Check for elapsed PLR intervals every interval_sec seconds in a daemon thread. Returns the thread."""
+
+    def run() -> None:
+        while True:
+            time.sleep(interval_sec)
+            try:
+                count = publish_due_plr(plr_calc)
+                if count:
+                    logging.debug("PLR: emitted %d interval(s) on timer", count)
+            except Exception as e:
+                logging.error("PLR: timer emission failed: %s", e)
+
+    thread = threading.Thread(target=run, daemon=True, name="plr-emitter")
+    thread.start()
+    return thread
+
+
 def _publish_signal(
     measurement: Dict[str, Any],
     timestamp: Optional[int],
-    metadata: Dict[str, Any],
+    metadata: Mapping[str, Any],
 ) -> None:
     """Publish a single signal metric (e.g. rssi, snr) to the plugin."""
     _publish(measurement, timestamp, metadata)
@@ -80,7 +139,7 @@ def _publish_signal(
 def _publish_measurement(
     measurement: Dict[str, Any],
     timestamp: Optional[int],
-    metadata: Dict[str, Any],
+    metadata: Mapping[str, Any],
 ) -> None:
     """Clean measurement name and publish to the plugin."""
     measurement = clean_message_measurement(measurement.copy())
@@ -90,39 +149,77 @@ def _publish_measurement(
 def _publish(
     measurement: Dict[str, Any],
     timestamp: Optional[int],
-    metadata: Dict[str, Any],
+    metadata: Mapping[str, Any],
 ) -> None:
-    """Publish one measurement to the Waggle plugin if value is not None."""
+    """Queue one measurement on the shared publisher if value is not None."""
     if measurement.get("value") is not None:
-        with Plugin() as plugin:
-            try:
-                plugin.publish(
-                    measurement["name"],
-                    measurement["value"],
-                    timestamp=timestamp,
-                    meta=metadata,
-                )
-                logging.info("%s published", measurement["name"])
-            except Exception as e:
-                logging.error(
-                    "measurement %s did not publish: %s",
-                    measurement["name"],
-                    str(e),
-                )
+        get_publisher().submit(
+            measurement["name"],
+            measurement["value"],
+            timestamp,
+            metadata,
+        )
+
+
+def parse_partition(text: str) -> Optional[Tuple[int, int]]:
+    """Parse an --mqtt-partition value "i/N" into (i, N); None for an empty value."""
+    if not text:
+        return None
+    index, _, count = text.partition("/")
+    i, n = int(index), int(count)
+    if n < 1 or not 0 <= i < n:
+        raise ValueError("partition must be i/N with 0 <= i < N")
+    return i, n
+
+
+def topic_partition(topic: str, count: int) -> Optional[int]:
+    """Partition of the device in a ChirpStack topic (application/<id>/device/<devEui>/...), or None if it names no device."""
+    key = device_key_from_topic(topic)
+    if key == topic:
+        return None
+    return shard_for_key(key.lower(), count)
 
 
 class ChirpstackClient:
     """MQTT client for ChirpStack. Subscribes to application topics and publishes decoded measurements."""
 
-    def __init__(self, args: Any, contract: Optional[Any] = None) -> None:
-        """Build MQTT client and packet-loss calculator. Contract is the codec fallback (optional)."""
+    def __init__(
+        self,
+        args: Any,
+        contract: Optional[Any] = None,
+        plr_calc: Optional[ShardedPacketLossTracker] = None,
+        pipeline: bool = True,
+    ) -> None:
+        """
+        Build MQTT client and message pipeline. Contract is the codec fallback (optional);
+        plr_calc is the packet loss tracker shared with the Loriot watcher (a new one if None).
+        pipeline: False skips the --workers pipeline, for callers that schedule handle_message
+        themselves (the asyncio engine) and replace client.on_message.
+        """
         self.args = args
         self.contract = contract
+        self.partition: Optional[Tuple[int, int]] = getattr(args, "mqtt_partition", None)
+        self.pipeline = self.configure_pipeline() if pipeline else None
         self.client = self.configure_client()
-        self.plr_calc = PacketLossCalculator(self.args.plr)
+        self.plr_calc = plr_calc if plr_calc is not None else plr_tracker_from_args(args)
+
+    def configure_pipeline(self) -> Optional[MessagePipeline]:
+        """Build the worker pipeline from --workers/--queue-size, or None to handle messages inline (--workers 0)."""
+        workers = getattr(self.args, "workers", 0)
+        if workers <= 0:
+            return None
+        handler = self.handle_dry_message if self.args.dry else self.handle_message
+        return MessagePipeline(
+            handler,
+            workers=workers,
+            queue_size=getattr(self.args, "queue_size", 1000),
+            policy=getattr(self.args, "backpressure", BACKPRESSURE_BLOCK),
+        )
 
     def configure_client(self) -> mqtt.Client:
         client_id = self.generate_client_id()
+        if self.partition is not None:
+            client_id += "-p%d" % self.partition[0]
         client = mqtt.Client(client_id)
         client.on_subscribe = self.on_subscribe
         client.on_connect = self.on_connect
@@ -130,13 +227,53 @@ class ChirpstackClient:
         # delay is the number of seconds to wait between successive reconnect attempts(default=1).
         # delay_max is the maximum number of seconds to wait between reconnection attempts(default=1)
         client.reconnect_delay_set(min_delay=5, max_delay=60)
-        if self.args.dry:
-            client.on_message = lambda client, userdata, message: self.dry_message(client, userdata, message)
+        if self.pipeline is not None:
+            on_message = lambda client, userdata, message: self.pipeline.submit(message.topic, message.payload)
+            metrics.register_queue("pipeline", self.pipeline.qsize)
+        elif self.args.dry:
+            on_message = lambda client, userdata, message: self.dry_message(client, userdata, message)
         else:
-            client.on_message = lambda client, userdata, message: self.publish_message(client, userdata, message)
+            on_message = lambda client, userdata, message: self.publish_message(client, userdata, message)
+        if self.partition is not None:
+            on_message = self.partition_filter(on_message, *self.partition)
+        client.on_message = self.timed_on_message(on_message)
         client.on_log = self.on_log
         return client
 
+    @staticmethod
+    def timed_on_message(on_message: Callable[[mqtt.Client, Any, mqtt.MQTTMessage], None]) -> Callable[[mqtt.Client, Any, mqtt.MQTTMessage], None]:
+        """Wrap on_message to record the time the paho network thread spends per message (metrics.py)."""
+
+        def timed(client: mqtt.Client, userdata: Any, message: mqtt.MQTTMessage) -> None:
+            t0 = metrics.start()
+            on_message(client, userdata, message)
+            metrics.observe_stage(metrics.STAGE_MQTT_RECEIVE, t0)
+
+        return timed
+
+    @staticmethod
+    def partition_filter(
+        on_message: Callable[[mqtt.Client, Any, mqtt.MQTTMessage], None], index: int, count: int
+    ) -> Callable[[mqtt.Client, Any, mqtt.MQTTMessage], None]:
+        """
+        Wrap on_message to pass only messages of devices in partition index of count.
+        Messages whose topic names no device are handled by partition 0.
+        """
+
+        def filtered(client: mqtt.Client, userdata: Any, message: mqtt.MQTTMessage) -> None:
+            partition = topic_partition(message.topic, count)
+            if partition == index or (partition is None and index == 0):
+                on_message(client, userdata, message)
+
+        return filtered
+
+    def subscription_topic(self) -> str:
+        """--mqtt-subscribe-topic, as a $share/<group>/ topic with --mqtt-shared-group."""
+        group = getattr(self.args, "mqtt_shared_group", "")
+        if group:
+            return "$share/%s/%s" % (group, self.args.mqtt_subscribe_topic)
+        return self.args.mqtt_subscribe_topic
+
     @staticmethod
     def generate_client_id() -> str:
         """Return a unique MQTT client id from hostname and PID."""
@@ -146,8 +283,12 @@ class ChirpstackClient:
 
     def on_connect(self, client: mqtt.Client, userdata: Any, flags: Any, rc: int) -> None:
         if rc == 0:
-            logging.info("Connected to MQTT broker")
-            client.subscribe(self.args.mqtt_subscribe_topic)
+            topic = self.subscription_topic()
+            if self.partition is not None:
+                logging.info("Connected to MQTT broker; subscribing to %s for partition %d/%d", topic, *self.partition)
+            else:
+                logging.info("Connected to MQTT broker; subscribing to %s", topic)
+            client.subscribe(topic)
         else:
             logging.error(f"Connection to MQTT broker failed with code {rc}") 
         return
@@ -167,13 +308,36 @@ class ChirpstackClient:
     def publish_message(
         self, client: mqtt.Client, userdata: Any, message: mqtt.MQTTMessage
     ) -> None:
-        self.log_message(message)
+        """paho on_message callback used when messages are handled inline (--workers 0)."""
+        self.handle_message(message.topic, message.payload)
+
+    @profiling.profiled
+    def handle_message(self, topic: str, payload: bytes) -> None:
+        """Parse a ChirpStack uplink (with codec fallback) and publish its measurements."""
+        self.log_message(topic, payload)
 
+        t0 = metrics.start()
         try:
-            metadata = parse_message_payload(message.payload.decode("utf-8"))
+            metadata = parse_message_payload(payload)
         except Exception:
-            logging.error("Message payload could not be parsed.")
+            logutil.log_limited(logging.ERROR, "unparsable payload", topic, "Message payload could not be parsed.")
             return
+        metrics.observe_stage(metrics.STAGE_JSON_PARSE, t0)
+
+        timestamp_ns = convert_time(metadata.get("time"))
+        if timestamp_ns is None:
+            logutil.log_limited(
+                logging.ERROR, "invalid time", topic, "ChirpStack message missing or invalid time: %s", metadata.get("time")
+            )
+            return
+
+        dedup = uplink_deduplicator(self.args)
+        if dedup is not None:
+            dev_eui = (metadata.get("deviceInfo") or {}).get("devEui")
+            keys = uplink_keys("local_chirpstack", dev_eui, metadata.get("fCnt"), metadata.get("deduplicationId"))
+            if dedup.is_duplicate("local_chirpstack", keys, timestamp_ns):
+                logging.debug("ChirpStack: duplicate uplink from %s (fCnt %s) dropped", dev_eui, metadata.get("fCnt"))
+                return
 
         measurements = None
         try:
@@ -191,20 +355,27 @@ class ChirpstackClient:
                 )
 
         if measurements is None:
-            logging.error("ChirpStack message did not contain measurements and codec fallback did not apply.")
+            logutil.log_limited(
+                logging.ERROR,
+                "no measurements",
+                topic,
+                "ChirpStack message did not contain measurements and codec fallback did not apply.",
+            )
             return
 
-        timestamp_ns = convert_time(metadata.get("time"))
-        if timestamp_ns is None:
-            logging.error("ChirpStack message missing or invalid time: %s", metadata.get("time"))
-            return
+        t0 = metrics.start()
         try:
-            measurement_metadata = Get_Measurement_metadata(metadata)
+            measurement_metadata, signal_metadata = Get_Metadata(metadata)
         except Exception:
             return
+        metrics.observe_stage(metrics.STAGE_METADATA, t0)
+        metrics.count_message(measurement_metadata.get("lns"), metadata["deviceInfo"].get("devEui"))
 
-        signal_values = Get_Signal_Performance_values(metadata) if self.args.signal_strength_indicators else None
-        signal_metadata = Get_Signal_Performance_metadata(metadata) if self.args.signal_strength_indicators else None
+        signal_values = None
+        if self.args.signal_strength_indicators:
+            signal_values = Get_Signal_Performance_values(metadata)
+        else:
+            signal_metadata = None
 
         process_and_publish(
             measurements,
@@ -219,23 +390,33 @@ class ChirpstackClient:
     def dry_message(
         self, client: mqtt.Client, userdata: Any, message: mqtt.MQTTMessage
     ) -> None:
+        """paho on_message callback used when --dry and messages are handled inline (--workers 0)."""
+        self.handle_dry_message(message.topic, message.payload)
+
+    def handle_dry_message(self, topic: str, payload: bytes) -> None:
         """Log raw message and measurements without publishing (used when --dry)."""
-        self.log_message(message)
-        self.log_measurements(message)
+        self.log_message(topic, payload)
+        self.log_measurements(payload)
 
     @staticmethod
-    def log_message(message: mqtt.MQTTMessage) -> None:
-        """Log raw ChirpStack MQTT message payload and topic."""
-        logging.info(
+    def log_message(topic: str, payload: bytes) -> None:
+        """
+        Log raw ChirpStack MQTT message payload and topic, at most once per topic per
+        rate-limit window unless debugging (the payload is only decoded if the line is logged).
+        """
+        logutil.log_limited(
+            logging.INFO,
+            "ChirpStack message received",
+            topic,
             "ChirpStack Message received: %s with topic %s",
-            message.payload.decode("utf-8"),
-            message.topic,
+            logutil.Lazy(payload),
+            topic,
         )
 
-    def log_measurements(self, message: mqtt.MQTTMessage) -> None:
+    def log_measurements(self, payload: bytes) -> None:
 
         try: #get metadata and measurements received
-            metadata = parse_message_payload(message.payload.decode("utf-8"))
+            metadata = parse_message_payload(payload)
             measurements = metadata["object"]["measurements"]
         except:
             logging.error("Message did not contain measurements.")
@@ -246,14 +427,9 @@ class ChirpstackClient:
             Performance_metadata = Get_Signal_Performance_metadata(metadata)
         
         for measurement in measurements:
-            # Skip the measurement if it's in the ignore list
-            if measurement["name"] in self.args.ignore:
-                continue
-            if self.args.collect: #true if not empty
-                if measurement["name"] in self.args.collect: #if not empty only log measurements in list
-                    logging.info(str(measurement["name"]) + ": " + str(measurement["value"]))
-            else: #else collect is empty so log all measurements
-                    logging.info(str(measurement["name"]) + ": " + str(measurement["value"]))
+            # Skip the measurement if it's ignored or not collected
+            if measurement_filter(self.args).allows(measurement["name"]):
+                logging.info(str(measurement["name"]) + ": " + str(measurement["value"]))
 
         if self.args.signal_strength_indicators:
             for val in Performance_vals['rxInfo']:
@@ -261,7 +437,7 @@ class ChirpstackClient:
                 logging.info("  rssi: " + str(val["rssi"]))
                 logging.info("  snr: " + str(val["snr"]))
             logging.info("spreading factor: " + str(Performance_vals["spreadingfactor"]))
-            pl,plr = self.plr_calc.process_packet(Performance_metadata['devEui'], Performance_vals['fCnt'])
+            pl,plr = self.plr_calc.process_packet((Performance_metadata.get('lns'), Performance_metadata['devEui']), Performance_vals.get('fCnt'))
             logging.info(f"packet loss: {pl}")
             if plr is not None:
                 logging.info(f"packet loss rate: {plr:.2f}%")
@@ -269,8 +445,14 @@ class ChirpstackClient:
         return
 
     def run(self) -> None:
-        """Connect to MQTT broker and run the event loop (blocks until disconnect)."""
+        """Start the message pipeline, connect to MQTT broker and run the event loop (blocks until disconnect)."""
+        if self.pipeline is not None:
+            self.pipeline.start()
         logging.info(f"connecting [{self.args.mqtt_server_ip}:{self.args.mqtt_server_port}]...")
         self.client.connect(host=self.args.mqtt_server_ip, port=self.args.mqtt_server_port, bind_address="0.0.0.0")
         logging.info("waiting for callback...")
-        self.client.loop_forever()
+        try:
+            self.client.loop_forever()
+        finally:
+            if self.pipeline is not None:
+                self.pipeline.stop()
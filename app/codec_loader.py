@@ -5,7 +5,9 @@ When Loriot lacks decoded.data or ChirpStack lacks object.measurements, the plug
 decode raw payload using a Codec class loaded from a GitHub repo or local path. Map keys
 are device names or regex patterns; values are repo URLs or paths (path after .git for
 multiple codecs in one repo). The Contract class holds the map and cache dir and
-provides warm_codec_cache() and decode_with_codec().
+provides warm_codec_cache() and decode_with_codec(), and decode_many() for backlogs: a codec
+may define decode_batch(list_of_bytes) -> list of dicts, which is then called once for many
+payloads of its devices instead of decode() per payload.
 """
 from __future__ import annotations
 
@@ -17,33 +19,113 @@ import os
 import re
 import subprocess
 import threading
-from typing import Any, Dict, List, Optional, Tuple
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Pattern, Sequence, Tuple
 
 from parse import clean_string
+from codec_pool import CODEC_POOL_FAILURES as _POOL_FAILURES
+import metrics
+import profiling
+import logutil
 
-# Lock for clone/import to avoid races when Loriot and ChirpStack use codecs from same repo.
+# Lock for codec imports to avoid races when Loriot and ChirpStack load the same codec.
 _clone_import_lock = threading.Lock()
 
+# Per-checkout locks for git clone/pull, so different repos sync concurrently.
+_repo_locks: Dict[str, threading.Lock] = {}
+_repo_locks_guard = threading.Lock()
+# Checkouts already cloned or pulled by this process.
+_synced_repos = set()
+# File in a checkout's .git dir whose mtime records the last clone/pull (for --codec-pull-ttl-sec).
+_SYNC_STAMP = "lorawan-listener-synced"
+
 # Cache: codec_dir -> Codec instance (shared across Contract instances)
 _codec_instance_cache = {}
 _cache_lock = threading.Lock()
 
 
-def _resolve_entry_for_device(
-    device_name: str, codec_map: Dict[str, str]
-) -> Optional[str]:
-    """Return url_or_path for the first matching key (exact or regex), or None if no match."""
-    if not codec_map or not device_name:
+# Fewest payloads of one codec passed to its decode_batch; smaller groups use decode.
+BATCH_MIN_PAYLOADS = 8
+
+_BACKREF_RE = re.compile(r"\\[1-9]|\(\?P=")
+# Inline global flags such as (?i) (not scoped ones such as (?i:...)).
+_GLOBAL_FLAGS_RE = re.compile(r"\(\?[aiLmsux]+\)")
+
+
+class _DeviceMatcher:
+    """
+    Resolves device names to codec map values: exact key first, then regex keys in map order
+    (first match wins). All patterns are compiled once and combined into one alternation of
+    named groups; results (including misses) are memoized per device name in a bounded LRU.
+    """
+
+    def __init__(self, codec_map: Dict[str, str], memo_size: int = 4096) -> None:
+        self.codec_map = codec_map or {}
+        self.memo_size = memo_size
+        self._memo: "OrderedDict[str, Optional[str]]" = OrderedDict()
+        self._memo_lock = threading.Lock()
+        # Group name -> map key, in map order.
+        self._groups: Dict[str, str] = {}
+        self._patterns: List[Tuple[str, Pattern[str]]] = []
+        for i, key in enumerate(self.codec_map):
+            try:
+                pattern = re.compile(key)
+            except (re.error, TypeError):
+                continue
+            self._patterns.append((key, pattern))
+            self._groups[f"_k{i}"] = key
+        self._combined: Optional[Pattern[str]] = None
+        # Numbered backreferences would point at the wrong group once keys are combined, and an
+        # inline global flag such as (?i) would apply to every key (on Python 3.8 a flag that is
+        # not at the start is only a DeprecationWarning), so such maps are matched key by key.
+        if self._patterns and not any(
+            _BACKREF_RE.search(key) or _GLOBAL_FLAGS_RE.search(key) for key, _ in self._patterns
+        ):
+            try:
+                self._combined = re.compile(
+                    "|".join(
+                        f"(?P<{name}>{key})" for name, key in self._groups.items()
+                    )
+                )
+            except re.error:
+                # e.g. duplicate group names across keys; match one by one.
+                self._combined = None
+
+    def _match(self, device_name: str) -> Optional[str]:
+        """Uncached resolution: exact key, then first matching pattern."""
+        if device_name in self.codec_map:
+            return self.codec_map[device_name]
+        if self._combined is not None:
+            m = self._combined.match(device_name)
+            if m is None:
+                return None
+            # Alternatives are tried left to right, so the first participating group is the
+            # first matching key in map order.
+            for name, key in self._groups.items():
+                if m.group(name) is not None:
+                    return self.codec_map[key]
+            return None
+        for key, pattern in self._patterns:
+            if pattern.match(device_name):
+                return self.codec_map[key]
         return None
-    if device_name in codec_map:
-        return codec_map[device_name]
-    for key, url_or_path in codec_map.items():
-        try:
-            if re.match(key, device_name):
-                return url_or_path
-        except re.error:
-            continue
-    return None
+
+    def resolve(self, device_name: str) -> Optional[str]:
+        """Return url_or_path for device_name, or None if no key matches."""
+        if not self.codec_map or not device_name:
+            return None
+        with self._memo_lock:
+            if device_name in self._memo:
+                self._memo.move_to_end(device_name)
+                return self._memo[device_name]
+        url_or_path = self._match(device_name)
+        with self._memo_lock:
+            self._memo[device_name] = url_or_path
+            if len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return url_or_path
 
 
 def _is_github_url(url_or_path: Any) -> bool:
@@ -62,12 +144,50 @@ def _sanitize_cache_key(url: str) -> str:
     return re.sub(r"[^a-zA-Z0-9._-]", "_", s)
 
 
-def _ensure_repo_cloned(url: str, cache_dir: str) -> Optional[str]:
-    """Clone repo into cache_dir if not present; return path to repo root. Thread-safe."""
+def _repo_lock(dest: str) -> threading.Lock:
+    """Return the lock serializing git operations on one checkout."""
+    with _repo_locks_guard:
+        lock = _repo_locks.get(dest)
+        if lock is None:
+            lock = _repo_locks[dest] = threading.Lock()
+        return lock
+
+
+def _checkout_age_sec(dest: str) -> Optional[float]:
+    """Seconds since dest was last cloned or pulled by the plugin, or None if unknown."""
+    try:
+        return time.time() - os.path.getmtime(os.path.join(dest, ".git", _SYNC_STAMP))
+    except OSError:
+        return None
+
+
+def _touch_sync_stamp(dest: str) -> None:
+    """Record that dest was just cloned or pulled."""
+    try:
+        with open(os.path.join(dest, ".git", _SYNC_STAMP), "w", encoding="utf-8"):
+            pass
+    except OSError:
+        pass
+
+
+def _ensure_repo_cloned(url: str, cache_dir: str, pull_ttl_sec: float = 0) -> Optional[str]:
+    """
+    Clone repo into cache_dir if not present; return path to repo root. Thread-safe.
+
+    An existing checkout is pulled at most once per process, and not at all if it was
+    synced less than pull_ttl_sec ago. Different repos are cloned/pulled concurrently.
+    """
     key = _sanitize_cache_key(url)
     dest = os.path.join(cache_dir, key)
-    with _clone_import_lock:
+    with _repo_lock(dest):
         if os.path.isdir(dest):
+            if dest in _synced_repos:
+                return dest
+            age = _checkout_age_sec(dest)
+            if pull_ttl_sec > 0 and age is not None and age < pull_ttl_sec:
+                logging.debug("Codec repo %s synced %.0fs ago; skipping git pull", url, age)
+                _synced_repos.add(dest)
+                return dest
             try:
                 subprocess.run(
                     ["git", "pull"],
@@ -76,8 +196,10 @@ def _ensure_repo_cloned(url: str, cache_dir: str) -> Optional[str]:
                     capture_output=True,
                     timeout=30,
                 )
+                _touch_sync_stamp(dest)
             except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError):
                 pass
+            _synced_repos.add(dest)
             return dest
         try:
             os.makedirs(cache_dir, exist_ok=True)
@@ -87,6 +209,8 @@ def _ensure_repo_cloned(url: str, cache_dir: str) -> Optional[str]:
                 capture_output=True,
                 timeout=60,
             )
+            _touch_sync_stamp(dest)
+            _synced_repos.add(dest)
             return dest
         except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError) as e:
             logging.warning("Git clone failed for %s: %s", url, e)
@@ -132,7 +256,7 @@ def _split_base_subpath(value: str) -> Tuple[str, Optional[str]]:
     return base, subpath
 
 
-def _resolve_codec_dir(url_or_path: str, cache_dir: str) -> Optional[str]:
+def _resolve_codec_dir(url_or_path: str, cache_dir: str, pull_ttl_sec: float = 0) -> Optional[str]:
     """
     Resolve map value to directory that contains codec.py. Returns path or None.
     If value contains .git, the part after .git is the path to the codec (e.g. .../codec.git/codecs/water).
@@ -143,7 +267,7 @@ def _resolve_codec_dir(url_or_path: str, cache_dir: str) -> Optional[str]:
     if not base:
         return None
     if _is_github_url(base):
-        repo_dir = _ensure_repo_cloned(base, cache_dir)
+        repo_dir = _ensure_repo_cloned(base, cache_dir, pull_ttl_sec)
         if repo_dir is None:
             return None
         if subpath:
@@ -183,36 +307,102 @@ class Contract:
             logging.warning("Codec map load failed: %s", e)
             return None
 
-    def __init__(self, codec_map: Dict[str, str], cache_dir: str) -> None:
-        """Hold codec map and cache dir; _resolved_dirs and _codec_instances are filled on use."""
+    def __init__(
+        self,
+        codec_map: Dict[str, str],
+        cache_dir: str,
+        pull_ttl_sec: float = 0,
+        warmup_workers: int = 4,
+        pool: Optional[Any] = None,
+    ) -> None:
+        """
+        Hold codec map and cache dir; _resolved_dirs and _codec_instances are filled on use.
+        pull_ttl_sec: skip git pull for checkouts synced less than this many seconds ago.
+        warmup_workers: max repos cloned/pulled concurrently by warm_codec_cache().
+        pool: a codec_pool.CodecPool to run codecs in worker processes instead of inline.
+        """
         self.codec_map = codec_map
         self.cache_dir = cache_dir
+        self.pull_ttl_sec = pull_ttl_sec
+        self.warmup_workers = max(1, int(warmup_workers))
+        self.pool = pool
+        self._matcher = _DeviceMatcher(codec_map)
         self._resolved_dirs = {}  # url_or_path -> codec_dir
         self._codec_instances = {}  # codec_dir -> Codec instance
 
+    def _resolve_dir(self, url_or_path: str) -> Optional[str]:
+        """Return (and remember) the codec directory for a map value."""
+        if url_or_path not in self._resolved_dirs:
+            self._resolved_dirs[url_or_path] = _resolve_codec_dir(url_or_path, self.cache_dir, self.pull_ttl_sec)
+        return self._resolved_dirs[url_or_path]
+
+    def _warm_values(self, values: List[str]) -> None:
+        """Resolve and load the codecs of map values sharing one repo (or path)."""
+        for url_or_path in values:
+            try:
+                codec_dir = self._resolve_dir(url_or_path)
+                if codec_dir and self.pool is not None:
+                    self.pool.preload(codec_dir)
+                elif codec_dir and codec_dir not in self._codec_instances:
+                    instance = _load_codec_from_path(codec_dir)
+                    if instance is not None:
+                        self._codec_instances[codec_dir] = instance
+            except Exception as e:
+                logging.warning("Codec warm-up failed for %s: %s", url_or_path, e)
+
     def warm_codec_cache(self) -> None:
         """
         Load all codec.py classes for entries in the map so clones/imports happen before
         clients start, avoiding races. Call from main before starting Loriot or MQTT client.
+        Map values are grouped by repo (base URL before the path after .git) and the
+        groups are warmed concurrently, so each repo is cloned or pulled once.
         """
         if not self.codec_map or not self.cache_dir:
             return
-        seen = set()
+        groups: Dict[str, List[str]] = {}
         for url_or_path in self.codec_map.values():
-            if not url_or_path or url_or_path in seen:
+            if not url_or_path or not isinstance(url_or_path, str):
                 continue
-            seen.add(url_or_path)
-            try:
-                if url_or_path not in self._resolved_dirs:
-                    self._resolved_dirs[url_or_path] = _resolve_codec_dir(url_or_path, self.cache_dir)
-                codec_dir = self._resolved_dirs[url_or_path]
-                if codec_dir and codec_dir not in self._codec_instances:
-                    instance = _load_codec_from_path(codec_dir)
-                    if instance is not None:
-                        self._codec_instances[codec_dir] = instance
-            except Exception as e:
-                logging.warning("Codec warm-up failed for %s: %s", url_or_path, e)
+            values = groups.setdefault(_split_base_subpath(url_or_path)[0], [])
+            if url_or_path not in values:
+                values.append(url_or_path)
+        started = time.monotonic()
+        with ThreadPoolExecutor(
+            max_workers=min(self.warmup_workers, len(groups) or 1),
+            thread_name_prefix="codec-warmup",
+        ) as executor:
+            for values in groups.values():
+                executor.submit(self._warm_values, values)
+        logging.info(
+            "Codec warm-up finished: %d codec(s) from %d source(s) in %.1fs",
+            len(set(self._resolved_dirs.values()) - {None}) if self.pool is not None else len(self._codec_instances),
+            len(groups),
+            time.monotonic() - started,
+        )
+
+    def start_warmup_daemon(self) -> None:
+        """Run warm_codec_cache() in a daemon thread; codecs not yet warm are loaded on first use."""
+        thread = threading.Thread(
+            target=self.warm_codec_cache,
+            daemon=True,
+            name="codec-warmup",
+        )
+        thread.start()
+
+    @staticmethod
+    def _decode_failed(device_name: str, url_or_path: str, error: Any, reason: str) -> None:
+        """Log (rate-limited) and count a failed Codec.decode."""
+        logutil.log_limited(
+            logging.WARNING,
+            "codec decode failed",
+            "device %s" % device_name,
+            "Codec Contract: codec decode failed for device %s: %s",
+            device_name,
+            error,
+        )
+        metrics.count_codec_failure(url_or_path, reason)
 
+    @profiling.profiled
     def decode_with_codec(
         self,
         device_name: str,
@@ -228,26 +418,31 @@ class Contract:
         if not self.codec_map or not self.cache_dir or not device_name or payload is None:
             logging.debug("Codec Contract: no codec map or cache dir or device name or payload")
             return None
-        url_or_path = _resolve_entry_for_device(device_name, self.codec_map)
+        t0 = metrics.start()
+        url_or_path = self._matcher.resolve(device_name)
         if url_or_path is None:
             logging.debug("Codec Contract: no matching codec map entry for device name %s", device_name)
             return None
         if url_or_path not in self._resolved_dirs:
             logging.debug("Codec Contract: url_or_path not in cache, resolving codec directory for url_or_path %s", url_or_path)
-            self._resolved_dirs[url_or_path] = _resolve_codec_dir(url_or_path, self.cache_dir)
-        codec_dir = self._resolved_dirs[url_or_path]
+        codec_dir = self._resolve_dir(url_or_path)
         if codec_dir is None:
             logging.debug("Codec Contract: no codec directory for url_or_path %s", url_or_path)
+            metrics.count_codec_failure(url_or_path, "resolve")
             return None
-        if codec_dir not in self._codec_instances:
-            logging.debug("Codec Contract: codec_dir not in cache, loading codec from path %s", codec_dir)
-            instance = _load_codec_from_path(codec_dir)
-            if instance is not None:
-                self._codec_instances[codec_dir] = instance
-        codec_instance = self._codec_instances.get(codec_dir)
-        if codec_instance is None:
-            logging.debug("Codec Contract: no codec instance for codec_dir %s", codec_dir)
-            return None
+        codec_instance = None
+        if self.pool is None:
+            if codec_dir not in self._codec_instances:
+                logging.debug("Codec Contract: codec_dir not in cache, loading codec from path %s", codec_dir)
+                instance = _load_codec_from_path(codec_dir)
+                if instance is not None:
+                    self._codec_instances[codec_dir] = instance
+            codec_instance = self._codec_instances.get(codec_dir)
+            if codec_instance is None:
+                logging.debug("Codec Contract: no codec instance for codec_dir %s", codec_dir)
+                metrics.count_codec_failure(url_or_path, "load")
+                return None
+        metrics.observe_stage(metrics.STAGE_CODEC_RESOLVE, t0)
         try:
             if encoding == "hex":
                 payload_bytes = bytes.fromhex(payload)
@@ -257,21 +452,156 @@ class Contract:
                 logging.warning("Codec Contract: unknown payload encoding: %s", encoding)
                 return None
         except Exception as e:
-            logging.warning("Codec Contract: payload decode failed: %s", e)
-            return None
-        try:
-            result = codec_instance.decode(payload_bytes)
-        except Exception as e:
-            logging.warning("Codec Contract: codec decode failed: %s", e)
+            logutil.log_limited(
+                logging.WARNING, "payload decode failed", device_name, "Codec Contract: payload decode failed: %s", e
+            )
+            metrics.count_codec_failure(url_or_path, "payload")
             return None
+        t0 = metrics.start()
+        p0 = profiling.codec_timer()
+        if self.pool is not None:
+            ok, result = self.pool.decode(url_or_path, codec_dir, payload_bytes)
+            profiling.record_codec(url_or_path, p0)
+            if not ok:
+                self._decode_failed(device_name, url_or_path, result, result if result in _POOL_FAILURES else "decode")
+                return None
+        else:
+            try:
+                result = codec_instance.decode(payload_bytes)
+            except Exception as e:
+                profiling.record_codec(url_or_path, p0)
+                self._decode_failed(device_name, url_or_path, e, "decode")
+                return None
+            profiling.record_codec(url_or_path, p0)
+            metrics.observe_codec(url_or_path, t0)
+        metrics.observe_stage(metrics.STAGE_CODEC_DECODE, t0)
+        return self._measurements(url_or_path, result)
+
+    @staticmethod
+    def _measurements(
+        url_or_path: str,
+        result: Any,
+        names: Optional[Dict[Any, str]] = None,
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        Convert a codec result dict to measurements; None if it is not a dict or has no values.
+        names caches cleaned measurement names across the results of one batch.
+        """
         if not isinstance(result, dict):
             logging.debug("Codec Contract: codec decode did not return a dict")
+            metrics.count_codec_failure(url_or_path, "result")
             return None
         measurements = []
         for key, value in result.items():
             if value is None:
                 continue
-            name = clean_string(str(key))
+            if names is None:
+                name = clean_string(str(key))
+            else:
+                name = names.get(key)
+                if name is None:
+                    name = names[key] = clean_string(str(key))
             measurements.append({"name": name, "value": value})
         logging.debug("Codec Contract: decoded measurements: %s", measurements)
         return measurements if measurements else None
+
+    def _batch_codec(self, url_or_path: str) -> Optional[Any]:
+        """The inline codec instance for a map value if it defines decode_batch, else None."""
+        if self.pool is not None:
+            return None
+        codec_dir = self._resolve_dir(url_or_path)
+        if codec_dir is None:
+            return None
+        if codec_dir not in self._codec_instances:
+            instance = _load_codec_from_path(codec_dir)
+            if instance is not None:
+                self._codec_instances[codec_dir] = instance
+        codec_instance = self._codec_instances.get(codec_dir)
+        return codec_instance if callable(getattr(codec_instance, "decode_batch", None)) else None
+
+    @profiling.profiled
+    def decode_many(
+        self,
+        requests: Sequence[Tuple[str, str]],
+        encoding: str = "hex",
+    ) -> List[Optional[List[Dict[str, Any]]]]:
+        """
+        Decode several (device_name, payload) pairs, e.g. a backlog of Loriot inbox files.
+
+        Payloads whose devices map to the same codec are passed to its decode_batch in one
+        call when the codec defines it (inline codecs only) and at least BATCH_MIN_PAYLOADS
+        are pending; the rest go through decode_with_codec. Returns one result per request,
+        as decode_with_codec would.
+        """
+        results: List[Optional[List[Dict[str, Any]]]] = [None] * len(requests)
+        if not self.codec_map or not self.cache_dir:
+            return results
+        groups: Dict[str, List[int]] = {}
+        for i, (device_name, payload) in enumerate(requests):
+            if not device_name or payload is None:
+                continue
+            url_or_path = self._matcher.resolve(device_name)
+            if url_or_path is not None:
+                groups.setdefault(url_or_path, []).append(i)
+        for url_or_path, indexes in groups.items():
+            codec_instance = self._batch_codec(url_or_path) if len(indexes) >= BATCH_MIN_PAYLOADS else None
+            if codec_instance is not None:
+                self._decode_batch(codec_instance, url_or_path, requests, indexes, encoding, results)
+            else:
+                for i in indexes:
+                    results[i] = self.decode_with_codec(requests[i][0], requests[i][1], encoding=encoding)
+        return results
+
+    def _decode_batch(
+        self,
+        codec_instance: Any,
+        url_or_path: str,
+        requests: Sequence[Tuple[str, str]],
+        indexes: List[int],
+        encoding: str,
+        results: List[Optional[List[Dict[str, Any]]]],
+    ) -> None:
+        """
+        Run codec_instance.decode_batch for requests[indexes] and fill results. If decode_batch
+        raises or returns the wrong number of results, the payloads are decoded one by one.
+        """
+        if encoding not in ("hex", "base64"):
+            logging.warning("Codec Contract: unknown payload encoding: %s", encoding)
+            return
+        decodable: List[int] = []
+        payloads: List[bytes] = []
+        for i in indexes:
+            device_name, payload = requests[i]
+            try:
+                payloads.append(bytes.fromhex(payload) if encoding == "hex" else base64.b64decode(payload))
+            except Exception as e:
+                logutil.log_limited(
+                    logging.WARNING, "payload decode failed", device_name, "Codec Contract: payload decode failed: %s", e
+                )
+                metrics.count_codec_failure(url_or_path, "payload")
+                continue
+            decodable.append(i)
+        if not decodable:
+            return
+        t0 = metrics.start()
+        p0 = profiling.codec_timer()
+        try:
+            decoded = codec_instance.decode_batch(payloads)
+        except Exception as e:
+            profiling.record_codec(url_or_path, p0, len(payloads))
+            logging.warning("Codec Contract: decode_batch failed for %s; decoding one by one: %s", url_or_path, e)
+            decoded = None
+        else:
+            profiling.record_codec(url_or_path, p0, len(payloads))
+            metrics.observe_codec(url_or_path, t0, len(payloads))
+            metrics.observe_stage(metrics.STAGE_CODEC_DECODE, t0)
+            if not isinstance(decoded, list) or len(decoded) != len(payloads):
+                logging.warning("Codec Contract: decode_batch for %s returned the wrong number of results; decoding one by one", url_or_path)
+                decoded = None
+        if decoded is None:
+            for i in decodable:
+                results[i] = self.decode_with_codec(requests[i][0], requests[i][1], encoding=encoding)
+            return
+        names: Dict[Any, str] = {}
+        for i, result in zip(decodable, decoded):
+            results[i] = self._measurements(url_or_path, result, names)
@@ -0,0 +1,297 @@
+"""
+Codec execution in worker processes (--codec-isolation process).
+
+Third-party Codec.decode code runs in a pool of worker processes instead of the message
+threads, so a codec that hangs or burns CPU cannot freeze ingestion and CPU-heavy codecs
+use more than one core. Each worker imports codecs with the same loader as inline mode
+(_load_codec_from_path on directories resolved by _resolve_codec_dir in the parent) and
+keeps them loaded. A call that exceeds the timeout kills its worker, which is replaced.
+A codec that times out or crashes its worker failure_threshold times in a row is skipped
+for cooldown_sec (circuit breaker), then tried again. Errors raised by the codec and calls
+that found no free worker ("busy") are counted as failures but do not trip the breaker. Per-codec call, failure and latency
+stats are kept in stats() and in the lorawan_codec_seconds metric.
+"""
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from multiprocessing.connection import Connection
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import metrics
+
+CODEC_ISOLATION_INLINE = "inline"
+CODEC_ISOLATION_PROCESS = "process"
+CODEC_ISOLATIONS = (CODEC_ISOLATION_INLINE, CODEC_ISOLATION_PROCESS)
+
+# Failure reasons of CodecPool.decode other than an error raised by the codec.
+CODEC_POOL_FAILURES = ("open", "busy", "timeout", "crashed")
+# Failures that count toward the circuit breaker: the codec itself hangs or kills its worker.
+_BREAKER_REASONS = ("timeout", "crashed")
+
+# Worker processes are spawned, not forked, so they do not inherit the parent's threads and locks.
+_mp = multiprocessing.get_context("spawn")
+
+
+def _worker_main(conn: Connection) -> None:
+    """Worker process loop: ("load", codec_dir) preloads, ("decode", codec_dir, payload) replies."""
+    from codec_loader import _load_codec_from_path
+
+    codecs: Dict[str, Any] = {}
+
+    def codec_for(codec_dir: str) -> Any:
+        if codec_dir not in codecs:
+            codecs[codec_dir] = _load_codec_from_path(codec_dir)
+        return codecs[codec_dir]
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError, KeyboardInterrupt):
+            return
+        if message is None:
+            return
+        if message[0] == "load":
+            try:
+                codec_for(message[1])
+            except Exception as e:
+                logging.warning("Codec worker: could not load %s: %s", message[1], e)
+            continue
+        _, codec_dir, payload = message
+        try:
+            codec = codec_for(codec_dir)
+            if codec is None:
+                reply: Tuple[str, Any] = ("error", "codec could not be loaded")
+            else:
+                reply = ("ok", codec.decode(payload))
+            conn.send(reply)
+        except Exception as e:
+            # Also covers results that cannot be pickled.
+            conn.send(("error", "%s: %s" % (type(e).__name__, e)))
+
+
+class _Worker:
+    """One worker process and the parent's end of its pipe."""
+
+    def __init__(self, preload: List[str]) -> None:
+        self.conn, child_conn = _mp.Pipe()
+        self.process = _mp.Process(target=_worker_main, args=(child_conn,), daemon=True, name="codec-worker")
+        self.process.start()
+        child_conn.close()
+        for codec_dir in preload:
+            self.conn.send(("load", codec_dir))
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join(1)
+        self.conn.close()
+
+
+class _CodecState:
+    """Stats and circuit breaker state of one codec."""
+
+    __slots__ = ("calls", "failures", "timeouts", "total_sec", "max_sec", "consecutive_failures", "open_until")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.total_sec = 0.0
+        self.max_sec = 0.0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+
+class CodecPool:
+    """Runs Codec.decode in worker processes with timeouts and a per-codec circuit breaker."""
+
+    def __init__(
+        self,
+        workers: int = 2,
+        timeout_sec: float = 5.0,
+        failure_threshold: int = 5,
+        cooldown_sec: float = 60.0,
+    ) -> None:
+        """
+        workers: number of worker processes.
+        timeout_sec: max time per decode; the worker is killed and replaced when exceeded.
+        failure_threshold: consecutive failures after which a codec is skipped (0: never).
+        cooldown_sec: how long a codec is skipped before it is tried again.
+        """
+        self.workers = max(1, int(workers))
+        self.timeout_sec = timeout_sec
+        self.failure_threshold = failure_threshold
+        self.cooldown_sec = cooldown_sec
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._all: Set[_Worker] = set()
+        self._preload: List[str] = []
+        self._states: Dict[str, _CodecState] = {}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self) -> None:
+        """Start the worker processes."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for _ in range(self.workers):
+            self._add_worker()
+        logging.info("Codec pool started with %d worker process(es), timeout %ss", self.workers, self.timeout_sec)
+
+    def stop(self) -> None:
+        """Stop all worker processes."""
+        with self._lock:
+            workers, self._all = list(self._all), set()
+            self._started = False
+        for worker in workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.process.join(1)
+            if worker.process.is_alive():
+                worker.kill()
+
+    def _add_worker(self) -> None:
+        with self._lock:
+            preload = list(self._preload)
+        worker = _Worker(preload)
+        with self._lock:
+            self._all.add(worker)
+        self._idle.put(worker)
+
+    def _replace_worker(self, worker: _Worker) -> None:
+        """Kill a hung or broken worker and start a new one."""
+        with self._lock:
+            self._all.discard(worker)
+            running = self._started
+        worker.kill()
+        if running:
+            self._add_worker()
+
+    def preload(self, codec_dir: str) -> None:
+        """Load codec_dir in every worker now and in every worker started later."""
+        with self._lock:
+            if codec_dir in self._preload:
+                return
+            self._preload.append(codec_dir)
+        # Idle workers get the load message now; busy ones load on first use.
+        idle = []
+        while True:
+            try:
+                idle.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        for worker in idle:
+            try:
+                worker.conn.send(("load", codec_dir))
+            except OSError:
+                self._replace_worker(worker)
+                continue
+            self._idle.put(worker)
+
+    def _state(self, codec: str) -> _CodecState:
+        with self._lock:
+            state = self._states.get(codec)
+            if state is None:
+                state = self._states[codec] = _CodecState()
+            return state
+
+    def decode(self, codec: str, codec_dir: str, payload: bytes) -> Tuple[bool, Any]:
+        """
+        Run the codec in codec_dir on payload in a worker. codec names the codec in stats.
+        Returns (True, result) or (False, reason) with reason one of "open" (circuit
+        open), "busy" (no worker free within the timeout), "timeout", "crashed" or an error.
+        """
+        self.start()
+        state = self._state(codec)
+        now = time.monotonic()
+        if state.open_until > now:
+            return False, "open"
+        t0 = time.perf_counter()
+        try:
+            worker = self._idle.get(timeout=self.timeout_sec)
+        except queue.Empty:
+            return self._failed(codec, state, "busy", t0)
+        try:
+            worker.conn.send(("decode", codec_dir, payload))
+            if not worker.conn.poll(self.timeout_sec):
+                self._replace_worker(worker)
+                return self._failed(codec, state, "timeout", t0)
+            status, value = worker.conn.recv()
+        except (EOFError, OSError):
+            self._replace_worker(worker)
+            return self._failed(codec, state, "crashed", t0)
+        self._idle.put(worker)
+        if status != "ok":
+            return self._failed(codec, state, value, t0)
+        elapsed = time.perf_counter() - t0
+        with self._lock:
+            state.calls += 1
+            state.total_sec += elapsed
+            state.max_sec = max(state.max_sec, elapsed)
+            state.consecutive_failures = 0
+        metrics.observe_codec(codec, t0)
+        return True, value
+
+    def _failed(self, codec: str, state: _CodecState, reason: str, t0: float) -> Tuple[bool, str]:
+        """Record a failed call and open the circuit after failure_threshold timeouts/crashes in a row."""
+        elapsed = time.perf_counter() - t0
+        with self._lock:
+            state.calls += 1
+            state.failures += 1
+            state.total_sec += elapsed
+            state.max_sec = max(state.max_sec, elapsed)
+            if reason == "timeout":
+                state.timeouts += 1
+            if reason in _BREAKER_REASONS:
+                state.consecutive_failures += 1
+            elif reason != "busy":
+                # The codec answered (with an error), so its worker is healthy.
+                state.consecutive_failures = 0
+            opened = self.failure_threshold > 0 and state.consecutive_failures >= self.failure_threshold
+            if opened:
+                state.open_until = time.monotonic() + self.cooldown_sec
+                state.consecutive_failures = 0
+        metrics.observe_codec(codec, t0)
+        if opened:
+            logging.warning(
+                "Codec pool: %s failed %d times in a row (last: %s); skipping it for %ss",
+                codec,
+                self.failure_threshold,
+                reason,
+                self.cooldown_sec,
+            )
+        return False, reason
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per-codec calls, failures, timeouts, mean/max latency and whether its circuit is open."""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                codec: {
+                    "calls": s.calls,
+                    "failures": s.failures,
+                    "timeouts": s.timeouts,
+                    "mean_ms": round(s.total_sec / s.calls * 1000, 3) if s.calls else None,
+                    "max_ms": round(s.max_sec * 1000, 3),
+                    "open": s.open_until > now,
+                }
+                for codec, s in self._states.items()
+            }
+
+
+def codec_pool_from_args(args: Any) -> Optional[CodecPool]:
+    """A CodecPool for --codec-isolation process, else None."""
+    if getattr(args, "codec_isolation", CODEC_ISOLATION_INLINE) != CODEC_ISOLATION_PROCESS:
+        return None
+    return CodecPool(
+        workers=getattr(args, "codec_workers", 2),
+        timeout_sec=getattr(args, "codec_timeout_sec", 5.0),
+        failure_threshold=getattr(args, "codec_failure_threshold", 5),
+        cooldown_sec=getattr(args, "codec_cooldown_sec", 60.0),
+    )
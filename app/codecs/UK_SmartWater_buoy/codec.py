@@ -3,8 +3,23 @@ UK SmartWater Buoy codec for LoRaWAN Listener.
 7 or 8 bytes, big-endian u16 fields
 -> battery_voltage_v, temperature_c (from Kelvin×100), fec (TDS/10), turbidity (turb/10).
 With 7 bytes, the last u16 is (bytes[6]<<8)|0 (JS treats missing byte as 0).
+decode_batch decodes many payloads at once with NumPy when it is installed.
 """
 import struct
+from typing import List
+
+
+def _round(np, values, ndigits: int) -> list:
+    """
+    np.round(values, ndigits) as a list, matching Python's round() exactly: np.round
+    scales by 10**ndigits first, so values within rounding error of a tie are redone
+    with round().
+    """
+    scaled = values * 10.0 ** ndigits
+    rounded = np.round(values, ndigits).tolist()
+    for i in np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6).tolist():
+        rounded[i] = round(float(values[i]), ndigits)
+    return rounded
 
 
 class Codec:
@@ -40,3 +55,42 @@ class Codec:
             }
         except (struct.error, IndexError):
             return {}
+
+    def decode_batch(self, payloads: List[bytes]) -> List[dict]:
+        """
+        Decode many payloads at once (e.g. an inbox backlog); same results as decode() per payload.
+        The fields of all 7/8-byte payloads are read as one big-endian u16 array and scaled
+        column-wise with NumPy. Without NumPy each payload goes through decode().
+        """
+        try:
+            import numpy as np
+        except ImportError:
+            return [self.decode(p) for p in payloads]
+        results: List[dict] = [{} for _ in payloads]
+        rows = []
+        frames = []
+        for i, p in enumerate(payloads):
+            if len(p) >= 8:
+                frames.append(bytes(p[:8]))
+            elif len(p) == 7:
+                frames.append(bytes(p) + b"\x00")
+            else:
+                continue
+            rows.append(i)
+        if not rows:
+            return results
+        raw = np.frombuffer(b"".join(frames), dtype=">u2").reshape(-1, 4).astype(np.float64)
+        columns = (
+            _round(np, raw[:, 0] * 3.3 / 512, 3),
+            _round(np, raw[:, 1] / 100.0 - 273.15, 1),
+            _round(np, raw[:, 2] / 10.0, 2),
+            _round(np, raw[:, 3] / 10.0, 2),
+        )
+        for i, vbat, temp, fec, turb in zip(rows, *columns):
+            results[i] = {
+                "battery_voltage_v": vbat,
+                "temperature_c": temp,
+                "fec": fec,
+                "turbidity": turb,
+            }
+        return results
@@ -0,0 +1,112 @@
+"""
+Uplink deduplication across gateways, MQTT redeliveries and both network servers.
+
+An uplink is identified by up to two keys:
+
+- a message id: ChirpStack's deduplicationId, or Loriot's (EUI, seqno, fcnt);
+- the frame: (devEui, fCnt) with the uplink time, so the same frame heard through
+  ChirpStack and Loriot is caught even though their message ids differ. Frames match
+  only if their uplink times are within time_tolerance_sec, so a device whose frame
+  counter restarted is not mistaken for a duplicate.
+
+Keys are kept in a time-bounded LRU (window_sec, at most max_entries), so memory is
+predictable. Duplicates are dropped before codec decoding, publishing and packet-loss
+counting; hits and misses are counted in the lorawan_dedup_total metric.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional, Tuple
+
+import metrics
+
+
+def _normalize_eui(eui: Any) -> str:
+    """Lowercase hex EUI without separators, so ChirpStack and Loriot spellings match."""
+    return str(eui).lower().replace("-", "").replace(":", "")
+
+
+def uplink_keys(lns: str, dev_eui: Any, fcnt: Any, message_id: Any = None) -> List[Hashable]:
+    """Dedup keys of one uplink: (lns, message_id) if given, and (devEui, fCnt) if both are known."""
+    keys: List[Hashable] = []
+    if message_id is not None:
+        keys.append(("id", lns, message_id))
+    if dev_eui and fcnt is not None:
+        try:
+            keys.append(("frame", _normalize_eui(dev_eui), int(fcnt)))
+        except (TypeError, ValueError):
+            pass
+    return keys
+
+
+class UplinkDeduplicator:
+    """Time-bounded LRU of recently seen uplink keys; see module docstring."""
+
+    def __init__(self, window_sec: float = 600.0, max_entries: int = 20000, time_tolerance_sec: float = 30.0) -> None:
+        """
+        window_sec: how long a key is remembered after it was last seen.
+        max_entries: max keys remembered; the least recently seen are dropped first.
+        time_tolerance_sec: max uplink time difference for two frames to be the same uplink.
+        """
+        self.window_sec = window_sec
+        self.max_entries = max(1, int(max_entries))
+        self._tolerance_ns = int(time_tolerance_sec * 1_000_000_000)
+        # key -> (last seen, monotonic; uplink time in ns for frame keys, else None)
+        self._entries: "OrderedDict[Hashable, Tuple[float, Optional[int]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def is_duplicate(self, lns: str, keys: List[Hashable], timestamp_ns: Optional[int]) -> bool:
+        """True if any of keys was seen within the window; the keys are remembered either way."""
+        if not keys:
+            return False
+        now = time.monotonic()
+        entries = self._entries
+        with self._lock:
+            cutoff = now - self.window_sec
+            while entries:
+                oldest = next(iter(entries.values()))
+                if oldest[0] >= cutoff:
+                    break
+                entries.popitem(last=False)
+            duplicate = False
+            for key in keys:
+                seen = entries.get(key)
+                if seen is None:
+                    continue
+                seen_ns = seen[1]
+                if seen_ns is None or timestamp_ns is None or abs(timestamp_ns - seen_ns) <= self._tolerance_ns:
+                    duplicate = True
+                    break
+            for key in keys:
+                entries[key] = (now, timestamp_ns if key[0] == "frame" else None)
+                entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            if duplicate:
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.count_dedup(lns, duplicate)
+        return duplicate
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def uplink_deduplicator(args: Any) -> Optional[UplinkDeduplicator]:
+    """The deduplicator for --dedup-window-sec, built on first use and cached on args; None if disabled."""
+    built = getattr(args, "uplink_deduplicator", None)
+    if built is None:
+        window_sec = getattr(args, "dedup_window_sec", 0)
+        if not window_sec or window_sec <= 0:
+            return None
+        built = UplinkDeduplicator(window_sec, getattr(args, "dedup_max_entries", 20000))
+        try:
+            args.uplink_deduplicator = built
+        except AttributeError:
+            pass
+    return built
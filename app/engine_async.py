@@ -0,0 +1,391 @@
+"""
+asyncio ingestion engine (--engine asyncio).
+
+The default threaded engine runs paho's loop_forever(), a pipeline worker pool, the Loriot
+watcher thread, the publisher thread and one thread per periodic task. This engine runs
+them as coroutines on one event loop instead:
+
+- MQTT: paho's socket is registered with the loop (add_reader/add_writer, loop_misc every
+  second) instead of running its own network thread. Messages are queued per device shard
+  (as in pipeline.py, so a device's messages stay in order) and handled by one coroutine
+  per shard, which runs the parse/decode/publish handler in a thread pool of --workers
+  threads (on the loop itself with --workers 0). When a shard queue is full, further
+  messages for it wait in an overflow list that one task per shard feeds into the queue as
+  it drains (backpressure block), or the oldest message is dropped (drop-oldest). Block
+  keeps reading the socket rather than removing its reader: paho reads PINGRESP only from
+  the socket, so a paused reader gets the connection closed by its keepalive check.
+- Loriot inbox: the inotify descriptor is watched by the loop (or the inbox is polled with
+  asyncio.sleep); files are parsed and published in a single-thread executor, in order.
+- Publisher: Publisher.run_async() batches and publishes on the loop.
+- Periodic tasks: PLR emission, PLR snapshots and the metrics summary log.
+
+SIGINT/SIGTERM stop the engine: MQTT is disconnected, queued messages are handled, and the
+publisher drains its queue before run() returns.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import signal
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, List, Optional, Tuple
+
+import paho.mqtt.client as mqtt
+
+import metrics
+from calc import ShardedPacketLossTracker
+from client import ChirpstackClient, publish_due_plr
+from inotify_watch import InotifyWatch, inotify_available
+from loriot_watcher import LoriotInboxWatcher, WATCH_MODE_INOTIFY, WATCH_MODE_POLL
+from pipeline import BACKPRESSURE_BLOCK, device_key_from_topic, shard_for_key
+from publisher import start_publisher
+
+ENGINE_THREADED = "threaded"
+ENGINE_ASYNCIO = "asyncio"
+ENGINES = (ENGINE_THREADED, ENGINE_ASYNCIO)
+
+# Reconnect delays, as reconnect_delay_set() in the threaded client.
+_RECONNECT_MIN_SEC = 5
+_RECONNECT_MAX_SEC = 60
+# Max seconds to wait at shutdown for queued messages and for the publisher to drain.
+_DRAIN_TIMEOUT_SEC = 10
+
+
+class AsyncioEngine:
+    """Runs MQTT ingestion, the Loriot inbox, the publisher and periodic tasks on one event loop."""
+
+    def __init__(
+        self,
+        args: Any,
+        contract: Optional[Any],
+        plr_calc: ShardedPacketLossTracker,
+        plr_state_path: str = "",
+    ) -> None:
+        self.args = args
+        self.contract = contract
+        self.plr_calc = plr_calc
+        self.plr_state_path = plr_state_path
+        self.workers = max(0, int(getattr(args, "workers", 1)))
+        shards = max(1, self.workers)
+        self.per_shard = max(1, int(getattr(args, "queue_size", 1000)) // shards)
+        self.policy = getattr(args, "backpressure", BACKPRESSURE_BLOCK)
+        self.dropped = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queues: List["asyncio.Queue[Tuple[str, bytes]]"] = []
+        # Backpressure block: messages waiting for room in their shard queue, and the task
+        # feeding them in (one per shard while its overflow is not empty).
+        self._overflow: List[Deque[Tuple[str, bytes]]] = []
+        self._feeders: List[Optional["asyncio.Task[None]"]] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._chirpstack: Optional[ChirpstackClient] = None
+        self._misc_task: Optional["asyncio.Task[None]"] = None
+        self._reconnect_task: Optional["asyncio.Task[None]"] = None
+        self._stopping: Optional[asyncio.Event] = None
+
+    def run(self) -> None:
+        """Run the engine until SIGINT/SIGTERM (blocks)."""
+        asyncio.run(self._main())
+
+    async def _main(self) -> None:
+        loop = self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self._stopping.set)
+        if self.workers:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="engine-worker")
+        args = self.args
+
+        publisher = None
+        publisher_task = None
+        if not args.dry:
+            publisher = start_publisher(args, thread=False)
+            publisher_task = loop.create_task(publisher.run_async())
+
+        background: List["asyncio.Task[None]"] = []
+        if args.signal_strength_indicators and not args.dry and args.plr_emit_interval_sec > 0:
+            background.append(loop.create_task(self._every(args.plr_emit_interval_sec, self._emit_plr)))
+        if self.plr_state_path:
+            background.append(
+                loop.create_task(self._every(args.plr_snapshot_interval_sec, self._snapshot_plr))
+            )
+        if getattr(args, "metrics_log_interval_sec", 0) > 0:
+            background.append(loop.create_task(self._metrics_summary(args.metrics_log_interval_sec)))
+        inbox_dir = (getattr(args, "loriot_inbox_dir", None) or "").strip()
+        if inbox_dir:
+            background.append(loop.create_task(self._run_loriot(inbox_dir)))
+
+        shard_tasks = self._start_shards()
+        logging.info("asyncio engine started (%d worker thread(s))", self.workers)
+        try:
+            self._connect_mqtt()
+            await self._stopping.wait()
+            logging.info("asyncio engine stopping")
+        finally:
+            await self._shutdown(background, shard_tasks, publisher, publisher_task)
+
+    async def _shutdown(
+        self,
+        background: List["asyncio.Task[None]"],
+        shard_tasks: List["asyncio.Task[None]"],
+        publisher: Any,
+        publisher_task: Optional["asyncio.Task[None]"],
+    ) -> None:
+        """Disconnect, finish queued messages, then let the publisher drain."""
+        assert self._loop is not None
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        if self._chirpstack is not None:
+            self._chirpstack.client.disconnect()
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        try:
+            await asyncio.wait_for(self._drain_shards(), _DRAIN_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            logging.warning("asyncio engine: queued MQTT messages not handled within %ss", _DRAIN_TIMEOUT_SEC)
+        for feeder in self._feeders:
+            if feeder is not None:
+                feeder.cancel()
+        for task in shard_tasks:
+            task.cancel()
+        await asyncio.gather(*shard_tasks, return_exceptions=True)
+        if publisher is not None and publisher_task is not None:
+            # stop() also joins the spool replay thread, so run it off the loop.
+            await self._loop.run_in_executor(None, publisher.stop)
+            try:
+                await asyncio.wait_for(publisher_task, _DRAIN_TIMEOUT_SEC)
+            except asyncio.TimeoutError:
+                logging.warning("asyncio engine: publisher did not drain within %ss", _DRAIN_TIMEOUT_SEC)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    # MQTT
+
+    def _connect_mqtt(self) -> None:
+        """Build the ChirpStack client, bind its socket to the loop and connect."""
+        # The engine runs handle_message on its own shard queues, so no threaded pipeline.
+        chirpstack = self._chirpstack = ChirpstackClient(self.args, self.contract, self.plr_calc, pipeline=False)
+        client = chirpstack.client
+        on_message: Callable[[mqtt.Client, Any, mqtt.MQTTMessage], None] = (
+            lambda client, userdata, message: self._submit(message.topic, message.payload)
+        )
+        if chirpstack.partition is not None:
+            on_message = chirpstack.partition_filter(on_message, *chirpstack.partition)
+        client.on_message = chirpstack.timed_on_message(on_message)
+        client.on_disconnect = self._on_disconnect
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        metrics.register_queue(
+            "pipeline", lambda: sum(q.qsize() for q in self._queues) + sum(len(o) for o in self._overflow)
+        )
+        logging.info(f"connecting [{self.args.mqtt_server_ip}:{self.args.mqtt_server_port}]...")
+        client.connect(host=self.args.mqtt_server_ip, port=self.args.mqtt_server_port, bind_address="0.0.0.0")
+
+    def _on_socket_open(self, client: mqtt.Client, userdata: Any, sock: socket.socket) -> None:
+        assert self._loop is not None
+        self._loop.add_reader(sock, client.loop_read)
+        self._misc_task = self._loop.create_task(self._misc_loop(client))
+
+    def _on_socket_close(self, client: mqtt.Client, userdata: Any, sock: socket.socket) -> None:
+        assert self._loop is not None
+        self._loop.remove_reader(sock)
+        self._loop.remove_writer(sock)
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+            self._misc_task = None
+
+    def _on_socket_register_write(self, client: mqtt.Client, userdata: Any, sock: socket.socket) -> None:
+        assert self._loop is not None
+        self._loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client: mqtt.Client, userdata: Any, sock: socket.socket) -> None:
+        assert self._loop is not None
+        self._loop.remove_writer(sock)
+
+    async def _misc_loop(self, client: mqtt.Client) -> None:
+        """Keepalive pings and timeouts (paho's loop_misc) while connected."""
+        while client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def _on_disconnect(self, client: mqtt.Client, userdata: Any, rc: int) -> None:
+        assert self._loop is not None and self._stopping is not None
+        if rc == 0 or self._stopping.is_set():
+            return
+        logging.warning("Disconnected from MQTT broker (rc %s); reconnecting", rc)
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = self._loop.create_task(self._reconnect(client))
+
+    async def _reconnect(self, client: mqtt.Client) -> None:
+        delay = _RECONNECT_MIN_SEC
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                client.reconnect()
+                return
+            except Exception as e:
+                logging.warning("MQTT reconnect failed: %s; retrying in %ss", e, delay)
+                delay = min(delay * 2, _RECONNECT_MAX_SEC)
+
+    def _start_shards(self) -> List["asyncio.Task[None]"]:
+        assert self._loop is not None
+        shards = max(1, self.workers)
+        maxsize = self.per_shard if self.policy == BACKPRESSURE_BLOCK else 0
+        self._queues = [asyncio.Queue(maxsize) for _ in range(shards)]
+        self._overflow = [deque() for _ in range(shards)]
+        self._feeders = [None] * shards
+        return [self._loop.create_task(self._run_shard(q)) for q in self._queues]
+
+    def _submit(self, topic: str, payload: bytes) -> None:
+        """Queue a message on its device's shard (called on the loop by paho's loop_read)."""
+        shard = shard_for_key(device_key_from_topic(topic), len(self._queues))
+        q = self._queues[shard]
+        if self.policy == BACKPRESSURE_BLOCK:
+            overflow = self._overflow[shard]
+            if not overflow and not q.full():
+                q.put_nowait((topic, payload))
+                return
+            overflow.append((topic, payload))
+            if len(overflow) == 1:
+                assert self._loop is not None
+                self._feeders[shard] = self._loop.create_task(self._feed_shard(q, overflow))
+            return
+        if q.qsize() >= self.per_shard:
+            q.get_nowait()
+            q.task_done()
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                logging.warning("Pipeline queue full; dropped oldest message (%d dropped so far)", self.dropped)
+        q.put_nowait((topic, payload))
+
+    async def _feed_shard(self, q: "asyncio.Queue[Tuple[str, bytes]]", overflow: Deque[Tuple[str, bytes]]) -> None:
+        """Move a shard's overflow into its queue, in order, as the queue drains."""
+        while overflow:
+            await q.put(overflow[0])
+            overflow.popleft()
+
+    async def _drain_shards(self) -> None:
+        """Wait until every overflow list is fed and every queued message handled."""
+        await asyncio.gather(*(feeder for feeder in self._feeders if feeder is not None))
+        await asyncio.gather(*(q.join() for q in self._queues))
+
+    async def _run_shard(self, q: "asyncio.Queue[Tuple[str, bytes]]") -> None:
+        """Handle one shard's messages in order, in the worker pool (or on the loop with --workers 0)."""
+        assert self._loop is not None
+        while True:
+            topic, payload = await q.get()
+            try:
+                chirpstack = self._chirpstack
+                assert chirpstack is not None
+                handler = chirpstack.handle_dry_message if self.args.dry else chirpstack.handle_message
+                if self._executor is not None:
+                    await self._loop.run_in_executor(self._executor, handler, topic, payload)
+                else:
+                    handler(topic, payload)
+            except Exception as e:
+                logging.exception("Pipeline: handler failed for topic %s: %s", topic, e)
+            finally:
+                q.task_done()
+
+    # Loriot inbox
+
+    async def _run_loriot(self, inbox_dir: str) -> None:
+        assert self._loop is not None
+        watcher = LoriotInboxWatcher(inbox_dir, self.args, self.contract, self.plr_calc)
+        # One thread, so files are handled one at a time and in order.
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="loriot-inbox")
+        use_inotify = watcher.watch_mode != WATCH_MODE_POLL and inotify_available()
+        if watcher.watch_mode == WATCH_MODE_INOTIFY and not use_inotify:
+            logging.warning("Loriot inbox: inotify is not available; falling back to polling")
+        logging.info("Loriot inbox watcher started for %s (watch mode %s)", inbox_dir, watcher.watch_mode)
+        try:
+            if use_inotify:
+                await self._loriot_inotify(watcher, executor)
+            else:
+                await self._loriot_poll(watcher, executor)
+        finally:
+            executor.shutdown(wait=True)
+            watcher.close()
+
+    async def _loriot_poll(self, watcher: LoriotInboxWatcher, executor: ThreadPoolExecutor) -> None:
+        assert self._loop is not None
+        while True:
+            try:
+                if os.path.isdir(watcher.inbox_dir):
+                    await self._loop.run_in_executor(executor, watcher.scan_inbox)
+                else:
+                    logging.debug("Loriot inbox: directory %s not present yet", watcher.inbox_dir)
+            except Exception as e:
+                logging.exception("Loriot inbox: poll error: %s", e)
+            await asyncio.sleep(watcher.poll_interval_sec)
+
+    async def _loriot_inotify(self, watcher: LoriotInboxWatcher, executor: ThreadPoolExecutor) -> None:
+        """Handle inotify events as the loop sees the descriptor become readable; re-watch if the inbox goes away."""
+        loop = self._loop
+        assert loop is not None
+        while True:
+            while not os.path.isdir(watcher.inbox_dir):
+                logging.debug("Loriot inbox: directory %s not present yet", watcher.inbox_dir)
+                await asyncio.sleep(watcher.poll_interval_sec)
+            watch = None
+            try:
+                watch = InotifyWatch(watcher.inbox_dir, watcher.watch_mask())
+                ready = asyncio.Event()
+                loop.add_reader(watch.fd, ready.set)
+                # Files written before the watch existed (e.g. during a restart).
+                await loop.run_in_executor(executor, watcher.scan_inbox)
+                gone = False
+                while not gone:
+                    try:
+                        await asyncio.wait_for(ready.wait(), watcher.idle_timeout())
+                    except asyncio.TimeoutError:
+                        await loop.run_in_executor(executor, watcher.idle)
+                        continue
+                    ready.clear()
+                    events = watch.read_events(0)
+                    if events:
+                        gone = await loop.run_in_executor(executor, watcher.handle_events, events)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.exception("Loriot inbox: watch error: %s", e)
+                await asyncio.sleep(watcher.poll_interval_sec)
+            finally:
+                if watch is not None:
+                    loop.remove_reader(watch.fd)
+                    watch.close()
+
+    # Periodic tasks
+
+    async def _every(self, interval_sec: float, task: Callable[[], Awaitable[None]]) -> None:
+        while True:
+            await asyncio.sleep(interval_sec)
+            await task()
+
+    async def _emit_plr(self) -> None:
+        assert self._loop is not None
+        try:
+            count = await self._loop.run_in_executor(None, publish_due_plr, self.plr_calc)
+            if count:
+                logging.debug("PLR: emitted %d interval(s) on timer", count)
+        except Exception as e:
+            logging.error("PLR: timer emission failed: %s", e)
+
+    async def _snapshot_plr(self) -> None:
+        assert self._loop is not None
+        try:
+            count = await self._loop.run_in_executor(None, self.plr_calc.snapshot, self.plr_state_path)
+            logging.debug("PLR state: saved %d device(s) to %s", count, self.plr_state_path)
+        except Exception as e:
+            logging.warning("PLR state: snapshot to %s failed: %s", self.plr_state_path, e)
+
+    async def _metrics_summary(self, interval_sec: float) -> None:
+        previous = None
+        while True:
+            await asyncio.sleep(interval_sec)
+            line, previous = metrics.summary(previous)
+            logging.info("Metrics: %s", line)
@@ -0,0 +1,108 @@
+"""
+Minimal Linux inotify binding (ctypes, no extra dependency).
+
+Used by the Loriot inbox watcher to react to new files instead of polling the
+directory. inotify_available() reports whether the running platform supports it.
+"""
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+from typing import List, Optional, Tuple
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+_EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+
+def _load_libc() -> Optional[ctypes.CDLL]:
+    """Load libc once; None if it has no inotify (non-Linux)."""
+    global _libc
+    if _libc is None:
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            # find_library may return None on musl (Alpine); CDLL(None) then uses the
+            # symbols already linked into the interpreter, which include libc.
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            libc.inotify_init1
+            libc.inotify_add_watch
+        except (OSError, AttributeError):
+            return None
+        _libc = libc
+    return _libc
+
+
+def inotify_available() -> bool:
+    """True if inotify can be used on this platform."""
+    return _load_libc() is not None
+
+
+class InotifyWatch:
+    """An inotify instance watching a single directory."""
+
+    def __init__(self, path: str, mask: int) -> None:
+        """Watch path for events in mask. Raises OSError if inotify or the watch cannot be set up."""
+        libc = _load_libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        wd = libc.inotify_add_watch(fd, os.fsencode(path), mask | IN_ONLYDIR)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, os.strerror(err), path)
+        self.fd = fd
+        self.path = path
+        self._poller = select.poll()
+        self._poller.register(fd, select.POLLIN)
+
+    def read_events(self, timeout: Optional[float] = None) -> List[Tuple[int, str]]:
+        """
+        Wait up to timeout seconds (None: forever) and return [(mask, name), ...].
+        Returns an empty list on timeout.
+        """
+        ready = self._poller.poll(None if timeout is None else int(timeout * 1000))
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            _wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(buf[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((mask, name))
+        return events
+
+    def close(self) -> None:
+        """Close the inotify instance (removes the watch)."""
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -0,0 +1,119 @@
+"""
+JSON decoding backends for uplink payloads.
+
+Payloads are decoded straight from the MQTT/file bytes (no intermediate str copy with
+msgspec/orjson). The backend is msgspec or orjson when installed, else the stdlib json module. With msgspec,
+ChirpStack uplinks are decoded against the ChirpstackUplink schema, so only the fields
+the plugin uses are materialized and the rest of the document is skipped.
+"""
+from __future__ import annotations
+
+import json
+import logging
+from typing import Any, Callable, Dict, Tuple, TypedDict, Union
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND_AUTO = "auto"
+BACKEND_MSGSPEC = "msgspec"
+BACKEND_ORJSON = "orjson"
+BACKEND_JSON = "json"
+BACKENDS = (BACKEND_AUTO, BACKEND_MSGSPEC, BACKEND_ORJSON, BACKEND_JSON)
+
+# Fields of a ChirpStack uplink event read by the plugin. Other fields are not decoded
+# by the msgspec backend; add a field here before reading it from the parsed uplink.
+ChirpstackUplink = TypedDict(
+    "ChirpstackUplink",
+    {
+        "time": Any,
+        "deviceInfo": Any,
+        "object": Any,
+        "data": Any,
+        "rxInfo": Any,
+        "txInfo": Any,
+        "fCnt": Any,
+        "devAddr": Any,
+        "deduplicationId": Any,
+    },
+    total=False,
+)
+
+# Exceptions raised by any backend for malformed input.
+JSON_DECODE_ERRORS: Tuple[type, ...] = (ValueError, TypeError) + (
+    (msgspec.DecodeError,) if msgspec is not None else ()
+)
+
+JsonInput = Union[bytes, bytearray, memoryview, str]
+
+
+def _json_loads(data: JsonInput) -> Any:
+    """stdlib json.loads; bytes are decoded as UTF-8 first, which is faster than letting json detect the encoding."""
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode("utf-8")
+    elif isinstance(data, memoryview):
+        data = data.tobytes().decode("utf-8")
+    return json.loads(data)
+
+
+_backend = BACKEND_JSON
+_loads: Callable[[JsonInput], Any] = _json_loads
+_loads_uplink: Callable[[JsonInput], Dict[str, Any]] = _json_loads
+
+
+def _available(name: str) -> bool:
+    if name == BACKEND_MSGSPEC:
+        return msgspec is not None
+    if name == BACKEND_ORJSON:
+        return orjson is not None
+    return name == BACKEND_JSON
+
+
+def set_json_backend(name: str = BACKEND_AUTO) -> str:
+    """
+    Select the decoding backend ("auto" picks msgspec, then orjson, then json).
+    Falls back to auto if the requested backend is not installed. Returns the backend used.
+    """
+    global _backend, _loads, _loads_uplink
+    if name != BACKEND_AUTO and not _available(name):
+        logging.warning("JSON backend %s is not installed; choosing automatically", name)
+        name = BACKEND_AUTO
+    if name == BACKEND_AUTO:
+        name = next(n for n in (BACKEND_MSGSPEC, BACKEND_ORJSON, BACKEND_JSON) if _available(n))
+    if name == BACKEND_MSGSPEC:
+        _loads = msgspec.json.Decoder().decode
+        _loads_uplink = msgspec.json.Decoder(ChirpstackUplink).decode
+    elif name == BACKEND_ORJSON:
+        _loads = orjson.loads
+        _loads_uplink = orjson.loads
+    else:
+        _loads = _json_loads
+        _loads_uplink = _json_loads
+    _backend = name
+    logging.debug("JSON backend: %s", name)
+    return name
+
+
+def get_json_backend() -> str:
+    """Name of the backend in use."""
+    return _backend
+
+
+def loads(data: JsonInput) -> Any:
+    """Decode a whole JSON document."""
+    return _loads(data)
+
+
+def loads_chirpstack_uplink(data: JsonInput) -> Dict[str, Any]:
+    """Decode a ChirpStack uplink; with msgspec, only the ChirpstackUplink fields are kept."""
+    return _loads_uplink(data)
+
+
+set_json_backend(BACKEND_AUTO)
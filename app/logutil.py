@@ -0,0 +1,128 @@
+"""
+Logging helpers for the per-message hot path.
+
+log_limited() logs a message at most once per event and key (e.g. a device) every
+--log-rate-limit-sec seconds and counts the rest; the suppressed count is reported as one
+summary line ("codec decode failed for X: 340 more time(s) in last 60s") when the window
+ends. Rate limiting is off while DEBUG logging is enabled. Lazy wraps a payload so it is
+only decoded if the record is actually emitted. configure() can also move log output to a
+background thread (QueueHandler/QueueListener) so handlers never block the MQTT thread.
+"""
+from __future__ import annotations
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Keys tracked at once; the oldest windows are summarized early when exceeded.
+_MAX_KEYS = 10000
+
+_window_sec = 60.0
+_lock = threading.Lock()
+# (event, key) -> [window start (monotonic), suppressed count, level, summary label]
+_windows: Dict[Tuple[str, Any], List[Any]] = {}
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class Lazy:
+    """Log argument that decodes bytes (UTF-8) only when the record is formatted."""
+
+    __slots__ = ("payload",)
+
+    def __init__(self, payload: Any) -> None:
+        self.payload = payload
+
+    def __str__(self) -> str:
+        payload = self.payload
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            return bytes(payload).decode("utf-8", "replace")
+        return str(payload)
+
+
+def log_limited(level: int, event: str, key: Any, msg: str, *args: Any) -> None:
+    """
+    Log msg % args at level unless (event, key) was logged within the current window;
+    repeats are counted and reported as "<event> for <key>: N more time(s) in last Ws"
+    when the window ends. key is typically a device or topic.
+    """
+    root = logging.getLogger()
+    if not root.isEnabledFor(level):
+        return
+    if _window_sec <= 0 or root.isEnabledFor(logging.DEBUG):
+        root.log(level, msg, *args)
+        return
+    now = time.monotonic()
+    window_key = (event, key)
+    expired = None
+    old: List[List[Any]] = []
+    with _lock:
+        window = _windows.get(window_key)
+        if window is not None and now - window[0] < _window_sec:
+            window[1] += 1
+            return
+        if window is not None and window[1]:
+            expired = window
+        _windows[window_key] = [now, 0, level, "%s for %s" % (event, key)]
+        if len(_windows) > _MAX_KEYS:
+            oldest = sorted(_windows, key=lambda k: _windows[k][0])[: _MAX_KEYS // 10]
+            old = [_windows.pop(k) for k in oldest if k != window_key]
+    for window in ([expired] if expired else []) + old:
+        _log_summary(window, now)
+    root.log(level, msg, *args)
+
+
+def _log_summary(window: List[Any], now: float) -> None:
+    start, suppressed, level, label = window
+    if suppressed:
+        logging.log(level, "%s: %d more time(s) in last %ds", label, suppressed, round(now - start))
+
+
+def flush_summaries() -> None:
+    """Log and reset the suppressed counts of every window that has ended."""
+    now = time.monotonic()
+    with _lock:
+        ended = [k for k, w in _windows.items() if now - w[0] >= _window_sec]
+        windows = [_windows.pop(k) for k in ended]
+    for window in windows:
+        _log_summary(window, now)
+
+
+def _summary_loop() -> None:
+    while True:
+        time.sleep(max(1.0, _window_sec / 4))
+        flush_summaries()
+
+
+def configure(rate_limit_sec: float = 60.0, async_handlers: bool = False) -> None:
+    """
+    Set the rate-limit window and start the summary thread. With async_handlers, the root
+    logger's handlers are moved behind a QueueHandler and run in a listener thread.
+    Call after logging.basicConfig().
+    """
+    global _window_sec, _listener
+    _window_sec = max(0.0, float(rate_limit_sec))
+    if _window_sec > 0:
+        threading.Thread(target=_summary_loop, daemon=True, name="log-summary").start()
+    if async_handlers and _listener is None:
+        root = logging.getLogger()
+        handlers = list(root.handlers)
+        log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+        for handler in handlers:
+            root.removeHandler(handler)
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop)
+
+
+def stop() -> None:
+    """Flush summaries and, with async handlers, write out queued records and stop the listener."""
+    global _listener
+    flush_summaries()
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
@@ -0,0 +1,194 @@
+"""
+Loriot inbox spool reader (append-only segment files).
+
+In spool mode scripts/loriot-websocket-to-files.sh appends each Loriot message as one
+JSON line to the current segment file (segment-<epoch ns>.jsonl) and starts a new segment
+when the current one is large or old enough. SpoolReader tails the segments in name
+order, keeps the consumed byte offset in a checkpoint file (written atomically) so a
+restart resumes where it stopped, and deletes a segment once it is fully consumed and a
+newer segment exists (the writer never appends to an older segment again).
+
+The checkpoint is held in memory and written at most every checkpoint_interval_sec or
+checkpoint_max_lines lines, before a consumed segment is deleted, and on close(), so
+appends do not cost a file write and fsync each. After a crash the lines read since the
+last write (up to checkpoint_max_lines) are read again and their uplinks handled twice:
+delivery is at least once. The dedup layer is in memory and starts empty after a
+restart, so it does not catch these repeats.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".jsonl"
+CHECKPOINT_NAME = ".spool-checkpoint"
+# Defaults for how often an advanced checkpoint is written (see module docstring).
+CHECKPOINT_INTERVAL_SEC = 5.0
+CHECKPOINT_MAX_LINES = 1000
+
+
+def is_segment_name(name: str) -> bool:
+    """True for spool segment file names written by the bridge script."""
+    return name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+
+
+class SpoolReader:
+    """Tails spool segments in an inbox directory with a persisted (segment, offset) checkpoint."""
+
+    def __init__(
+        self,
+        inbox_dir: str,
+        checkpoint_interval_sec: float = CHECKPOINT_INTERVAL_SEC,
+        checkpoint_max_lines: int = CHECKPOINT_MAX_LINES,
+    ) -> None:
+        self.inbox_dir = inbox_dir
+        self.checkpoint_path = os.path.join(inbox_dir, CHECKPOINT_NAME)
+        self.checkpoint_interval_sec = checkpoint_interval_sec
+        self.checkpoint_max_lines = max(1, int(checkpoint_max_lines))
+        self._checkpoint: Optional[Tuple[str, int]] = None
+        self._loaded = False
+        # Lines consumed since the checkpoint file was last written, and when that was.
+        self._unsaved_lines = 0
+        self._unsaved = False
+        self._saved_at = time.monotonic()
+        # read_pending runs in the watcher thread; flush_checkpoint may run at shutdown.
+        self._lock = threading.Lock()
+
+    def _load_checkpoint(self) -> None:
+        """Read the checkpoint file once; a missing or corrupt file means start from the oldest segment."""
+        self._loaded = True
+        try:
+            with open(self.checkpoint_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._checkpoint = (str(data["segment"]), int(data["offset"]))
+        except FileNotFoundError:
+            self._checkpoint = None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Loriot spool: ignoring unreadable checkpoint %s: %s", self.checkpoint_path, e)
+            self._checkpoint = None
+
+    def _advance(self, segment: str, offset: int, lines: int) -> None:
+        """Move the checkpoint to (segment, offset); write it if enough lines or time have passed."""
+        self._checkpoint = (segment, offset)
+        self._unsaved_lines += lines
+        self._unsaved = True
+        if self._save_due():
+            self._save_checkpoint()
+
+    def _save_due(self) -> bool:
+        return self._unsaved and (
+            self._unsaved_lines >= self.checkpoint_max_lines
+            or time.monotonic() - self._saved_at >= self.checkpoint_interval_sec
+        )
+
+    def flush_checkpoint(self) -> None:
+        """Write the checkpoint if it advanced since it was last written (e.g. at shutdown)."""
+        # Waits for a read in progress, but not indefinitely at shutdown.
+        if not self._lock.acquire(timeout=5):
+            logging.warning("Loriot spool: checkpoint busy; not written")
+            return
+        try:
+            if self._unsaved:
+                self._save_checkpoint()
+        finally:
+            self._lock.release()
+
+    def _save_checkpoint(self) -> None:
+        """Persist the checkpoint: write a temp file, fsync, then rename over the checkpoint file."""
+        if self._checkpoint is None:
+            return
+        segment, offset = self._checkpoint
+        self._unsaved = False
+        self._unsaved_lines = 0
+        self._saved_at = time.monotonic()
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"segment": segment, "offset": offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint_path)
+
+    def _segments(self) -> List[str]:
+        """Segment file names in the inbox, oldest first."""
+        with os.scandir(self.inbox_dir) as it:
+            return sorted(entry.name for entry in it if is_segment_name(entry.name) and entry.is_file())
+
+    def read_pending(
+        self,
+        handler: Callable[[bytes], None],
+        batch_handler: Optional[Callable[[List[bytes]], None]] = None,
+    ) -> int:
+        """
+        Call handler(line) for every complete line not yet consumed, advance the checkpoint
+        (written as described in the module docstring), and delete fully consumed sealed
+        segments. Returns the number of lines read. With batch_handler, the new lines of each
+        segment are passed to it in one list instead.
+        """
+        with self._lock:
+            return self._read_pending(handler, batch_handler)
+
+    def _read_pending(
+        self,
+        handler: Callable[[bytes], None],
+        batch_handler: Optional[Callable[[List[bytes]], None]],
+    ) -> int:
+        if not self._loaded:
+            self._load_checkpoint()
+        if self._save_due():
+            # Lines read by an earlier call, with nothing new since.
+            self._save_checkpoint()
+        segments = self._segments()
+        count = 0
+        for i, name in enumerate(segments):
+            sealed = i < len(segments) - 1
+            offset = 0
+            if self._checkpoint is not None:
+                cp_name, cp_offset = self._checkpoint
+                if name < cp_name:
+                    # Consumed before a crash/restart but not yet deleted.
+                    self._remove(name)
+                    continue
+                if name == cp_name:
+                    offset = cp_offset
+            path = os.path.join(self.inbox_dir, name)
+            try:
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            end = data.rfind(b"\n") + 1
+            lines = [line for line in data[:end].splitlines() if line.strip()]
+            count += len(lines)
+            if batch_handler is not None and len(lines) > 1:
+                batch_handler(lines)
+            else:
+                for line in lines:
+                    handler(line)
+            if sealed and end < len(data):
+                logging.warning("Loriot spool: dropping %d bytes of incomplete last line in %s", len(data) - end, name)
+                end = len(data)
+            if end:
+                self._advance(name, offset + end, len(lines))
+            if sealed:
+                # Persist first, so a restart does not look for the removed segment's lines again.
+                if self._unsaved:
+                    self._save_checkpoint()
+                self._remove(name)
+            else:
+                break
+        return count
+
+    def _remove(self, name: str) -> None:
+        """Delete a consumed segment."""
+        try:
+            os.remove(os.path.join(self.inbox_dir, name))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning("Loriot spool: could not remove %s: %s", name, e)
@@ -2,7 +2,13 @@
 Loriot inbox watcher.
 
 Watches a directory for new files (one Loriot JSON message per file), parses them
-with parse_loriot_payload and publishes via the shared pipeline. No direct WebSocket
+with parse_loriot_payload and publishes via the shared pipeline. On Linux the directory
+is watched with inotify (files are handled as soon as they are closed or moved in);
+elsewhere, or with --loriot-watch-mode poll, it is polled. With --loriot-inbox-format spool
+the bridge appends messages to segment files instead, which are tailed by SpoolReader
+(see loriot_spool.py). With a codec map, a backlog of files or spool lines (catch-up after a
+restart, a burst of events) is parsed in batches with parse_loriot_batch, so codecs with
+decode_batch decode many payloads per call. No direct WebSocket
 connection (plugin netpol does not allow outbound). Use scripts/loriot-websocket-to-files.sh
 on the node to connect to Loriot and write messages into this directory.
 """
@@ -12,46 +18,135 @@ import logging
 import os
 import threading
 import time
-from typing import Any, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
-from parse_loriot import parse_loriot_payload
+from parse_loriot import parse_loriot_batch, parse_loriot_payload, LORIOT_LNS
 from client import process_and_publish
-from calc import PacketLossCalculator
+from measurement_filter import measurement_filter
+from dedup import uplink_deduplicator
+import metrics
+import profiling
+import logutil
+from calc import ShardedPacketLossTracker, plr_tracker_from_args
+from loriot_spool import SpoolReader
+from inotify_watch import (
+    InotifyWatch,
+    inotify_available,
+    IN_MODIFY,
+    IN_CLOSE_WRITE,
+    IN_MOVED_TO,
+    IN_Q_OVERFLOW,
+    IN_IGNORED,
+    IN_DELETE_SELF,
+    IN_MOVE_SELF,
+)
+
+WATCH_MODE_AUTO = "auto"
+WATCH_MODE_INOTIFY = "inotify"
+WATCH_MODE_POLL = "poll"
+WATCH_MODES = (WATCH_MODE_AUTO, WATCH_MODE_INOTIFY, WATCH_MODE_POLL)
+
+INBOX_FORMAT_FILES = "files"
+INBOX_FORMAT_SPOOL = "spool"
+INBOX_FORMATS = (INBOX_FORMAT_FILES, INBOX_FORMAT_SPOOL)
+
+# Max inbox files or spool lines parsed together when a codec map is set.
+INBOX_BATCH_SIZE = 256
+
+# Events after which a watched file is complete; the bridge script closes each file once written.
+_INOTIFY_FILE_EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO
+# Events that mean the watch is gone (directory removed or moved away).
+_INOTIFY_GONE_EVENTS = IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF
 
 
 class LoriotInboxWatcher:
     """
     Watches an inbox directory for Loriot JSON message files, parses and publishes
-    each, then deletes the file. Runs the poll loop in a daemon thread.
+    each, then deletes the file. Runs the inotify or poll loop in a daemon thread.
     """
 
-    def __init__(self, inbox_dir: str, args: Any, contract: Optional[Any] = None) -> None:
+    def __init__(
+        self,
+        inbox_dir: str,
+        args: Any,
+        contract: Optional[Any] = None,
+        plr_calc: Optional[ShardedPacketLossTracker] = None,
+    ) -> None:
         self.inbox_dir = inbox_dir
         self.args = args
         self.contract = contract
-        self.plr_calc = PacketLossCalculator(args.plr)
+        self.plr_calc = plr_calc if plr_calc is not None else plr_tracker_from_args(args)
         self.poll_interval_sec = float(getattr(args, "loriot_poll_interval_sec", 1.5))
+        self.watch_mode = getattr(args, "loriot_watch_mode", WATCH_MODE_AUTO)
+        self.inbox_format = getattr(args, "loriot_inbox_format", INBOX_FORMAT_FILES)
+        self.spool = SpoolReader(inbox_dir) if self.inbox_format == INBOX_FORMAT_SPOOL else None
+        # Batches only pay off for codec fallback (Codec.decode_batch).
+        self.batch_size = INBOX_BATCH_SIZE if contract is not None and getattr(contract, "codec_map", None) else 1
 
-    def _process_file(self, path: str) -> bool:
-        """Read file, parse as Loriot JSON, publish if valid. Returns True if caller should delete the file."""
+    def _read_file(self, path: str) -> Tuple[Optional[bytes], bool]:
+        """(contents, False), or (None, True if the caller should delete the file) if it cannot be read."""
+        t0 = metrics.start()
         try:
-            with open(path, "r", encoding="utf-8") as f:
+            with open(path, "rb") as f:
                 body = f.read()
+        except FileNotFoundError:
+            # Already handled (e.g. seen by both the catch-up scan and an inotify event).
+            return None, False
         except OSError as e:
             logging.warning("Loriot inbox: could not read %s: %s", path, e)
-            return True
+            return None, True
+        metrics.observe_stage(metrics.STAGE_LORIOT_READ, t0)
+        return body, False
+
+    @profiling.profiled
+    def _process_file(self, path: str) -> bool:
+        """Read file, parse as Loriot JSON, publish if valid. Returns True if caller should delete the file."""
+        body, remove = self._read_file(path)
+        if body is None:
+            return remove
+        return self._process_body(body, path)
+
+    @profiling.profiled
+    def _process_spool_line(self, line: bytes) -> None:
+        """Parse and publish one spool segment line (spool mode). Failures are logged and skipped."""
+        self._process_body(line, "spool")
+
+    @profiling.profiled
+    def _process_spool_lines(self, lines: List[bytes]) -> None:
+        """Parse and publish the new lines of a spool segment in batches (spool mode)."""
+        for start in range(0, len(lines), self.batch_size):
+            for parsed in parse_loriot_batch(lines[start:start + self.batch_size], codec_contract=self.contract):
+                self._publish_parsed(parsed, "spool")
+
+    def _process_body(self, body: bytes, source: str) -> bool:
+        """Parse a Loriot JSON message from source (file path or spool), publish if valid. Returns False on publish failure."""
         try:
             parsed = parse_loriot_payload(
                 body,
                 codec_contract=self.contract,
             )
         except Exception as e:
-            logging.warning("Loriot inbox: parse failed for %s: %s", path, e)
+            logutil.log_limited(logging.WARNING, "Loriot parse failed", source, "Loriot inbox: parse failed for %s: %s", source, e)
             return True
+        return self._publish_parsed(parsed, source)
+
+    def _publish_parsed(self, parsed: Optional[Dict[str, Any]], source: str) -> bool:
+        """Publish a parsed Loriot message from source unless it is empty or a duplicate. Returns False on publish failure."""
         if parsed is None:
-            logging.debug("Loriot inbox: no measurements in %s; skipping", path)
+            logging.debug("Loriot inbox: no measurements in %s; skipping", source)
             return True
-        logging.info("Loriot inbox message received: %s", path)
+        dedup = uplink_deduplicator(self.args)
+        if dedup is not None and dedup.is_duplicate(LORIOT_LNS, parsed["dedup_keys"], parsed["timestamp_ns"]):
+            logging.debug("Loriot inbox: duplicate uplink in %s dropped", source)
+            return True
+        logutil.log_limited(
+            logging.INFO,
+            "Loriot message received",
+            parsed["measurement_metadata"]["devEui"],
+            "Loriot inbox message received: %s",
+            source,
+        )
+        metrics.count_message(parsed["measurement_metadata"]["lns"], parsed["measurement_metadata"]["devEui"])
         if getattr(self.args, "dry", False):
             self._log_measurements(parsed["measurements"])
             return True
@@ -66,43 +161,178 @@ class LoriotInboxWatcher:
                 self.plr_calc,
             )
         except Exception as e:
-            logging.exception("Loriot inbox: publish failed for %s: %s", path, e)
+            logging.exception("Loriot inbox: publish failed for %s: %s", source, e)
             return False
         return True
 
     def _log_measurements(self, measurements: list) -> None:
         """Log measurement names and values (respecting --ignore and --collect). Used when --dry."""
+        allows = measurement_filter(self.args).allows
         for m in measurements:
-            if m["name"] in self.args.ignore:
-                continue
-            if self.args.collect and m["name"] not in self.args.collect:
+            if not allows(m["name"]):
                 continue
             logging.info("%s: %s", m["name"], m["value"])
 
-    def _run_loop(self) -> None:
+    def _remove(self, path: str) -> None:
+        """Delete a handled inbox file."""
+        t0 = metrics.start()
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.warning("Loriot inbox: could not remove %s: %s", path, e)
+        metrics.observe_stage(metrics.STAGE_LORIOT_REMOVE, t0)
+
+    def _handle_path(self, path: str) -> None:
+        """Process one inbox file and delete it when done."""
+        if self._process_file(path):
+            self._remove(path)
+
+    @profiling.profiled
+    def _handle_batch(self, paths: List[str]) -> None:
+        """Read, parse (with parse_loriot_batch) and publish inbox files, deleting each when done."""
+        bodies = []
+        read = []
+        for path in paths:
+            body, remove = self._read_file(path)
+            if body is not None:
+                bodies.append(body)
+                read.append(path)
+            elif remove:
+                self._remove(path)
+        for path, parsed in zip(read, parse_loriot_batch(bodies, codec_contract=self.contract)):
+            if self._publish_parsed(parsed, path):
+                self._remove(path)
+
+    def _handle_paths(self, paths: List[str]) -> None:
+        """Process inbox files in order; more than one are handled in batches of batch_size."""
+        if self.batch_size <= 1 or len(paths) <= 1:
+            for path in paths:
+                self._handle_path(path)
+            return
+        for start in range(0, len(paths), self.batch_size):
+            self._handle_batch(paths[start:start + self.batch_size])
+
+    def scan_inbox(self) -> None:
+        """Process every file (or, in spool mode, every new spool line) currently in the inbox, oldest first."""
+        if self.spool is not None:
+            self.spool.read_pending(
+                self._process_spool_line,
+                self._process_spool_lines if self.batch_size > 1 else None,
+            )
+            return
+        with os.scandir(self.inbox_dir) as it:
+            # is_file() uses the directory entry type, so no extra stat per file.
+            names = sorted(
+                entry.name
+                for entry in it
+                if not entry.name.startswith(".") and entry.is_file()
+            )
+        self._handle_paths([os.path.join(self.inbox_dir, name) for name in names])
+
+    def _wait_for_inbox(self) -> None:
+        """Sleep until the inbox directory exists."""
+        while not os.path.isdir(self.inbox_dir):
+            logging.debug("Loriot inbox: directory %s not present yet", self.inbox_dir)
+            time.sleep(self.poll_interval_sec)
+
+    def _run_poll_loop(self) -> None:
         """Poll inbox directory for files, process and delete. Runs until thread is stopped."""
         while True:
             try:
                 if not os.path.isdir(self.inbox_dir):
                     logging.debug("Loriot inbox: directory %s not present yet", self.inbox_dir)
-                    time.sleep(self.poll_interval_sec)
-                    continue
-                names = os.listdir(self.inbox_dir)
-                for name in names:
-                    if name.startswith("."):
-                        continue
-                    path = os.path.join(self.inbox_dir, name)
-                    if not os.path.isfile(path):
-                        continue
-                    if self._process_file(path):
-                        try:
-                            os.remove(path)
-                        except OSError as e:
-                            logging.warning("Loriot inbox: could not remove %s: %s", path, e)
+                else:
+                    self.scan_inbox()
             except Exception as e:
                 logging.exception("Loriot inbox: poll error: %s", e)
             time.sleep(self.poll_interval_sec)
 
+    def _run_inotify_loop(self) -> None:
+        """
+        Watch the inbox with inotify and process files as they are completed. Does a
+        catch-up scan whenever the watch is (re)established or the event queue overflows.
+        """
+        while True:
+            watch = None
+            try:
+                self._wait_for_inbox()
+                watch = InotifyWatch(self.inbox_dir, self.watch_mask())
+                # Files written before the watch existed (e.g. during a restart).
+                self.scan_inbox()
+                gone = False
+                while not gone:
+                    events = watch.read_events(self.idle_timeout())
+                    if events:
+                        gone = self.handle_events(events)
+                    else:
+                        self.idle()
+            except Exception as e:
+                logging.exception("Loriot inbox: watch error: %s", e)
+                time.sleep(self.poll_interval_sec)
+            finally:
+                if watch is not None:
+                    watch.close()
+
+    def watch_mask(self) -> int:
+        """inotify events to watch the inbox for."""
+        # The bridge keeps the current spool segment open, so appends only show up as IN_MODIFY.
+        return _INOTIFY_FILE_EVENTS | (IN_MODIFY if self.spool is not None else 0)
+
+    def idle_timeout(self) -> Optional[float]:
+        """Seconds to wait for inotify events before calling idle() (None: wait forever)."""
+        return self.spool.checkpoint_interval_sec if self.spool is not None else None
+
+    def idle(self) -> None:
+        """No inotify events for idle_timeout(): write the spool checkpoint if it advanced."""
+        if self.spool is not None:
+            self.spool.flush_checkpoint()
+
+    def close(self) -> None:
+        """Persist state at shutdown (the spool checkpoint)."""
+        if self.spool is not None:
+            self.spool.flush_checkpoint()
+
+    def handle_events(self, events: List[Tuple[int, str]]) -> bool:
+        """Handle one batch of inotify events. Returns True if the inbox directory went away."""
+        if self.spool is not None:
+            # Our own checkpoint writes (.spool-checkpoint.tmp) and other dot-files are not segments.
+            events = [(m, name) for m, name in events if not name.startswith(".")]
+            # Segments are read from the checkpoint on, so one pass covers a burst of events.
+            if any(m & _INOTIFY_GONE_EVENTS for m, _ in events):
+                logging.warning("Loriot inbox: directory %s went away; waiting for it", self.inbox_dir)
+                return True
+            if events:
+                self.scan_inbox()
+            return False
+        # Files completed in one burst are handled together, in event order.
+        paths: List[str] = []
+        for mask, name in events:
+            if mask & _INOTIFY_GONE_EVENTS:
+                self._handle_paths(paths)
+                logging.warning("Loriot inbox: directory %s went away; waiting for it", self.inbox_dir)
+                return True
+            if mask & IN_Q_OVERFLOW:
+                self._handle_paths(paths)
+                paths = []
+                logging.warning("Loriot inbox: inotify queue overflowed; rescanning %s", self.inbox_dir)
+                self.scan_inbox()
+                continue
+            if not name or name.startswith("."):
+                continue
+            paths.append(os.path.join(self.inbox_dir, name))
+        self._handle_paths(paths)
+        return False
+
+    def _run_loop(self) -> None:
+        """Run the inotify loop when requested/available, else the poll loop."""
+        use_inotify = self.watch_mode != WATCH_MODE_POLL and inotify_available()
+        if self.watch_mode == WATCH_MODE_INOTIFY and not use_inotify:
+            logging.warning("Loriot inbox: inotify is not available; falling back to polling")
+        if use_inotify:
+            self._run_inotify_loop()
+        else:
+            self._run_poll_loop()
+
     def start_daemon(self) -> None:
         """Start the inbox watcher in a daemon thread. Returns immediately."""
         thread = threading.Thread(
@@ -111,20 +341,24 @@ class LoriotInboxWatcher:
             name="loriot-inbox",
         )
         thread.start()
-        logging.info("Loriot inbox watcher started for %s", self.inbox_dir)
+        logging.info("Loriot inbox watcher started for %s (watch mode %s)", self.inbox_dir, self.watch_mode)
 
 
 def start_loriot_inbox_daemon(
-    args: Any, contract: Optional[Any] = None
-) -> None:
+    args: Any,
+    contract: Optional[Any] = None,
+    plr_calc: Optional[ShardedPacketLossTracker] = None,
+) -> Optional[LoriotInboxWatcher]:
     """
-    Start the Loriot inbox watcher in a daemon thread.
+    Start the Loriot inbox watcher in a daemon thread and return it (call close() at shutdown).
 
-    Call when --loriot-inbox-dir is set. Polls the directory for new files,
+    Call when --loriot-inbox-dir is set. Watches the directory for new files,
     parses each as Loriot JSON, publishes via the shared pipeline, then deletes the file.
+    plr_calc is the packet loss tracker shared with the ChirpStack client.
     """
     inbox_dir = (getattr(args, "loriot_inbox_dir", None) or "").strip()
     if not inbox_dir:
-        return
-    watcher = LoriotInboxWatcher(inbox_dir, args, contract)
+        return None
+    watcher = LoriotInboxWatcher(inbox_dir, args, contract, plr_calc)
     watcher.start_daemon()
+    return watcher
@@ -2,26 +2,57 @@
 LoRaWAN Listener plugin entry point.
 
 Parses CLI and env, configures logging, loads and warms the codec contract (if configured),
-then starts the Loriot inbox watcher (if --loriot-inbox-dir is set) and the ChirpStack MQTT client.
+then starts the publisher (unless --dry), the Loriot inbox watcher (if --loriot-inbox-dir is set)
+and the ChirpStack MQTT client, each on its own thread or, with --engine asyncio, on one event
+loop (see engine_async.py).
 """
 import logging
 import argparse
 import os
 from codec_loader import Contract
-from client import ChirpstackClient
-from loriot_watcher import start_loriot_inbox_daemon
+from codec_pool import codec_pool_from_args, CODEC_ISOLATIONS, CODEC_ISOLATION_INLINE
+from calc import start_snapshot_daemon, plr_tracker_from_args
+from client import ChirpstackClient, start_plr_emitter, parse_partition
+from loriot_watcher import start_loriot_inbox_daemon, WATCH_MODES, INBOX_FORMATS
+from publisher import start_publisher, stop_publisher
+from pipeline import BACKPRESSURE_POLICIES
+from measurement_filter import MeasurementFilter
+from dedup import uplink_deduplicator
+from engine_async import AsyncioEngine, ENGINES, ENGINE_ASYNCIO, ENGINE_THREADED
+import metrics
+import profiling
+import logutil
+from json_decode import set_json_backend, BACKENDS as JSON_BACKENDS
 
 
 def main() -> None:
     """Parse arguments, set up logging and codec contract, then run ChirpStack (and optionally Loriot) clients."""
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", action="store_true", help="enable debug logs")
+    parser.add_argument(
+        "--log-rate-limit-sec",
+        default=float(os.getenv("LOG_RATE_LIMIT_SEC", "60")),
+        type=float,
+        help="per-message log lines are logged at most once per device/topic and event in this many seconds, with a count of the rest; 0 logs every line, --debug disables the limit (default: LOG_RATE_LIMIT_SEC or 60)",
+    )
+    parser.add_argument(
+        "--log-async",
+        action="store_true",
+        default=os.getenv("LOG_ASYNC", "").lower() in ("1", "true", "yes"),
+        help="write log records from a background thread so logging never blocks message handling",
+    )
     parser.add_argument(
         "--dry",
         action="store_true",
         default=False,
         help="enable dry-run mode where no messages will be broadcast to Beehive",
     )
+    parser.add_argument(
+        "--engine",
+        default=os.getenv("ENGINE", ENGINE_THREADED),
+        choices=ENGINES,
+        help="threaded: paho network thread, worker threads and one thread per background task; asyncio: MQTT, Loriot inbox, publisher and periodic tasks on one event loop (default: ENGINE or threaded)",
+    )
     parser.add_argument(
         "--mqtt-server-ip",
         default=os.getenv("MQTT_SERVER_HOST", "wes-rabbitmq"),
@@ -38,19 +69,55 @@ def main() -> None:
         default=os.getenv("MQTT_SUBSCRIBE_TOPIC", "application/#"),
         help="MQTT subscribe topic",
     )
+    parser.add_argument(
+        "--mqtt-shared-group",
+        default=os.getenv("MQTT_SHARED_GROUP", ""),
+        help="join this MQTT shared subscription group ($share/<group>/<topic>) so several plugin processes split the messages; needs a broker with shared subscriptions (default: MQTT_SHARED_GROUP or none)",
+    )
+    parser.add_argument(
+        "--mqtt-partition",
+        default=os.getenv("MQTT_PARTITION", ""),
+        type=parse_partition,
+        metavar="i/N",
+        help="handle only devices whose devEui hashes to partition i of N, so N plugin processes split the devices; works with any broker (default: MQTT_PARTITION or all devices)",
+    )
+    parser.add_argument(
+        "--workers",
+        default=int(os.getenv("MQTT_WORKERS", "1")),
+        type=int,
+        help="worker threads that parse/decode/publish MQTT messages; 0 handles them on the MQTT network thread (default: MQTT_WORKERS or 1)",
+    )
+    parser.add_argument(
+        "--queue-size",
+        default=int(os.getenv("MQTT_QUEUE_SIZE", "1000")),
+        type=int,
+        help="max MQTT messages waiting for a worker (default: MQTT_QUEUE_SIZE or 1000)",
+    )
+    parser.add_argument(
+        "--backpressure",
+        default=os.getenv("MQTT_BACKPRESSURE", "block"),
+        choices=BACKPRESSURE_POLICIES,
+        help="what to do when the worker queue is full: block the MQTT thread or drop the oldest queued message (default: MQTT_BACKPRESSURE or block)",
+    )
+    parser.add_argument(
+        "--json-backend",
+        default=os.getenv("JSON_BACKEND", "auto"),
+        choices=JSON_BACKENDS,
+        help="JSON decoder for uplinks: msgspec, orjson, json, or auto (first installed in that order) (default: JSON_BACKEND or auto)",
+    )
     parser.add_argument(
         "--collect",
         nargs="*",  # 0 or more values expected => creates a list
         type=str,
         default=[],  # default if nothing is provided
-        help="A list of chirpstack measurements to retrieve. If empty all will be retrieved (ex: --collect m1 m2 m3)"
+        help="A list of measurements to retrieve, by name, glob (temp_*, must match the whole name) or re:<regex> (matches anywhere in the name). If empty all will be retrieved (ex: --collect m1 m2 m3)"
     )
     parser.add_argument(
         "--ignore",
         nargs="*",  # 0 or more values expected => creates a list
         type=str,
         default=[],  # default if nothing is provided
-        help="A list of chirpstack measurements to ignore (opposite of --collect). If empty all will be retrieved (ex: --ignore m1 m2 m3)"
+        help="A list of measurements to ignore (opposite of --collect), by name, glob (must match the whole name) or re:<regex> (matches anywhere in the name). If empty all will be retrieved (ex: --ignore m1 m2 m3)"
     )
     parser.add_argument(
         "--signal-strength-indicators",
@@ -64,6 +131,41 @@ def main() -> None:
         help="plr's(packet loss rate) time interval in seconds, for example 3600 will mean plr will be measured every hour",
         type=int
     )
+    parser.add_argument(
+        "--plr-max-devices",
+        default=int(os.getenv("PLR_MAX_DEVICES", "10000")),
+        type=int,
+        help="max devices tracked for packet loss; the least recently seen device is dropped when full, 0 for no limit (default: PLR_MAX_DEVICES or 10000)",
+    )
+    parser.add_argument(
+        "--plr-shards",
+        default=int(os.getenv("PLR_SHARDS", "16")),
+        type=int,
+        help="number of independently locked shards of packet loss state, so concurrent workers rarely wait on each other (default: PLR_SHARDS or 16)",
+    )
+    parser.add_argument(
+        "--plr-idle-ttl-sec",
+        default=float(os.getenv("PLR_IDLE_TTL_SEC", "86400")),
+        type=float,
+        help="drop packet loss state of devices not heard for this many seconds, 0 to keep forever (default: PLR_IDLE_TTL_SEC or 86400)",
+    )
+    parser.add_argument(
+        "--plr-state-path",
+        default=os.getenv("PLR_STATE_PATH", ""),
+        help="file to save packet loss state to periodically and restore it from at start, so restarts keep PLR baselines; empty disables (default: PLR_STATE_PATH)",
+    )
+    parser.add_argument(
+        "--plr-snapshot-interval-sec",
+        default=float(os.getenv("PLR_SNAPSHOT_INTERVAL_SEC", "300")),
+        type=float,
+        help="seconds between packet loss state snapshots (default: PLR_SNAPSHOT_INTERVAL_SEC or 300)",
+    )
+    parser.add_argument(
+        "--plr-emit-interval-sec",
+        default=float(os.getenv("PLR_EMIT_INTERVAL_SEC", "60")),
+        type=float,
+        help="seconds between checks that publish signal.plr for devices whose plr interval elapsed, even if they went silent; 0 publishes plr only when a packet arrives (default: PLR_EMIT_INTERVAL_SEC or 60)",
+    )
     parser.add_argument(
         "--loriot-inbox-dir",
         default=os.getenv("LORIOT_INBOX_DIR", ""),
@@ -75,6 +177,71 @@ def main() -> None:
         type=float,
         help="seconds between Loriot inbox directory polls (default: LORIOT_POLL_INTERVAL_SEC or 1.5)",
     )
+    parser.add_argument(
+        "--loriot-watch-mode",
+        default=os.getenv("LORIOT_WATCH_MODE", "auto"),
+        choices=WATCH_MODES,
+        help="how to detect new Loriot inbox files: inotify, poll, or auto (inotify when available, else poll) (default: LORIOT_WATCH_MODE or auto)",
+    )
+    parser.add_argument(
+        "--loriot-inbox-format",
+        default=os.getenv("LORIOT_INBOX_FORMAT", "files"),
+        choices=INBOX_FORMATS,
+        help="Loriot inbox layout written by the bridge script: files (one JSON file per message) or spool (JSON lines appended to rotating segment files) (default: LORIOT_INBOX_FORMAT or files)",
+    )
+    parser.add_argument(
+        "--dedup-window-sec",
+        default=float(os.getenv("DEDUP_WINDOW_SEC", "600")),
+        type=float,
+        help="seconds an uplink is remembered to drop duplicates (MQTT redeliveries, Loriot duplicates, the same uplink via ChirpStack and Loriot); 0 disables deduplication (default: DEDUP_WINDOW_SEC or 600)",
+    )
+    parser.add_argument(
+        "--dedup-max-entries",
+        default=int(os.getenv("DEDUP_MAX_ENTRIES", "20000")),
+        type=int,
+        help="max uplink keys remembered for deduplication; bounds its memory (default: DEDUP_MAX_ENTRIES or 20000)",
+    )
+    parser.add_argument(
+        "--publish-batch-size",
+        default=int(os.getenv("PUBLISH_BATCH_SIZE", "100")),
+        type=int,
+        help="max measurements published per batch through the plugin session (default: PUBLISH_BATCH_SIZE or 100)",
+    )
+    parser.add_argument(
+        "--publish-max-latency-sec",
+        default=float(os.getenv("PUBLISH_MAX_LATENCY_SEC", "0.5")),
+        type=float,
+        help="max seconds a measurement waits before its batch is published (default: PUBLISH_MAX_LATENCY_SEC or 0.5)",
+    )
+    parser.add_argument(
+        "--publish-queue-size",
+        default=int(os.getenv("PUBLISH_QUEUE_SIZE", "10000")),
+        type=int,
+        help="max measurements buffered for publishing; new measurements are dropped when full (default: PUBLISH_QUEUE_SIZE or 10000)",
+    )
+    parser.add_argument(
+        "--publish-spool-dir",
+        default=os.getenv("PUBLISH_SPOOL_DIR", ""),
+        help="directory where measurements that cannot be sent to Beehive or overflow the publish queue are stored and replayed from; empty disables the spool (default: PUBLISH_SPOOL_DIR or disabled)",
+    )
+    parser.add_argument(
+        "--publish-spool-max-mb",
+        default=float(os.getenv("PUBLISH_SPOOL_MAX_MB", "64")),
+        type=float,
+        help="max size of the publish spool in MB (compressed); the oldest measurements are dropped beyond it (default: PUBLISH_SPOOL_MAX_MB or 64)",
+    )
+    parser.add_argument(
+        "--publish-spool-replay-rate",
+        default=float(os.getenv("PUBLISH_SPOOL_REPLAY_RATE", "100")),
+        type=float,
+        help="max spooled measurements replayed per second once publishing works again; 0 is unlimited (default: PUBLISH_SPOOL_REPLAY_RATE or 100)",
+    )
+    parser.add_argument(
+        "--publish-spool-backlog",
+        default=int(os.getenv("PUBLISH_SPOOL_BACKLOG", "1000")),
+        type=int,
+        help="messages waiting to be sent to Beehive at which new measurements are spooled instead of published (default: PUBLISH_SPOOL_BACKLOG or 1000)",
+    )
     default_cache = os.path.expanduser(
         os.getenv("LORAWAN_CODEC_CACHE", "~/.cache/lorawan-listener-codecs")
     )
@@ -91,26 +258,182 @@ def main() -> None:
         default=default_cache,
         help="directory to clone GitHub codec repos into (default: LORAWAN_CODEC_CACHE or ~/.cache/lorawan-listener-codecs)",
     )
+    parser.add_argument(
+        "--codec-pull-ttl-sec",
+        default=float(os.getenv("LORAWAN_CODEC_PULL_TTL_SEC", "0")),
+        type=float,
+        help="skip git pull for cached codec repos synced less than this many seconds ago; 0 always pulls at start (default: LORAWAN_CODEC_PULL_TTL_SEC or 0)",
+    )
+    parser.add_argument(
+        "--codec-warmup-workers",
+        default=int(os.getenv("LORAWAN_CODEC_WARMUP_WORKERS", "4")),
+        type=int,
+        help="max codec repos cloned/pulled concurrently at start (default: LORAWAN_CODEC_WARMUP_WORKERS or 4)",
+    )
+    parser.add_argument(
+        "--codec-lazy-warmup",
+        action="store_true",
+        default=os.getenv("LORAWAN_CODEC_LAZY_WARMUP", "").lower() in ("1", "true", "yes"),
+        help="warm codecs in the background and start the clients immediately; codecs not yet loaded are loaded on first use",
+    )
+    parser.add_argument(
+        "--codec-isolation",
+        default=os.getenv("LORAWAN_CODEC_ISOLATION", CODEC_ISOLATION_INLINE),
+        choices=CODEC_ISOLATIONS,
+        help="inline: run codecs in the message threads; process: run codecs in worker processes with a timeout per call (default: LORAWAN_CODEC_ISOLATION or inline)",
+    )
+    parser.add_argument(
+        "--codec-workers",
+        default=int(os.getenv("LORAWAN_CODEC_WORKERS", "2")),
+        type=int,
+        help="codec worker processes with --codec-isolation process (default: LORAWAN_CODEC_WORKERS or 2)",
+    )
+    parser.add_argument(
+        "--codec-timeout-sec",
+        default=float(os.getenv("LORAWAN_CODEC_TIMEOUT_SEC", "5")),
+        type=float,
+        help="max seconds per codec call with --codec-isolation process; the worker is killed and replaced when exceeded (default: LORAWAN_CODEC_TIMEOUT_SEC or 5)",
+    )
+    parser.add_argument(
+        "--codec-failure-threshold",
+        default=int(os.getenv("LORAWAN_CODEC_FAILURE_THRESHOLD", "5")),
+        type=int,
+        help="with --codec-isolation process, a codec that times out or crashes this many times in a row is skipped for --codec-cooldown-sec; 0 never skips (default: LORAWAN_CODEC_FAILURE_THRESHOLD or 5)",
+    )
+    parser.add_argument(
+        "--codec-cooldown-sec",
+        default=float(os.getenv("LORAWAN_CODEC_COOLDOWN_SEC", "60")),
+        type=float,
+        help="seconds a failing codec is skipped before it is tried again (default: LORAWAN_CODEC_COOLDOWN_SEC or 60)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=os.getenv("LORAWAN_PROFILE", "").lower() in ("1", "true", "yes"),
+        help="profile the plugin for --profile-duration-sec at start; a profile can also be started any time with SIGUSR1",
+    )
+    parser.add_argument(
+        "--profile-mode",
+        default=os.getenv("PROFILE_MODE", profiling.PROFILE_MODE_SAMPLING),
+        choices=profiling.PROFILE_MODES,
+        help="sampling: stack samples of all threads (collapsed stacks); cprofile: cProfile of message handling and codec decoding (pstats) (default: PROFILE_MODE or sampling)",
+    )
+    parser.add_argument(
+        "--profile-duration-sec",
+        default=float(os.getenv("PROFILE_DURATION_SEC", "60")),
+        type=float,
+        help="length of a profile in seconds (default: PROFILE_DURATION_SEC or 60)",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=os.getenv("PROFILE_DIR", "/tmp/lorawan-listener-profile"),
+        help="directory profiles and per-codec timings are written to (default: PROFILE_DIR or /tmp/lorawan-listener-profile)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        default=int(os.getenv("METRICS_PORT", "0")),
+        type=int,
+        help="serve Prometheus metrics on http://<metrics-bind>:<port>/metrics; 0 disables (default: METRICS_PORT or 0)",
+    )
+    parser.add_argument(
+        "--metrics-bind",
+        default=os.getenv("METRICS_BIND", "127.0.0.1"),
+        help="address the metrics endpoint listens on (default: METRICS_BIND or 127.0.0.1)",
+    )
+    parser.add_argument(
+        "--metrics-log-interval-sec",
+        default=float(os.getenv("METRICS_LOG_INTERVAL_SEC", "0")),
+        type=float,
+        help="log a metrics summary line every this many seconds; 0 disables (default: METRICS_LOG_INTERVAL_SEC or 0)",
+    )
 
     args = parser.parse_args()
+    if args.mqtt_shared_group and args.mqtt_partition:
+        parser.error("--mqtt-shared-group and --mqtt-partition cannot be combined")
 
     logging.basicConfig(
         level=logging.DEBUG if args.debug else logging.INFO,
         format="%(asctime)s %(message)s",
         datefmt="%Y/%m/%d %H:%M:%S",
     )
+    logutil.configure(args.log_rate_limit_sec, args.log_async)
+    if args.mqtt_shared_group and args.signal_strength_indicators:
+        logging.warning(
+            "MQTT shared group: uplinks of a device are spread over the group, so each process "
+            "computes packet loss from a subset of them; use --mqtt-partition for accurate signal.pl/plr"
+        )
+
+    set_json_backend(args.json_backend)
+    # Metrics are only recorded when exposed or logged
+    if args.metrics_port > 0 or args.metrics_log_interval_sec > 0:
+        metrics.enable()
+        if args.metrics_port > 0:
+            metrics.serve(args.metrics_port, args.metrics_bind)
+        if args.metrics_log_interval_sec > 0 and args.engine == ENGINE_THREADED:
+            metrics.start_summary_log(args.metrics_log_interval_sec)
+
+    # Profiling: on demand with SIGUSR1, or right away with --profile
+    profiling.configure(args.profile_dir, args.profile_mode, args.profile_duration_sec)
+    profiling.install_signal_handler()
+    if args.profile:
+        profiling.start_profiling()
 
-    # Load codec map and warm codec cache before clients start to avoid races.
+    # Compile --collect/--ignore once; shared by ChirpStack, Loriot and dry-run paths
+    args.measurement_filter = MeasurementFilter(args.collect, args.ignore)
+    uplink_deduplicator(args)
+
+    # Load codec map and warm codec cache before clients start (or in the background with --codec-lazy-warmup).
     codec_map = Contract.load_codec_map(args.codec_map)
-    codec_contract = Contract(codec_map, args.codec_cache_dir) if codec_map and args.codec_cache_dir else None
+    codec_contract = (
+        Contract(
+            codec_map,
+            args.codec_cache_dir,
+            pull_ttl_sec=args.codec_pull_ttl_sec,
+            warmup_workers=args.codec_warmup_workers,
+            pool=codec_pool_from_args(args),
+        )
+        if codec_map and args.codec_cache_dir
+        else None
+    )
     if codec_contract:
-        codec_contract.warm_codec_cache()
+        if args.codec_lazy_warmup:
+            codec_contract.start_warmup_daemon()
+        else:
+            codec_contract.warm_codec_cache()
 
-    if getattr(args, "loriot_inbox_dir", "").strip():
-        start_loriot_inbox_daemon(args, codec_contract)
+    # One packet loss tracker shared by ChirpStack and Loriot, keyed on (lns, devEui)
+    plr_calc = plr_tracker_from_args(args)
+    plr_state_path = args.plr_state_path.strip()
+    if plr_state_path:
+        restored = plr_calc.restore(plr_state_path)
+        logging.info("PLR state: restored %d device(s) from %s", restored, plr_state_path)
 
-    mqtt_client = ChirpstackClient(args, codec_contract)
-    mqtt_client.run()
+    loriot_watcher = None
+    try:
+        if args.engine == ENGINE_ASYNCIO:
+            AsyncioEngine(args, codec_contract, plr_calc, plr_state_path).run()
+        else:
+            if not args.dry:
+                start_publisher(args)
+            if plr_state_path:
+                start_snapshot_daemon(plr_calc, plr_state_path, args.plr_snapshot_interval_sec)
+            if args.signal_strength_indicators and not args.dry and args.plr_emit_interval_sec > 0:
+                start_plr_emitter(plr_calc, args.plr_emit_interval_sec)
+            if getattr(args, "loriot_inbox_dir", "").strip():
+                loriot_watcher = start_loriot_inbox_daemon(args, codec_contract, plr_calc)
+            ChirpstackClient(args, codec_contract, plr_calc).run()
+    finally:
+        if loriot_watcher is not None:
+            loriot_watcher.close()
+        if plr_state_path:
+            try:
+                plr_calc.snapshot(plr_state_path)
+            except OSError as e:
+                logging.warning("PLR state: final snapshot to %s failed: %s", plr_state_path, e)
+        stop_publisher()
+        if codec_contract and codec_contract.pool is not None:
+            codec_contract.pool.stop()
+        logutil.stop()
 
 if __name__ == "__main__":
     try:
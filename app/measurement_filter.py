@@ -0,0 +1,94 @@
+"""
+Precompiled --collect/--ignore measurement filter.
+
+Built once from the argument lists and shared by the ChirpStack, Loriot and dry-run
+paths. Plain entries are compared by cleaned name (see parse.clean_string), so a raw
+name such as "Air Temperature" and its published form "air_temperature" both match.
+Entries with glob characters (*, ?, [) are shell-style patterns that must match the
+whole name; entries starting with "re:" are regular expressions that may match anywhere
+in it (anchor them with ^ and $ as needed). The decision for each name is memoized.
+"""
+from __future__ import annotations
+
+import fnmatch
+import re
+from typing import Any, Dict, Iterable, List, Optional, Pattern, Tuple
+
+from parse import clean_string
+
+REGEX_PREFIX = "re:"
+_GLOB_CHARS = frozenset("*?[")
+# Decisions are memoized per raw name; the cap (cleared when reached) bounds memory.
+_MEMO_MAX = 4096
+
+
+_Compiled = Tuple[frozenset, Optional[Pattern[str]], Optional[Pattern[str]]]
+
+
+def _compile(entries: Iterable[str]) -> _Compiled:
+    """
+    (cleaned plain names, one combined pattern for the globs or None, one for the regexes
+    or None). Glob translations end in \\Z, so the glob pattern is used with match().
+    """
+    names = set()
+    globs: List[str] = []
+    regexes: List[str] = []
+    for entry in entries:
+        if entry.startswith(REGEX_PREFIX):
+            regexes.append("(?:%s)" % entry[len(REGEX_PREFIX):])
+        elif _GLOB_CHARS.intersection(entry):
+            globs.append("(?:%s)" % fnmatch.translate(entry.lower()))
+        else:
+            names.add(clean_string(entry))
+    return (
+        frozenset(names),
+        re.compile("|".join(globs)) if globs else None,
+        re.compile("|".join(regexes)) if regexes else None,
+    )
+
+
+class MeasurementFilter:
+    """Decides whether a measurement is published, from --collect and --ignore."""
+
+    def __init__(self, collect: Iterable[str] = (), ignore: Iterable[str] = ()) -> None:
+        """collect: names/patterns to publish (empty: all). ignore: names/patterns never published."""
+        self._collect = _compile(collect or ())
+        self._ignore = _compile(ignore or ())
+        self._collect_all = not self._collect[0] and self._collect[1] is None and self._collect[2] is None
+        self._memo: Dict[str, bool] = {}
+
+    @staticmethod
+    def _matches(raw: str, cleaned: str, compiled: _Compiled) -> bool:
+        names, glob, regex = compiled
+        if cleaned in names:
+            return True
+        if glob is not None and (glob.match(raw) is not None or glob.match(cleaned) is not None):
+            return True
+        return regex is not None and (regex.search(raw) is not None or regex.search(cleaned) is not None)
+
+    def allows(self, name: Any) -> bool:
+        """True if the measurement named name should be published."""
+        allowed = self._memo.get(name)
+        if allowed is not None:
+            return allowed
+        raw = str(name)
+        cleaned = clean_string(raw)
+        allowed = not self._matches(raw, cleaned, self._ignore) and (
+            self._collect_all or self._matches(raw, cleaned, self._collect)
+        )
+        if len(self._memo) >= _MEMO_MAX:
+            self._memo.clear()
+        self._memo[name] = allowed
+        return allowed
+
+
+def measurement_filter(args: Any) -> MeasurementFilter:
+    """The filter for args.collect/args.ignore, built on first use and cached on args."""
+    built = getattr(args, "measurement_filter", None)
+    if built is None:
+        built = MeasurementFilter(args.collect, args.ignore)
+        try:
+            args.measurement_filter = built
+        except AttributeError:
+            pass
+    return built
@@ -0,0 +1,293 @@
+"""
+Internal metrics: counters, latency histograms and gauges, in Prometheus text format.
+
+Disabled by default. Instrumented code calls start() at the beginning of a stage and
+observe_stage(stage, t0) at the end; while disabled start() returns 0.0 and every
+record function returns at once, so the cost is a function call per site. enable()
+(from --metrics-port / --metrics-log-interval-sec) turns recording on; serve() exposes
+GET /metrics over HTTP and start_summary_log() logs a summary line periodically.
+"""
+from __future__ import annotations
+
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Stage names used by the instrumented code.
+STAGE_MQTT_RECEIVE = "mqtt_receive"
+STAGE_JSON_PARSE = "json_parse"
+STAGE_CODEC_RESOLVE = "codec_resolve"
+STAGE_CODEC_DECODE = "codec_decode"
+STAGE_METADATA = "metadata"
+STAGE_PUBLISH = "publish"
+STAGE_LORIOT_READ = "loriot_read"
+STAGE_LORIOT_REMOVE = "loriot_remove"
+
+# Latency buckets in seconds (upper bounds; +Inf is implied).
+_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Per-device series beyond this many devices are counted under devEui="other".
+MAX_DEVICE_SERIES = 1000
+
+LabelValues = Tuple[str, ...]
+
+enabled = False
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: LabelValues = (), amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def series(self) -> Dict[LabelValues, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> List[str]:
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        for labels, value in sorted(self.series().items()):
+            lines.append("%s%s %s" % (self.name, _format_labels(self.labelnames, labels), value))
+        return lines
+
+
+class Histogram:
+    """Latency histogram (seconds) with optional labels."""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        # labels -> [bucket counts..., +Inf count, sum]
+        self._values: Dict[LabelValues, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: LabelValues, seconds: float, count: int = 1) -> None:
+        """Record count observations of seconds each."""
+        index = bisect.bisect_left(_BUCKETS, seconds)
+        with self._lock:
+            row = self._values.get(labels)
+            if row is None:
+                row = self._values[labels] = [0] * (len(_BUCKETS) + 2)
+            row[index] += count
+            row[-1] += seconds * count
+
+    def series(self) -> Dict[LabelValues, Tuple[int, float]]:
+        """labels -> (count, sum)."""
+        with self._lock:
+            return {labels: (int(sum(row[:-1])), row[-1]) for labels, row in self._values.items()}
+
+    def render(self) -> List[str]:
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            rows = sorted((labels, list(row)) for labels, row in self._values.items())
+        for labels, row in rows:
+            cumulative = 0
+            for bound, count in zip(_BUCKETS + (float("inf"),), row[:-1]):
+                cumulative += count
+                le = 'le="%s"' % ("+Inf" if bound == float("inf") else repr(bound))
+                lines.append("%s_bucket%s %d" % (self.name, _format_labels(self.labelnames, labels, le), cumulative))
+            lines.append("%s_sum%s %r" % (self.name, _format_labels(self.labelnames, labels), row[-1]))
+            lines.append("%s_count%s %d" % (self.name, _format_labels(self.labelnames, labels), cumulative))
+        return lines
+
+
+class Gauge:
+    """Gauge whose labelled values are read from callbacks when rendered (e.g. queue depths)."""
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._callbacks: Dict[LabelValues, Callable[[], float]] = {}
+
+    def set_function(self, labels: LabelValues, fn: Callable[[], float]) -> None:
+        self._callbacks[labels] = fn
+
+    def series(self) -> Dict[LabelValues, float]:
+        values = {}
+        for labels, fn in list(self._callbacks.items()):
+            try:
+                values[labels] = fn()
+            except Exception:
+                continue
+        return values
+
+    def render(self) -> List[str]:
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s gauge" % self.name]
+        for labels, value in sorted(self.series().items()):
+            lines.append("%s%s %s" % (self.name, _format_labels(self.labelnames, labels), value))
+        return lines
+
+
+STAGE_SECONDS = Histogram("lorawan_stage_seconds", "Time spent per processing stage", ("stage",))
+CODEC_SECONDS = Histogram("lorawan_codec_seconds", "Codec.decode time per codec", ("codec",))
+MESSAGES = Counter("lorawan_messages_total", "Uplinks received", ("lns",))
+DEVICE_MESSAGES = Counter("lorawan_device_messages_total", "Uplinks received per device", ("lns", "devEui"))
+CODEC_FAILURES = Counter("lorawan_codec_failures_total", "Codec fallback failures", ("codec", "reason"))
+PUBLISHED = Counter("lorawan_measurements_published_total", "Measurements handed to the Waggle plugin")
+PUBLISH_ERRORS = Counter("lorawan_publish_errors_total", "Measurements that failed or were dropped", ("reason",))
+DEDUP = Counter("lorawan_dedup_total", "Uplinks checked for duplicates, by result (hit: dropped as duplicate)", ("lns", "result"))
+SPOOL = Counter("lorawan_spool_measurements_total", "Measurements written to or replayed from the publish spool", ("op",))
+QUEUE_DEPTH = Gauge("lorawan_queue_depth", "Items waiting in internal queues", ("queue",))
+
+_METRICS = (STAGE_SECONDS, CODEC_SECONDS, MESSAGES, DEVICE_MESSAGES, CODEC_FAILURES, PUBLISHED, PUBLISH_ERRORS, DEDUP, SPOOL, QUEUE_DEPTH)
+_devices_seen: Dict[LabelValues, None] = {}
+
+
+def enable() -> None:
+    """Start recording metrics."""
+    global enabled
+    enabled = True
+
+
+def start() -> float:
+    """Start time of a stage for observe_stage (0.0 when disabled)."""
+    return time.perf_counter() if enabled else 0.0
+
+
+def observe_stage(stage: str, t0: float) -> None:
+    """Record the time since t0 = start() for stage."""
+    if t0:
+        STAGE_SECONDS.observe((stage,), time.perf_counter() - t0)
+
+
+def observe_codec(codec: str, t0: float, count: int = 1) -> None:
+    """Record the time since t0 (a perf_counter value) for count decodes by codec (one batch), split evenly."""
+    if enabled and t0 and count > 0:
+        CODEC_SECONDS.observe((codec,), (time.perf_counter() - t0) / count, count)
+
+
+def count_message(lns: str, deveui: Any) -> None:
+    """Count one uplink for lns and for the device (first MAX_DEVICE_SERIES devices by name)."""
+    if not enabled:
+        return
+    MESSAGES.inc((lns,))
+    key = (lns, str(deveui))
+    if key not in _devices_seen:
+        if len(_devices_seen) >= MAX_DEVICE_SERIES:
+            key = (lns, "other")
+        else:
+            _devices_seen[key] = None
+    DEVICE_MESSAGES.inc(key)
+
+
+def count_codec_failure(codec: str, reason: str) -> None:
+    if enabled:
+        CODEC_FAILURES.inc((codec, reason))
+
+
+def count_published(amount: int = 1) -> None:
+    if enabled:
+        PUBLISHED.inc((), amount)
+
+
+def count_publish_error(reason: str) -> None:
+    if enabled:
+        PUBLISH_ERRORS.inc((reason,))
+
+
+def count_dedup(lns: str, duplicate: bool) -> None:
+    if enabled:
+        DEDUP.inc((lns, "hit" if duplicate else "miss"))
+
+
+def count_spool(op: str, amount: int = 1) -> None:
+    """Count measurements written to ("write") or replayed from ("replay") the publish spool."""
+    if enabled:
+        SPOOL.inc((op,), amount)
+
+
+def register_queue(name: str, depth: Callable[[], float]) -> None:
+    """Report depth() as lorawan_queue_depth{queue=name}."""
+    QUEUE_DEPTH.set_function((name,), depth)
+
+
+def render() -> str:
+    """All metrics in Prometheus text exposition format."""
+    lines: List[str] = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logging.debug("metrics: " + format, *args)
+
+
+def serve(port: int, bind: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve GET /metrics on bind:port from a daemon thread. Returns the server."""
+    server = ThreadingHTTPServer((bind, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-http").start()
+    logging.info("Metrics endpoint on http://%s:%d/metrics", bind, server.server_address[1])
+    return server
+
+
+def summary(previous: Optional[Dict[str, Any]] = None) -> Tuple[str, Dict[str, Any]]:
+    """A one-line summary of the interval since previous, and the totals to pass next time."""
+    previous = previous or {}
+    totals: Dict[str, Any] = {
+        "messages": sum(MESSAGES.series().values()),
+        "published": sum(PUBLISHED.series().values()),
+        "errors": sum(PUBLISH_ERRORS.series().values()),
+        "codec_failures": sum(CODEC_FAILURES.series().values()),
+        "duplicates": sum(v for (_, result), v in DEDUP.series().items() if result == "hit"),
+        "stages": STAGE_SECONDS.series(),
+    }
+    parts = [
+        "%s=%d" % (key, totals[key] - previous.get(key, 0))
+        for key in ("messages", "published", "errors", "codec_failures", "duplicates")
+    ]
+    previous_stages = previous.get("stages", {})
+    for (stage,), (count, total) in sorted(totals["stages"].items()):
+        prev_count, prev_total = previous_stages.get((stage,), (0, 0.0))
+        if count > prev_count:
+            parts.append("%s=%.3fms" % (stage, (total - prev_total) / (count - prev_count) * 1000))
+    for (queue,), depth in sorted(QUEUE_DEPTH.series().items()):
+        parts.append("queue_%s=%d" % (queue, depth))
+    return " ".join(parts), totals
+
+
+def start_summary_log(interval_sec: float) -> threading.Thread:
+    """Log a metrics summary (counts and mean stage times over the interval) every interval_sec seconds."""
+
+    def run() -> None:
+        previous: Optional[Dict[str, Any]] = None
+        while True:
+            time.sleep(interval_sec)
+            line, previous = summary(previous)
+            logging.info("Metrics: %s", line)
+
+    thread = threading.Thread(target=run, daemon=True, name="metrics-summary")
+    thread.start()
+    return thread
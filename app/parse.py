@@ -1,42 +1,72 @@
 """
 ChirpStack MQTT payload parsing and metadata helpers.
 
-Parses JSON payloads, extracts device/metadata, normalizes measurement names (clean_string),
-and converts timestamps. Used by the ChirpStack client and the shared publish pipeline.
+Parses JSON payloads (see json_decode.py), extracts device/metadata (cached per device), normalizes measurement names (clean_string),
+and converts timestamps (fast RFC 3339 path, dateutil fallback). Used by the ChirpStack
+client and the shared publish pipeline.
 """
 from __future__ import annotations
 
-import json
+import calendar
 import logging
 import re
-from typing import Any, Dict, List, Optional
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional, Tuple, Union
 
 from dateutil import parser
 
-def parse_message_payload(payload_data: str) -> Dict[str, Any]:
-    """Parse ChirpStack MQTT message payload JSON into a dict."""
-    tmp_dict = json.loads(payload_data)
-    return tmp_dict
-
-def Get_Measurement_metadata(message_dict: Dict[str, Any]) -> Dict[str, Any]:
-    tmp_dict = {}
+from json_decode import loads_chirpstack_uplink
 
-    #Get static metadata
-    tmp_dict['devAddr'] = message_dict.get('devAddr', None)
-    tmp_dict['lns'] = 'local_chirpstack'
+def parse_message_payload(payload_data: Union[bytes, str]) -> Dict[str, Any]:
+    """Parse ChirpStack MQTT message payload JSON (bytes or str) into a dict of the fields the plugin uses."""
+    tmp_dict = loads_chirpstack_uplink(payload_data)
+    return tmp_dict
 
-    #get values from nested dictionary
-    deviceInfo_dict = message_dict.get('deviceInfo', None)
+# deviceInfo fields copied into measurement metadata, in published order.
+_DEVICE_INFO_KEYS = (
+    'tenantId',
+    'tenantName',
+    'applicationId',
+    'applicationName',
+    'deviceProfileId',
+    'deviceProfileName',
+    'deviceName',
+    'devEui',
+)
+
+class _DeviceMetadata:
+    """Cached metadata of one device, valid while its deviceInfo is unchanged."""
+
+    __slots__ = ("device_info", "base", "signal", "overlay")
+
+    def __init__(self, device_info: Dict[str, Any], base: Dict[str, Any], signal: Mapping[str, Any]) -> None:
+        self.device_info = device_info  # fingerprint: the deviceInfo these were built from
+        self.base = base  # measurement metadata without devAddr
+        self.signal = signal
+        self.overlay: Optional[Tuple[Any, Mapping[str, Any]]] = None  # (devAddr, measurement metadata)
+
+# devEui -> _DeviceMetadata. Cleared when full so foreign devices cannot grow it without bound.
+_device_metadata_cache: Dict[Any, _DeviceMetadata] = {}
+_DEVICE_METADATA_CACHE_MAX = 10000
+
+def _build_device_metadata(deviceInfo_dict: Dict[str, Any]) -> _DeviceMetadata:
+    """Build the per-device parts of measurement and signal metadata from deviceInfo."""
+    base = {'lns': 'local_chirpstack'}
+    signal = {}
+
+    #get values from nested dictionary; signal metadata does not depend on the other keys
     try:
-        tmp_dict['tenantId'] = deviceInfo_dict['tenantId']
-        tmp_dict['tenantName'] = deviceInfo_dict['tenantName']
-        tmp_dict['applicationId'] = deviceInfo_dict['applicationId']
-        tmp_dict['applicationName'] = deviceInfo_dict['applicationName']
-        tmp_dict['deviceProfileId'] = deviceInfo_dict['deviceProfileId']
-        tmp_dict['deviceProfileName'] = deviceInfo_dict['deviceProfileName']
-        tmp_dict['deviceName'] = deviceInfo_dict['deviceName']
-        tmp_dict['devEui'] = deviceInfo_dict['devEui']
-    except:
+        signal['deviceName'] = deviceInfo_dict['deviceName']
+        signal['devEui'] = deviceInfo_dict['devEui']
+        signal['lns'] = 'local_chirpstack'
+    except KeyError:
+        logging.error("deviceInfo was not found")
+    try:
+        for key in _DEVICE_INFO_KEYS:
+            base[key] = deviceInfo_dict[key]
+    except KeyError:
         logging.error("deviceInfo was not found")
 
     #get tags
@@ -44,13 +74,46 @@ def Get_Measurement_metadata(message_dict: Dict[str, Any]) -> Dict[str, Any]:
     try:
         for key, value in tags_dict.items():
             key = clean_string(key)
-            tmp_dict[key + "_tag"] = value
+            base[key + "_tag"] = value
+            signal[key + "_tag"] = value
     except:
         pass
 
     #NOTE: NEVER get device variables, they hold sensitive data that should not be exposed.
 
-    return tmp_dict
+    return _DeviceMetadata(deviceInfo_dict, base, MappingProxyType(signal))
+
+def Get_Metadata(message_dict: Dict[str, Any]) -> Tuple[Mapping[str, Any], Mapping[str, Any]]:
+    """
+    Return (measurement metadata, signal metadata) for a ChirpStack uplink.
+
+    Both are read-only mappings shared between uplinks of the same device: they are built
+    once per devEui and rebuilt only when its deviceInfo changes (or, for measurement
+    metadata, when devAddr changes). Copy them before modifying. Raises if deviceInfo is missing.
+    """
+    deviceInfo_dict = message_dict.get('deviceInfo', None)
+    if not isinstance(deviceInfo_dict, dict):
+        logging.error("deviceInfo was not found")
+        raise KeyError('deviceInfo')
+
+    dev_eui = deviceInfo_dict.get('devEui')
+    entry = _device_metadata_cache.get(dev_eui)
+    if entry is None or entry.device_info != deviceInfo_dict:
+        entry = _build_device_metadata(deviceInfo_dict)
+        if len(_device_metadata_cache) >= _DEVICE_METADATA_CACHE_MAX:
+            _device_metadata_cache.clear()
+        _device_metadata_cache[dev_eui] = entry
+
+    dev_addr = message_dict.get('devAddr', None)
+    overlay = entry.overlay
+    if overlay is None or overlay[0] != dev_addr:
+        overlay = (dev_addr, MappingProxyType({'devAddr': dev_addr, **entry.base}))
+        entry.overlay = overlay
+    return overlay[1], entry.signal
+
+def Get_Measurement_metadata(message_dict: Dict[str, Any]) -> Mapping[str, Any]:
+    """Get measurement metadata (devAddr, lns, deviceInfo fields, tags) from message_dict. See Get_Metadata."""
+    return Get_Metadata(message_dict)[0]
 
 def clean_message_measurement(measurement: Dict[str, Any]) -> Dict[str, Any]:
     """Normalize measurement name with clean_string (lowercase, alphanumeric + underscore)."""
@@ -58,18 +121,38 @@ def clean_message_measurement(measurement: Dict[str, Any]) -> Dict[str, Any]:
     measurement["name"] = clean_string(measurement["name"])
     return measurement
 
+# Characters allowed in cleaned names; everything else becomes '_'.
+_CLEAN_PATTERN = re.compile(r'[^a-z0-9_]')
+# str.translate table for the ASCII fast path (applied after lower()).
+_ASCII_CLEAN_TABLE = {
+    c: '_' for c in range(128) if not (chr(c).isdigit() or 'a' <= chr(c) <= 'z' or chr(c) == '_')
+}
+# Memo of raw name -> cleaned name. Deployments use a few dozen distinct names; the cap
+# (cleared when reached) and the length limit keep unexpected or hostile names from growing it.
+_clean_cache: Dict[str, str] = {}
+_CLEAN_CACHE_MAX = 4096
+_CLEAN_CACHE_MAX_LEN = 256
+
 def clean_string(txt: str) -> str:
     """Lowercase and replace non-alphanumeric/underscore with underscore (for measurement names)."""
-    #convert capital letters to lowercase
-    txt = txt.lower()
+    cleaned = _clean_cache.get(txt)
+    if cleaned is not None:
+        return cleaned
 
-    #pattern excepted 
-    pattern = r'[^a-z0-9_]'
+    #convert capital letters to lowercase
+    lowered = txt.lower()
 
     #replace not excepted values with '_' in txt
-    txt = re.sub(pattern, '_', txt)
+    if lowered.isascii():
+        cleaned = lowered.translate(_ASCII_CLEAN_TABLE)
+    else:
+        cleaned = _CLEAN_PATTERN.sub('_', lowered)
 
-    return txt
+    if len(txt) <= _CLEAN_CACHE_MAX_LEN:
+        if len(_clean_cache) >= _CLEAN_CACHE_MAX:
+            _clean_cache.clear()
+        _clean_cache[txt] = cleaned
+    return cleaned
 
 def Get_Signal_Performance_values(message_dict: Dict[str, Any]) -> Dict[str, Any]:
     """Get Lorawan Performance values from message_dict."""
@@ -105,42 +188,60 @@ def Get_Signal_Performance_values(message_dict: Dict[str, Any]) -> Dict[str, Any
     return tmp_dict
 
 
-def Get_Signal_Performance_metadata(message_dict: Dict[str, Any]) -> Dict[str, Any]:
-    """Get Lorawan Performance metadata from message_dict."""
-    tmp_dict = {}
+def Get_Signal_Performance_metadata(message_dict: Dict[str, Any]) -> Mapping[str, Any]:
+    """Get Lorawan Performance metadata from message_dict. See Get_Metadata."""
+    return Get_Metadata(message_dict)[1]
 
-    #get values from nested dictionary
-    deviceInfo_dict = message_dict.get('deviceInfo', None)
-    try:
-        tmp_dict['deviceName'] = deviceInfo_dict['deviceName']
-        tmp_dict['devEui'] = deviceInfo_dict['devEui']
-        tmp_dict['lns'] = 'local_chirpstack'
-    except:
-        logging.error("deviceInfo was not found")
 
-    #get tags
-    tags_dict = deviceInfo_dict.get('tags', None)
-    try:
-        for key, value in tags_dict.items():
-            key = clean_string(key)
-            tmp_dict[key + "_tag"] = value
-    except:
-        pass
+# ChirpStack time, e.g. 2024-12-03T15:48:41.591164273+00:00: second-resolution prefix,
+# optional 1-9 digit fraction, then Z or a +HH:MM/-HH:MM offset.
+_RFC3339_RE = re.compile(
+    r"(\d{4}-\d{2}-\d{2}[Tt ]\d{2}:\d{2}:\d{2})(?:\.(\d{1,9}))?([Zz]|[+-]\d{2}:\d{2})"
+)
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
-    #NOTE: NEVER get device variables, they hold sensitive data that should not be exposed.
 
-    return tmp_dict
+@lru_cache(maxsize=256)
+def _epoch_seconds(prefix: str, offset: str) -> int:
+    """Whole seconds since epoch for a 'YYYY-MM-DDTHH:MM:SS' prefix and Z/+HH:MM offset. Raises ValueError."""
+    seconds = calendar.timegm(
+        datetime(
+            int(prefix[0:4]), int(prefix[5:7]), int(prefix[8:10]),
+            int(prefix[11:13]), int(prefix[14:16]), int(prefix[17:19]),
+        ).timetuple()
+    )
+    if offset not in ("Z", "z"):
+        minutes = int(offset[1:3]) * 60 + int(offset[4:6])
+        seconds -= minutes * 60 if offset[0] == "+" else -minutes * 60
+    return seconds
+
+
+def _convert_time_fallback(iso_time: Any) -> int:
+    """Parse any ISO 8601 form dateutil accepts. Raises ValueError/TypeError/OverflowError."""
+    datetime_obj = parser.isoparse(iso_time)
+    if datetime_obj.tzinfo is None:
+        # Naive times are local time, as datetime.timestamp() assumes.
+        return int(datetime_obj.timestamp() * 1e9)
+    return (datetime_obj - _EPOCH) // timedelta(microseconds=1) * 1000
 
 
 def convert_time(iso_time: Any) -> Optional[int]:
-    """Parse ISO timestamp string to nanoseconds since epoch. Returns None on parse failure."""
+    """
+    Parse ISO timestamp string to nanoseconds since epoch. Returns None on parse failure.
+
+    RFC 3339 times as sent by ChirpStack are parsed directly into exact integer nanoseconds
+    (the seconds part is cached, so uplinks within the same second skip the calendar math);
+    other formats fall back to dateutil.
+    """
     try:
-        datetime_obj = parser.isoparse(iso_time)
-    except ValueError as e:
+        m = _RFC3339_RE.fullmatch(iso_time) if isinstance(iso_time, str) else None
+        if m is not None:
+            prefix, fraction, offset = m.groups()
+            nanoseconds = _epoch_seconds(prefix, offset) * 1_000_000_000
+            if fraction:
+                nanoseconds += int(fraction.ljust(9, "0"))
+            return nanoseconds
+        return _convert_time_fallback(iso_time)
+    except (ValueError, TypeError, OverflowError) as e:
         logging.error(f"Error: {e}")
-    else:
-        # Convert the datetime object to nanoseconds since the epoch
-        total_seconds = datetime_obj.timestamp()
-        nanoseconds = int(total_seconds * 1e9)
-
-    return nanoseconds
+        return None
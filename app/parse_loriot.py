@@ -4,19 +4,63 @@ Loriot uplink parser.
 Parses Loriot uplink JSON (e.g. from file or WebSocket). Expects decoded payload in
 'decoded.data' or legacy 'object'; if missing, can use codec_contract to decode raw
 payload. Sets measurement_metadata.lns to "loriot" (Loriot is decoupled from the
-listener; messages may come from files). Returns a normalized dict for the shared
+listener; messages may come from files). Signal values (rssi, snr, fcnt, dr) are taken
+from the uplink in the same layout as ChirpStack's. Returns a normalized dict for the shared
 publish pipeline or None if the message cannot be parsed.
 """
 from __future__ import annotations
 
-import json
 import logging
-from typing import Any, Dict, Optional, Union
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
+from json_decode import loads, JSON_DECODE_ERRORS
 from parse import clean_string
+from dedup import uplink_keys
+import logutil
+import metrics
 
 LORIOT_LNS = "loriot"
 
+
+def _spreading_factor(dr: Any) -> Optional[int]:
+    """Spreading factor from a Loriot data rate string such as "SF7 BW125 4/5"."""
+    if not isinstance(dr, str) or not dr.startswith("SF"):
+        return None
+    sf = dr[2:].split(" ", 1)[0]
+    return int(sf) if sf.isdigit() else None
+
+
+def _loriot_signal(data: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    (signal_values, signal_metadata) in the ChirpStack layout from a Loriot uplink:
+    spreading factor from dr, fCnt from fcnt, and one rxInfo entry per gateway in gws
+    (or the top-level rssi/snr). (None, None) if the uplink has no EUI or no radio info.
+    """
+    eui = data.get("EUI")
+    gws = data.get("gws")
+    if gws and isinstance(gws, list):
+        rx_info = [
+            {"gatewayId": gw.get("gweui"), "rssi": gw.get("rssi"), "snr": gw.get("snr")}
+            for gw in gws
+            if isinstance(gw, dict)
+        ]
+    elif data.get("rssi") is not None or data.get("snr") is not None:
+        rx_info = [{"gatewayId": data.get("gweui"), "rssi": data.get("rssi"), "snr": data.get("snr")}]
+    else:
+        rx_info = []
+    if not eui or not rx_info:
+        return None, None
+
+    signal_values = {
+        "spreadingfactor": _spreading_factor(data.get("dr")),
+        "fCnt": data.get("fcnt"),
+        "rxInfo": rx_info,
+    }
+    signal_metadata = {"devEui": str(eui), "lns": LORIOT_LNS}
+    if data.get("name"):
+        signal_metadata["deviceName"] = str(data["name"])
+    return signal_values, signal_metadata
+
 def _loriot_ts_to_ns(ts_ms: Optional[Any]) -> Optional[int]:
     """Convert Loriot millisecond timestamp to nanoseconds since epoch."""
     if ts_ms is None:
@@ -27,46 +71,32 @@ def _loriot_ts_to_ns(ts_ms: Optional[Any]) -> Optional[int]:
         return None
 
 
-def parse_loriot_payload(
-    body: Union[str, Dict[str, Any]],
-    codec_contract: Optional[Any] = None,
-) -> Optional[Dict[str, Any]]:
-    """
-    Parse Loriot uplink JSON into a normalized payload for the shared pipeline.
-
-    Expects decoded payload in 'decoded.data' or 'object'; if missing, uses
-    codec_contract.decode_with_codec when provided. Returns a dict with keys:
-    measurements, timestamp_ns, measurement_metadata, signal_values, signal_metadata,
-    or None if the message cannot be decoded.
-    """
-    try:
-        data = json.loads(body) if isinstance(body, str) else body
-    except (json.JSONDecodeError, TypeError) as e:
-        logging.warning("Loriot: invalid JSON: %s", e)
-        return None
-
+def _decoded_measurements(data: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """Measurements from 'decoded.data' or 'object', or None if the uplink has neither."""
     decoded = data.get("decoded", {}) or {}
     payload = decoded.get("data") or data.get("object")
-    measurements = None
-
-    if payload and isinstance(payload, dict):
-        measurements = []
-        for key, value in payload.items():
-            if value is None:
-                continue
-            name = clean_string(str(key))
-            measurements.append({"name": name, "value": value})
-        if not measurements:
-            measurements = None
+    if not payload or not isinstance(payload, dict):
+        return None
+    measurements = []
+    for key, value in payload.items():
+        if value is None:
+            continue
+        name = clean_string(str(key))
+        measurements.append({"name": name, "value": value})
+    return measurements or None
+
+
+def _codec_request(data: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    """(device name, hex payload) for codec fallback, or None if the uplink lacks either."""
+    raw_data = data.get("data")
+    device_name = data.get("name")
+    if raw_data is not None and device_name:
+        return device_name, raw_data
+    return None
 
-    if measurements is None and codec_contract:
-        raw_data = data.get("data")
-        device_name = data.get("name")
-        if raw_data is not None and device_name:
-            measurements = codec_contract.decode_with_codec(
-                device_name, raw_data, encoding="hex"
-            )
 
+def _normalized(data: Dict[str, Any], measurements: Optional[List[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    """The normalized payload (see parse_loriot_payload) of an uplink and its measurements."""
     if not measurements:
         logging.debug("Loriot: no decoded.data/object and codec fallback did not yield measurements; skipping")
         return None
@@ -87,10 +117,7 @@ def parse_loriot_payload(
         "devAddr": devaddr,
     }
 
-    # Do not publish signal measurements for Loriot (rssi, snr, pl, plr, etc.)
-    #TODO: This will be done in a later version of the plugin.
-    signal_values = None
-    signal_metadata = None
+    signal_values, signal_metadata = _loriot_signal(data)
 
     return {
         "measurements": measurements,
@@ -98,4 +125,85 @@ def parse_loriot_payload(
         "measurement_metadata": measurement_metadata,
         "signal_values": signal_values,
         "signal_metadata": signal_metadata,
+        "dedup_keys": uplink_keys(
+            LORIOT_LNS,
+            eui,
+            data.get("fcnt"),
+            (eui, data.get("seqno"), data.get("fcnt")) if data.get("seqno") is not None else None,
+        ),
     }
+
+
+def _loads(body: Union[bytes, str, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Decode a Loriot JSON body (dicts are passed through); None if it is not valid JSON."""
+    t0 = metrics.start()
+    try:
+        data = loads(body) if isinstance(body, (bytes, str)) else body
+    except JSON_DECODE_ERRORS as e:
+        logutil.log_limited(logging.WARNING, "Loriot invalid JSON", "loriot", "Loriot: invalid JSON: %s", e)
+        return None
+    metrics.observe_stage(metrics.STAGE_JSON_PARSE, t0)
+    return data
+
+
+def parse_loriot_payload(
+    body: Union[bytes, str, Dict[str, Any]],
+    codec_contract: Optional[Any] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Parse Loriot uplink JSON into a normalized payload for the shared pipeline.
+
+    Expects decoded payload in 'decoded.data' or 'object'; if missing, uses
+    codec_contract.decode_with_codec when provided. Returns a dict with keys:
+    measurements, timestamp_ns, measurement_metadata, signal_values, signal_metadata,
+    dedup_keys (see dedup.uplink_keys), or None if the message cannot be decoded.
+    """
+    data = _loads(body)
+    if data is None:
+        return None
+    measurements = _decoded_measurements(data)
+    if measurements is None and codec_contract:
+        request = _codec_request(data)
+        if request is not None:
+            measurements = codec_contract.decode_with_codec(request[0], request[1], encoding="hex")
+    return _normalized(data, measurements)
+
+
+def parse_loriot_batch(
+    bodies: Sequence[Union[bytes, str, Dict[str, Any]]],
+    codec_contract: Optional[Any] = None,
+) -> List[Optional[Dict[str, Any]]]:
+    """
+    parse_loriot_payload for a backlog of uplinks (e.g. inbox catch-up). Uplinks that need
+    codec fallback are decoded together with codec_contract.decode_many, so a codec with
+    decode_batch is called once for its devices' payloads. Returns one result per body;
+    a body that cannot be parsed gives None (and is logged) without affecting the others.
+    """
+    datas: List[Optional[Dict[str, Any]]] = []
+    measurements: List[Optional[List[Dict[str, Any]]]] = []
+    pending: List[int] = []
+    requests: List[Tuple[str, str]] = []
+    for body in bodies:
+        try:
+            data = _loads(body)
+            found = _decoded_measurements(data) if data is not None else None
+            request = _codec_request(data) if data is not None and found is None and codec_contract else None
+        except Exception as e:
+            logutil.log_limited(logging.WARNING, "Loriot parse failed", "loriot", "Loriot: parse failed: %s", e)
+            data, found, request = None, None, None
+        if request is not None:
+            pending.append(len(datas))
+            requests.append(request)
+        datas.append(data)
+        measurements.append(found)
+    if requests:
+        for i, decoded in zip(pending, codec_contract.decode_many(requests, encoding="hex")):
+            measurements[i] = decoded
+    results: List[Optional[Dict[str, Any]]] = []
+    for data, found in zip(datas, measurements):
+        try:
+            results.append(_normalized(data, found) if data is not None else None)
+        except Exception as e:
+            logutil.log_limited(logging.WARNING, "Loriot parse failed", "loriot", "Loriot: parse failed: %s", e)
+            results.append(None)
+    return results
@@ -0,0 +1,128 @@
+"""
+Staged MQTT message pipeline.
+
+The paho on_message callback only enqueues (topic, payload bytes); a pool of worker
+threads runs the parse/decode/publish handler. Each worker owns a bounded queue and
+messages are routed by a stable hash of the device EUI (taken from the ChirpStack topic),
+so messages of one device are always handled in order by the same worker.
+"""
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+import zlib
+from typing import Callable, List, Optional, Tuple
+
+BACKPRESSURE_BLOCK = "block"
+BACKPRESSURE_DROP_OLDEST = "drop-oldest"
+BACKPRESSURE_POLICIES = (BACKPRESSURE_BLOCK, BACKPRESSURE_DROP_OLDEST)
+
+# Sentinel put on worker queues to stop the worker.
+_STOP = None
+
+
+def device_key_from_topic(topic: str) -> str:
+    """
+    Return the device EUI from a ChirpStack topic (application/<id>/device/<devEui>/event/<type>),
+    or the topic itself when it does not follow that layout.
+    """
+    parts = topic.split("/", 4)
+    if len(parts) >= 4 and parts[2] == "device":
+        return parts[3]
+    return topic
+
+
+def shard_for_key(key: str, shards: int) -> int:
+    """Stable shard index for key (same across processes, unlike hash())."""
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+
+class MessagePipeline:
+    """Bounded, device-affine worker pool for MQTT messages."""
+
+    def __init__(
+        self,
+        handler: Callable[[str, bytes], None],
+        workers: int = 1,
+        queue_size: int = 1000,
+        policy: str = BACKPRESSURE_BLOCK,
+    ) -> None:
+        """
+        handler: called as handler(topic, payload) on a worker thread.
+        workers: number of worker threads (at least 1).
+        queue_size: total number of queued messages, split evenly between workers.
+        policy: "block" makes the MQTT thread wait for room; "drop-oldest" discards the
+            oldest queued message of the worker instead.
+        """
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"unknown backpressure policy: {policy}")
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.policy = policy
+        per_worker = max(1, int(queue_size) // self.workers)
+        self.queues: List["queue.Queue[Optional[Tuple[str, bytes]]]"] = [
+            queue.Queue(maxsize=per_worker) for _ in range(self.workers)
+        ]
+        self.dropped = 0
+        self._threads: List[threading.Thread] = []
+
+    def submit(self, topic: str, payload: bytes) -> None:
+        """Enqueue a message on its device's worker queue, applying the backpressure policy."""
+        q = self.queues[shard_for_key(device_key_from_topic(topic), self.workers)]
+        item = (topic, payload)
+        if self.policy == BACKPRESSURE_BLOCK:
+            q.put(item)
+            return
+        while True:
+            try:
+                q.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                continue
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 100 == 0:
+                logging.warning("Pipeline queue full; dropped oldest message (%d dropped so far)", self.dropped)
+
+    def qsize(self) -> int:
+        """Total number of queued messages across workers."""
+        return sum(q.qsize() for q in self.queues)
+
+    def _run_worker(self, q: "queue.Queue[Optional[Tuple[str, bytes]]]") -> None:
+        """Handle messages from q until the stop sentinel is received."""
+        while True:
+            item = q.get()
+            if item is _STOP:
+                return
+            topic, payload = item
+            try:
+                self.handler(topic, payload)
+            except Exception as e:
+                logging.exception("Pipeline: handler failed for topic %s: %s", topic, e)
+
+    def start(self) -> None:
+        """Start the worker threads (daemon). Returns immediately."""
+        if self._threads:
+            return
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(
+                target=self._run_worker,
+                args=(q,),
+                daemon=True,
+                name=f"pipeline-worker-{i}",
+            )
+            thread.start()
+            self._threads.append(thread)
+        logging.info("Message pipeline started with %d worker(s)", self.workers)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Let workers finish queued messages, then stop them (waits up to timeout per worker)."""
+        for q in self.queues:
+            q.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
@@ -0,0 +1,222 @@
+"""
+Opt-in profiling of the running plugin.
+
+A profiling window lasts a fixed time and is started at startup with --profile or at any
+time by sending SIGUSR1 to the process. Two modes:
+
+- sampling (default): a background thread samples the stacks of all threads every few
+  milliseconds (sys._current_frames) and writes them in collapsed-stack format
+  (flamegraph.pl / speedscope input).
+- cprofile: message handlers decorated with @profiled (ChirpStack handle_message, Loriot
+  file/spool handling, Contract.decode_with_codec) run under a per-thread cProfile.Profile,
+  merged into one pstats file at the end of the window.
+
+In both modes each codec's decode time is recorded and written as JSON, so a slow
+third-party Codec.decode can be identified. When no window is active, @profiled costs a
+global lookup per call and codec timing is skipped.
+"""
+from __future__ import annotations
+
+import cProfile
+import functools
+import json
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+PROFILE_MODE_SAMPLING = "sampling"
+PROFILE_MODE_CPROFILE = "cprofile"
+PROFILE_MODES = (PROFILE_MODE_SAMPLING, PROFILE_MODE_CPROFILE)
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class ProfileSession:
+    """One profiling window; see module docstring."""
+
+    def __init__(self, output_dir: str, mode: str, duration_sec: float, sample_interval_sec: float = 0.005) -> None:
+        self.output_dir = output_dir
+        self.mode = mode
+        self.duration_sec = duration_sec
+        self.sample_interval_sec = sample_interval_sec
+        self.cprofile = mode == PROFILE_MODE_CPROFILE
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles: List[cProfile.Profile] = []
+        self._in_flight = 0
+        self._samples: Counter = Counter()
+        # codec -> [calls, total seconds, max seconds]
+        self._codec_times: Dict[str, List[float]] = {}
+
+    def call(self, fn: Callable[..., Any], args: Any, kwargs: Any) -> Any:
+        """Run fn under this thread's profiler (nested profiled calls run inside the outer one)."""
+        local = self._local
+        if getattr(local, "depth", 0):
+            return fn(*args, **kwargs)
+        profile = getattr(local, "profile", None)
+        if profile is None:
+            profile = local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+        with self._lock:
+            self._in_flight += 1
+        local.depth = 1
+        profile.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.disable()
+            local.depth = 0
+            with self._lock:
+                self._in_flight -= 1
+
+    def record_codec(self, codec: str, seconds: float, calls: int = 1) -> None:
+        with self._lock:
+            row = self._codec_times.get(codec)
+            if row is None:
+                row = self._codec_times[codec] = [0, 0.0, 0.0]
+            row[0] += calls
+            row[1] += seconds
+            row[2] = max(row[2], seconds / calls)
+
+    def _sample(self, deadline: float) -> None:
+        """Collect collapsed stacks of all other threads until deadline."""
+        me = threading.get_ident()
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self._samples[";".join(reversed(stack))] += 1
+            time.sleep(self.sample_interval_sec)
+
+    def run(self) -> None:
+        """Profile for duration_sec, then write the results (blocks)."""
+        deadline = time.monotonic() + self.duration_sec
+        if self.cprofile:
+            time.sleep(self.duration_sec)
+        else:
+            self._sample(deadline)
+        _end_session(self)
+        # Let in-flight profiled calls finish before their profiles are read.
+        wait_until = time.monotonic() + 5
+        while self._in_flight and time.monotonic() < wait_until:
+            time.sleep(0.01)
+        self._write()
+
+    def _write(self) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        written = []
+        if self.cprofile and self._profiles:
+            stats = pstats.Stats(self._profiles[0])
+            for profile in self._profiles[1:]:
+                stats.add(profile)
+            path = os.path.join(self.output_dir, "profile-%s.pstats" % stamp)
+            stats.dump_stats(path)
+            written.append(path)
+        elif self._samples:
+            path = os.path.join(self.output_dir, "profile-%s.collapsed" % stamp)
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, count in self._samples.most_common():
+                    f.write("%s %d\n" % (stack, count))
+            written.append(path)
+        if self._codec_times:
+            path = os.path.join(self.output_dir, "codec-timing-%s.json" % stamp)
+            codecs = {
+                codec: {"calls": calls, "total_sec": round(total, 6), "mean_ms": round(total / calls * 1000, 3), "max_ms": round(peak * 1000, 3)}
+                for codec, (calls, total, peak) in sorted(self._codec_times.items(), key=lambda kv: -kv[1][1])
+            }
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(codecs, f, indent=2)
+            written.append(path)
+        if written:
+            logging.info("Profiling: wrote %s", ", ".join(written))
+        else:
+            logging.info("Profiling: nothing was recorded")
+
+
+_session: Optional[ProfileSession] = None
+_session_lock = threading.Lock()
+_settings: Dict[str, Any] = {}
+
+
+def _end_session(session: ProfileSession) -> None:
+    global _session
+    with _session_lock:
+        if _session is session:
+            _session = None
+
+
+def configure(output_dir: str, mode: str = PROFILE_MODE_SAMPLING, duration_sec: float = 60) -> None:
+    """Set where and how start_profiling() profiles."""
+    _settings.update(output_dir=output_dir, mode=mode, duration_sec=duration_sec)
+
+
+def start_profiling() -> bool:
+    """Start a profiling window in a daemon thread. Returns False if one is already running."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            return False
+        _session = ProfileSession(
+            _settings.get("output_dir", "/tmp/lorawan-listener-profile"),
+            _settings.get("mode", PROFILE_MODE_SAMPLING),
+            _settings.get("duration_sec", 60),
+        )
+        session = _session
+    logging.info(
+        "Profiling: %s profile for %ss, output in %s", session.mode, session.duration_sec, session.output_dir
+    )
+    threading.Thread(target=session.run, daemon=True, name="profiler").start()
+    return True
+
+
+def install_signal_handler(signum: int = getattr(signal, "SIGUSR1", 0)) -> None:
+    """Start a profiling window when the process receives signum (SIGUSR1). Call from the main thread."""
+    if not signum:
+        return
+
+    def handler(_signum: int, _frame: Any) -> None:
+        if not start_profiling():
+            logging.info("Profiling: a profile is already running")
+
+    signal.signal(signum, handler)
+
+
+def profiled(fn: F) -> F:
+    """Run fn under cProfile while a cprofile window is active."""
+
+    @functools.wraps(fn)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        session = _session
+        if session is None or not session.cprofile:
+            return fn(*args, **kwargs)
+        return session.call(fn, args, kwargs)
+
+    return wrapper  # type: ignore[return-value]
+
+
+def codec_timer() -> float:
+    """Start time for record_codec (0.0 when no profiling window is active)."""
+    return time.perf_counter() if _session is not None else 0.0
+
+
+def record_codec(codec: str, t0: float, calls: int = 1) -> None:
+    """Record one decode (or a batch of calls payloads) by codec that started at t0 = codec_timer()."""
+    if t0 and calls > 0:
+        session = _session
+        if session is not None:
+            session.record_codec(codec, time.perf_counter() - t0, calls)
@@ -0,0 +1,441 @@
+"""
+Long-lived Waggle plugin session with batched publishing.
+
+The shared publish pipeline hands measurements to a Publisher instead of opening a
+Plugin per measurement. The Publisher keeps one Plugin session open for the process
+lifetime, buffers measurements in a bounded queue and publishes them from a daemon
+thread in batches (flushed by size or by a max-latency deadline). If the session
+fails it is closed and reopened after a delay. Measurements that pywaggle rejects
+(TypeError/ValueError, e.g. a non-string meta value) are logged and dropped; retrying
+them cannot succeed.
+
+Plugin.publish does not fail when Beehive is unreachable: it only puts the message on
+the session's in-memory send queue, which pywaggle's RabbitMQ thread drains whenever it
+is connected. An outage therefore shows up as a growing send queue. With a spool
+(--publish-spool-dir), once that backlog reaches --publish-spool-backlog messages new
+batches are written to disk instead of being handed to the session, measurements that
+do not fit in the publish queue are spooled too, and whatever is still in the send
+queue when a session is closed (at shutdown or on reconnect) is moved to the spool.
+A replay thread feeds spooled measurements back into the queue, oldest first and at
+most --publish-spool-replay-rate per second, once the backlog has drained to half the
+limit and nothing was spooled for a while. The live path only appends to the spool's
+in-memory compressor; disk flushes happen in the spool's own thread.
+
+With the asyncio engine (engine_async.py) the batching loop runs as the run_async()
+coroutine on the event loop instead of in the publisher thread.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+import wagglemsg
+from waggle.plugin import Plugin
+
+import logutil
+import metrics
+from spool import Spool, spool_from_args
+
+# (name, value, timestamp_ns, meta)
+PublishItem = Tuple[str, Any, int, Dict[str, Any]]
+
+
+class Publisher:
+    """Publishes measurements through a single long-lived Plugin session in batches."""
+
+    def __init__(
+        self,
+        batch_size: int = 100,
+        max_latency_sec: float = 0.5,
+        queue_size: int = 10000,
+        reconnect_delay_sec: float = 5.0,
+        spool: Optional[Spool] = None,
+        replay_rate: float = 100.0,
+        backlog_limit: int = 1000,
+    ) -> None:
+        """
+        batch_size: max measurements published per batch.
+        max_latency_sec: max time a measurement waits in the queue before its batch is flushed.
+        queue_size: max measurements buffered; submit() drops new measurements when full.
+        reconnect_delay_sec: wait before reopening the Plugin session after a failure.
+        spool: where failed and overflowing measurements are stored for replay (None: dropped).
+        replay_rate: max spooled measurements replayed per second (0: no limit).
+        backlog_limit: with a spool, unsent messages in the session's send queue at which
+            new batches are spooled instead of published (Beehive unreachable).
+        """
+        self.batch_size = max(1, int(batch_size))
+        self.max_latency_sec = max(0.0, float(max_latency_sec))
+        self.reconnect_delay_sec = reconnect_delay_sec
+        self.queue: "queue.Queue[PublishItem]" = queue.Queue(maxsize=max(0, int(queue_size)))
+        self._plugin: Optional[Plugin] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._started = False
+        self.spool = spool
+        self.replay_rate = max(0.0, float(replay_rate))
+        self.backlog_limit = max(1, int(backlog_limit))
+        # Replay waits until nothing has been spooled for this long.
+        self._replay_backoff_sec = max(1.0, 2 * reconnect_delay_sec)
+        self._last_failure: Optional[float] = None
+        self._replay_thread: Optional[threading.Thread] = None
+
+    def submit(
+        self,
+        name: str,
+        value: Any,
+        timestamp: Optional[int],
+        meta: Mapping[str, Any],
+    ) -> bool:
+        """
+        Queue one measurement for publishing. Returns False if it was dropped.
+
+        meta is copied, so callers may keep mutating their dict (e.g. gatewayId per rxInfo);
+        keys whose value is None (e.g. a Loriot uplink without devaddr) are left out, since
+        pywaggle only accepts string values. timestamp defaults to now so queueing delay does
+        not shift the measurement time.
+        """
+        item = (name, value, timestamp or time.time_ns(), {k: v for k, v in meta.items() if v is not None})
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if self._spool_item(item):
+                return True
+            logutil.log_limited(
+                logging.ERROR, "publish queue full", name, "measurement %s did not publish: publish queue is full", name
+            )
+            metrics.count_publish_error("queue_full")
+            return False
+        return True
+
+    def _spool_item(self, item: PublishItem) -> bool:
+        """Write item to the spool, if there is one. Returns False if it was not stored."""
+        if self.spool is None or not self.spool.append(item):
+            return False
+        metrics.count_spool("write")
+        return True
+
+    def start(self, thread: bool = True) -> None:
+        """
+        Start the publisher in a daemon thread. Returns immediately. With thread=False the
+        caller runs the batching loop by awaiting run_async() instead.
+        """
+        if self._started:
+            return
+        self._started = True
+        if thread:
+            self._thread = threading.Thread(
+                target=self._run_loop,
+                daemon=True,
+                name="publisher",
+            )
+            self._thread.start()
+        metrics.register_queue("publish", self.queue.qsize)
+        if self.spool is not None:
+            self.spool.start()
+            self._replay_thread = threading.Thread(target=self._replay_loop, daemon=True, name="spool-replay")
+            self._replay_thread.start()
+        logging.info(
+            "Publisher started (batch size %d, max latency %.2fs)",
+            self.batch_size,
+            self.max_latency_sec,
+        )
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Flush queued measurements and close the Plugin session (waits up to timeout)."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._replay_thread is not None:
+            self._replay_thread.join(timeout)
+            self._replay_thread = None
+
+    def _open_session(self) -> Plugin:
+        """Return the open Plugin session, opening a new one if needed."""
+        if self._plugin is None:
+            plugin = Plugin()
+            plugin.__enter__()
+            self._plugin = plugin
+            logging.debug("Publisher: plugin session opened")
+        return self._plugin
+
+    def _close_session(self) -> None:
+        """
+        Close the Plugin session. pywaggle flushes its send queue if it is connected; with a
+        spool, messages still unsent after that (Beehive unreachable) are spooled.
+        """
+        plugin, self._plugin = self._plugin, None
+        if plugin is None:
+            return
+        try:
+            plugin.__exit__(None, None, None)
+        except Exception as e:
+            logging.warning("Publisher: error closing plugin session: %s", e)
+        if self.spool is not None:
+            self._spool_unsent(plugin)
+
+    def _spool_unsent(self, plugin: Plugin) -> None:
+        """Move the messages left in a closed session's send queue to the spool."""
+        send = getattr(plugin, "send", None)
+        if send is None:
+            return
+        stored = 0
+        while True:
+            try:
+                data = send.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                msg = wagglemsg.load(data.body)
+            except Exception as e:
+                logging.warning("Publish spool: cannot read unsent message: %s", e)
+                continue
+            if self._spool_item((msg.name, msg.value, msg.timestamp, msg.meta)):
+                stored += 1
+        if stored:
+            self._last_failure = time.monotonic()
+            logging.warning("Publish spool: stored %d message(s) the plugin session could not send", stored)
+
+    def _backlog(self) -> int:
+        """Messages handed to the open session but not yet sent to Beehive."""
+        send = getattr(self._plugin, "send", None)
+        return send.qsize() if send is not None else 0
+
+    def _next_batch(self) -> List[PublishItem]:
+        """Wait for the first measurement, then collect until batch_size or the latency deadline."""
+        try:
+            first = self.queue.get(timeout=0.5)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.max_latency_sec
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _publish_batch(self, batch: List[PublishItem]) -> None:
+        """
+        Publish each measurement of the batch through the open session, or spool the batch
+        while the session's backlog is at the limit. If the session raises, the measurements
+        not yet published are left in batch for the caller to retry.
+        """
+        plugin = self._open_session()
+        if self.spool is not None:
+            backlog = self._backlog()
+            if backlog >= self.backlog_limit:
+                self._last_failure = time.monotonic()
+                stored = sum(1 for item in batch if self._spool_item(item))
+                logutil.log_limited(
+                    logging.WARNING,
+                    "publish backlog",
+                    "publisher",
+                    "Publisher: %d message(s) not yet sent to Beehive; spooled %d measurement(s)",
+                    backlog,
+                    stored,
+                )
+                if stored < len(batch):
+                    metrics.count_publish_error("spool")
+                batch.clear()
+                return
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        published = 0
+        for i, (name, value, timestamp, meta) in enumerate(batch):
+            t0 = metrics.start()
+            try:
+                plugin.publish(name, value, timestamp=timestamp, meta=meta)
+            except (TypeError, ValueError) as e:
+                # Rejected by pywaggle's checks; it would be rejected again on every retry.
+                logutil.log_limited(logging.ERROR, "publish invalid", name, "measurement %s dropped: %s", name, str(e))
+                metrics.count_publish_error("invalid")
+                continue
+            except Exception:
+                del batch[:i]
+                metrics.count_published(published)
+                raise
+            metrics.observe_stage(metrics.STAGE_PUBLISH, t0)
+            published += 1
+            if debug:
+                logging.debug("%s published", name)
+        batch.clear()
+        metrics.count_published(published)
+        logutil.log_limited(logging.INFO, "batch published", "publisher", "%d measurement(s) published", published)
+
+    def _run_loop(self) -> None:
+        """Publish batches until stopped, then drain the queue and close the session."""
+        pending: List[PublishItem] = []
+        while True:
+            stopping = self._stop.is_set()
+            if not pending:
+                pending = self._next_batch()
+                if not pending and stopping and self.queue.empty():
+                    break
+                if not pending:
+                    continue
+            try:
+                self._publish_batch(pending)
+            except Exception as e:
+                self._last_failure = time.monotonic()
+                logging.error("Publisher: publish session failed: %s; reconnecting in %ss", e, self.reconnect_delay_sec)
+                self._close_session()
+                if self._stop.wait(self.reconnect_delay_sec):
+                    break
+        self._finish(pending)
+
+    async def run_async(self) -> None:
+        """
+        Batching loop as a coroutine (start(thread=False)). Each tick publishes everything
+        queued in batches of batch_size, so a measurement waits at most max_latency_sec;
+        Plugin.publish only hands the message to the plugin's sender, so it runs on the loop.
+        Session failures, stop() and the final drain are handled as in the thread loop.
+        """
+        tick = max(0.001, self.max_latency_sec)
+        pending: List[PublishItem] = []
+        while True:
+            stopping = self._stop.is_set()
+            if not pending:
+                pending = self._take_batch()
+                if not pending:
+                    if stopping:
+                        break
+                    await asyncio.sleep(tick)
+                    continue
+            try:
+                self._publish_batch(pending)
+            except Exception as e:
+                self._last_failure = time.monotonic()
+                logging.error("Publisher: publish session failed: %s; reconnecting in %ss", e, self.reconnect_delay_sec)
+                self._close_session()
+                if stopping:
+                    break
+                await asyncio.sleep(self.reconnect_delay_sec)
+                continue
+            # Let other coroutines run between batches of a backlog.
+            await asyncio.sleep(0)
+        self._finish(pending)
+
+    def _take_batch(self) -> List[PublishItem]:
+        """Up to batch_size queued measurements, without waiting."""
+        batch: List[PublishItem] = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _finish(self, pending: List[PublishItem]) -> None:
+        """After the batching loop: spool what is left (if spooling) and close the session."""
+        if self.spool is not None:
+            self._spool_unpublished(pending)
+        self._close_session()
+        if self.spool is not None:
+            self.spool.close()
+        logging.info("Publisher stopped")
+
+    def _spool_unpublished(self, pending: List[PublishItem]) -> None:
+        """At shutdown, store the measurements that could not be published in the spool."""
+        while True:
+            try:
+                pending.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if pending:
+            stored = sum(1 for item in pending if self._spool_item(item))
+            logging.info("Publish spool: stored %d unpublished measurement(s) at shutdown", stored)
+
+    def _can_replay(self) -> bool:
+        """
+        True if nothing was spooled or failed within the replay backoff, the session's backlog
+        is under half the limit and the queue is at most half full.
+        """
+        last_failure = self._last_failure
+        if last_failure is not None and time.monotonic() - last_failure < self._replay_backoff_sec:
+            return False
+        if self._backlog() >= self.backlog_limit // 2:
+            return False
+        return self.queue.maxsize == 0 or self.queue.qsize() < self.queue.maxsize // 2
+
+    def _replay_loop(self) -> None:
+        """Feed spooled measurements back into the queue, oldest segment first, rate limited."""
+        spool = self.spool
+        assert spool is not None
+        interval = 1.0 / self.replay_rate if self.replay_rate else 0.0
+        while not self._stop.is_set():
+            path = spool.next_segment() if self._can_replay() else None
+            if path is None:
+                self._stop.wait(1.0)
+                continue
+            replayed = 0
+            next_at = time.monotonic()
+            for item in spool.read_segment(path):
+                while not self._can_replay():
+                    if self._stop.wait(1.0):
+                        return
+                now = time.monotonic()
+                if next_at > now:
+                    if self._stop.wait(next_at - now):
+                        return
+                else:
+                    # No catch-up burst after a pause.
+                    next_at = now
+                next_at += interval
+                while True:
+                    try:
+                        self.queue.put(item, timeout=1.0)
+                        break
+                    except queue.Full:
+                        if self._stop.is_set():
+                            return
+                replayed += 1
+            # Stopping mid-segment leaves it in the spool; it is replayed again on the next start.
+            spool.remove_segment(path)
+            metrics.count_spool("replay", replayed)
+            logging.info("Publish spool: replayed %d measurement(s) from %s", replayed, path)
+
+
+_publisher: Optional[Publisher] = None
+_publisher_lock = threading.Lock()
+
+
+def start_publisher(args: Any, thread: bool = True) -> Publisher:
+    """Create and start the process-wide publisher from --publish-* args (see Publisher.start for thread)."""
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = Publisher(
+                batch_size=getattr(args, "publish_batch_size", 100),
+                max_latency_sec=getattr(args, "publish_max_latency_sec", 0.5),
+                queue_size=getattr(args, "publish_queue_size", 10000),
+                spool=spool_from_args(args),
+                replay_rate=getattr(args, "publish_spool_replay_rate", 100.0),
+                backlog_limit=getattr(args, "publish_spool_backlog", 1000),
+            )
+            _publisher.start(thread)
+        return _publisher
+
+
+def get_publisher() -> Publisher:
+    """Return the process-wide publisher, starting one with default settings if needed."""
+    if _publisher is None:
+        return start_publisher(None)
+    return _publisher
+
+
+def stop_publisher() -> None:
+    """Flush and stop the process-wide publisher, if started."""
+    global _publisher
+    with _publisher_lock:
+        publisher, _publisher = _publisher, None
+    if publisher is not None:
+        publisher.stop()
@@ -0,0 +1,232 @@
+"""
+Disk-backed store-and-forward buffer for measurements that could not be published.
+
+The Publisher appends a measurement to the spool when Beehive is unreachable (the plugin
+session's send backlog is at its limit) or its queue is full, and replays the spool once
+the backlog has drained. Measurements are written as
+JSON lines to gzip-compressed segment files (spool-<seq>.jsonl.gz) that are appended to
+and never rewritten. A segment is sealed when it reaches segment_bytes; sealed segments
+are replayed oldest first and removed once replayed. When the spool exceeds max_bytes the
+oldest segments are evicted. Writes go to the compressor in memory and are flushed and
+fsynced every fsync_interval_sec from a background thread, so the SD card sees one sync
+per interval instead of one per measurement. A crash loses at most the last interval;
+a truncated segment is read up to the last flushed record. Delivery is at least once: a
+segment interrupted during replay is replayed again from the start.
+"""
+from __future__ import annotations
+
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+import zlib
+from collections import deque
+from typing import Any, BinaryIO, Deque, Iterator, Optional, Tuple
+
+SEGMENT_PATTERN = re.compile(r"^spool-(\d{12})\.jsonl\.gz$")
+
+# (name, value, timestamp_ns, meta), as in publisher.PublishItem
+SpoolItem = Tuple[str, Any, int, Any]
+
+
+class Spool:
+    """Append-only, size-capped spool of gzip segments; see module docstring."""
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 64 * 1024 * 1024,
+        segment_bytes: int = 1024 * 1024,
+        fsync_interval_sec: float = 1.0,
+    ) -> None:
+        """
+        directory: where segments are kept (created if missing); existing segments are replayed.
+        max_bytes: max compressed size of all segments; the oldest are evicted beyond it.
+        segment_bytes: compressed size at which the segment being written is sealed.
+        fsync_interval_sec: how often appended records are flushed and fsynced.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max(1, int(max_bytes))
+        self.segment_bytes = max(1, min(int(segment_bytes), self.max_bytes))
+        self.fsync_interval_sec = fsync_interval_sec
+        self._lock = threading.Lock()
+        # Sealed segments, oldest first: (path, size in bytes).
+        self._sealed: Deque[Tuple[str, int]] = deque()
+        self._sealed_bytes = 0
+        seq = 0
+        for name in sorted(os.listdir(directory)):
+            match = SEGMENT_PATTERN.match(name)
+            if not match:
+                continue
+            path = os.path.join(directory, name)
+            size = os.path.getsize(path)
+            self._sealed.append((path, size))
+            self._sealed_bytes += size
+            seq = int(match.group(1)) + 1
+        self._seq = seq
+        self._raw: Optional[BinaryIO] = None
+        self._gz: Optional[gzip.GzipFile] = None
+        self._active_path = ""
+        self._active_records = 0
+        self._dirty = False
+        self._closed = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if self._sealed:
+            logging.info(
+                "Publish spool: %d segment(s) (%d bytes) from a previous run in %s",
+                len(self._sealed),
+                self._sealed_bytes,
+                directory,
+            )
+
+    def start(self) -> None:
+        """Start the background flush/fsync thread."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._sync_loop, daemon=True, name="spool-sync")
+        self._thread.start()
+
+    def close(self) -> None:
+        """Seal the segment being written (flushed and fsynced) and stop the sync thread."""
+        self._stop.set()
+        with self._lock:
+            self._closed = True
+            self._seal_locked()
+        if self._thread is not None:
+            self._thread.join(5)
+            self._thread = None
+
+    def append(self, item: SpoolItem) -> bool:
+        """Append one measurement. Returns False if the spool is closed or the item cannot be stored."""
+        try:
+            data = (json.dumps(list(item), separators=(",", ":")) + "\n").encode("utf-8")
+        except (TypeError, ValueError) as e:
+            logging.warning("Publish spool: cannot store measurement %s: %s", item[0], e)
+            return False
+        with self._lock:
+            if self._closed:
+                return False
+            try:
+                if self._gz is None:
+                    self._open_segment_locked()
+                assert self._gz is not None and self._raw is not None
+                self._gz.write(data)
+                self._active_records += 1
+                self._dirty = True
+                if self._raw.tell() >= self.segment_bytes:
+                    self._seal_locked()
+                self._evict_locked()
+            except OSError as e:
+                logging.error("Publish spool: write to %s failed: %s", self.directory, e)
+                return False
+        return True
+
+    def _open_segment_locked(self) -> None:
+        self._active_path = os.path.join(self.directory, "spool-%012d.jsonl.gz" % self._seq)
+        self._seq += 1
+        self._raw = open(self._active_path, "ab")
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode="ab", mtime=0)
+        self._active_records = 0
+
+    def _seal_locked(self) -> None:
+        """Finish the segment being written and queue it for replay."""
+        gz, raw = self._gz, self._raw
+        if gz is None or raw is None:
+            return
+        self._gz = self._raw = None
+        try:
+            gz.close()
+            raw.flush()
+            os.fsync(raw.fileno())
+        finally:
+            raw.close()
+        size = os.path.getsize(self._active_path)
+        self._sealed.append((self._active_path, size))
+        self._sealed_bytes += size
+        self._dirty = False
+
+    def _evict_locked(self) -> None:
+        """Remove the oldest sealed segments while the spool is over max_bytes."""
+        active = self._raw.tell() if self._raw is not None else 0
+        while self._sealed and self._sealed_bytes + active > self.max_bytes:
+            path, size = self._sealed.popleft()
+            self._sealed_bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            logging.warning("Publish spool: over %d bytes; evicted oldest segment %s", self.max_bytes, path)
+
+    def sync(self) -> None:
+        """Flush buffered records of the segment being written to disk and fsync it."""
+        with self._lock:
+            if not self._dirty or self._gz is None or self._raw is None:
+                return
+            self._gz.flush(zlib.Z_SYNC_FLUSH)
+            self._raw.flush()
+            self._dirty = False
+            # fsync a duplicate descriptor outside the lock so appends are not held up by the disk.
+            fd = os.dup(self._raw.fileno())
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _sync_loop(self) -> None:
+        while not self._stop.wait(self.fsync_interval_sec):
+            try:
+                self.sync()
+            except OSError as e:
+                logging.error("Publish spool: sync failed: %s", e)
+
+    def next_segment(self) -> Optional[str]:
+        """The oldest segment to replay, sealing the one being written if nothing else is left."""
+        with self._lock:
+            if not self._sealed and self._active_records:
+                self._seal_locked()
+            return self._sealed[0][0] if self._sealed else None
+
+    def read_segment(self, path: str) -> Iterator[SpoolItem]:
+        """Yield the measurements of a segment in order (up to the last complete record)."""
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        name, value, timestamp, meta = json.loads(line)
+                    except ValueError:
+                        continue
+                    yield name, value, int(timestamp), meta
+        except FileNotFoundError:
+            return
+        except (EOFError, OSError, zlib.error) as e:
+            logging.warning("Publish spool: segment %s is truncated or damaged: %s", path, e)
+
+    def remove_segment(self, path: str) -> None:
+        """Remove a replayed segment."""
+        with self._lock:
+            for i, (sealed_path, size) in enumerate(self._sealed):
+                if sealed_path == path:
+                    del self._sealed[i]
+                    self._sealed_bytes -= size
+                    break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def pending_bytes(self) -> int:
+        """Compressed bytes waiting to be replayed."""
+        with self._lock:
+            return self._sealed_bytes + (self._raw.tell() if self._raw is not None else 0)
+
+
+def spool_from_args(args: Any) -> Optional[Spool]:
+    """A Spool in --publish-spool-dir, or None if it is not set."""
+    directory = getattr(args, "publish_spool_dir", "") if args is not None else ""
+    if not directory:
+        return None
+    return Spool(directory, max_bytes=int(getattr(args, "publish_spool_max_mb", 64) * 1024 * 1024))
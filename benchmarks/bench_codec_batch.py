@@ -0,0 +1,86 @@
+"""
+Benchmark: Codec.decode per payload vs Codec.decode_batch, for the UK SmartWater buoy codec.
+
+Decodes --n random 7/8-byte payloads (default 10000) three ways and checks that all give the
+same results:
+- codec: Codec.decode in a loop vs one Codec.decode_batch call (NumPy);
+- contract: Contract.decode_with_codec per hex payload vs Contract.decode_many, as used for
+  a Loriot inbox backlog (includes hex decoding and conversion to measurements).
+
+Usage: python benchmarks/bench_codec_batch.py [--n 10000]
+Exits with status 1 if batch and per-payload results differ.
+"""
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+from codec_loader import Contract  # noqa: E402
+
+CODEC_DIR = os.path.join(ROOT, "app", "codecs", "UK_SmartWater_buoy")
+
+
+def load_codec():
+    spec = importlib.util.spec_from_file_location("buoy_codec", os.path.join(CODEC_DIR, "codec.py"))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod.Codec()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--n", type=int, default=10000, help="payloads per batch")
+    ap.add_argument("--repeat", type=int, default=5, help="best of this many runs")
+    ap.add_argument("--seed", type=int, default=1)
+    opts = ap.parse_args()
+
+    try:
+        import numpy
+    except ImportError:
+        print("numpy is not installed; decode_batch falls back to decode, nothing to compare")
+        return
+    rng = random.Random(opts.seed)
+    payloads = [bytes(rng.getrandbits(8) for _ in range(rng.choice((7, 8, 8, 8)))) for _ in range(opts.n)]
+    codec = load_codec()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        contract = Contract({"^SW": CODEC_DIR}, cache_dir)
+        requests = [("SW buoy %d" % (i % 50), p.hex()) for i, p in enumerate(payloads)]
+
+        def per_payload():
+            return [codec.decode(p) for p in payloads]
+
+        def batch():
+            return codec.decode_batch(payloads)
+
+        def contract_per_payload():
+            return [contract.decode_with_codec(name, payload, encoding="hex") for name, payload in requests]
+
+        def contract_batch():
+            return contract.decode_many(requests, encoding="hex")
+
+        same = per_payload() == batch() and contract_per_payload() == contract_batch()
+
+        def bench(label, fn, baseline=None):
+            best = min(timeit.repeat(fn, number=1, repeat=opts.repeat))
+            per_payload_us = best / opts.n * 1e6
+            speedup = f"{baseline / best:5.1f}x" if baseline else "  1.0x"
+            print(f"{label:34s} {best * 1e3:9.2f} ms  {per_payload_us:7.3f} us/payload  {speedup}")
+            return best
+
+        print(f"{opts.n} payloads, numpy {numpy.__version__}")
+        baseline = bench("codec decode (loop)", per_payload)
+        bench("codec decode_batch", batch, baseline)
+        baseline = bench("contract decode_with_codec (loop)", contract_per_payload)
+        bench("contract decode_many", contract_batch, baseline)
+    print("results identical" if same else "RESULTS DIFFER")
+    sys.exit(0 if same else 1)
+
+
+if __name__ == "__main__":
+    main()
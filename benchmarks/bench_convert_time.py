@@ -0,0 +1,52 @@
+"""
+Micro-benchmark: parse.convert_time against the previous dateutil-based implementation.
+
+Usage: python benchmarks/bench_convert_time.py [--n 200000]
+Requires python-dateutil (as the plugin does).
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from dateutil import parser as dateutil_parser  # noqa: E402
+
+from parse import convert_time  # noqa: E402
+
+
+def legacy_convert_time(iso_time):
+    """convert_time before the RFC 3339 fast path (float seconds * 1e9)."""
+    datetime_obj = dateutil_parser.isoparse(iso_time)
+    return int(datetime_obj.timestamp() * 1e9)
+
+
+def make_samples(count):
+    """ChirpStack-style times: a few uplinks per second with 9-digit fractions."""
+    return [
+        "2024-12-03T15:%02d:%02d.%09d+00:00" % ((i // 240) % 60, (i // 4) % 60, (i * 7919) % 1_000_000_000)
+        for i in range(count)
+    ]
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--n", type=int, default=200000, help="timestamps per run")
+    opts = ap.parse_args()
+
+    samples = make_samples(opts.n)
+    exact = sum(convert_time(s) == legacy_convert_time(s) for s in samples[:10000])
+    max_diff = max(abs(convert_time(s) - legacy_convert_time(s)) for s in samples[:10000])
+
+    legacy = min(timeit.repeat(lambda: [legacy_convert_time(s) for s in samples], number=1, repeat=3))
+    fast = min(timeit.repeat(lambda: [convert_time(s) for s in samples], number=1, repeat=3))
+    print(f"samples:           {opts.n}")
+    print(f"legacy (dateutil): {legacy / opts.n * 1e6:.3f} us/call")
+    print(f"convert_time:      {fast / opts.n * 1e6:.3f} us/call")
+    print(f"speedup:           {legacy / fast:.1f}x")
+    print(f"equal to legacy:   {exact}/10000 (max diff {max_diff} ns, legacy loses sub-microsecond digits)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Benchmark: ChirpStack uplink decoding per JSON backend, over test/example.json.
+
+Usage: python benchmarks/bench_json_decode.py [--n 100000]
+Backends that are not installed (msgspec, orjson) are skipped.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+import json_decode  # noqa: E402
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--n", type=int, default=100000, help="decodes per backend")
+    ap.add_argument("--payload", default=os.path.join(ROOT, "test", "example.json"))
+    opts = ap.parse_args()
+
+    with open(opts.payload, "rb") as f:
+        # Compact, as ChirpStack sends it over MQTT.
+        payload = json.dumps(json.loads(f.read()), separators=(",", ":")).encode("utf-8")
+
+    def legacy():
+        return json.loads(payload.decode("utf-8"))
+
+    def bench(label, fn, baseline=None):
+        best = min(timeit.repeat(fn, number=opts.n, repeat=3))
+        per_call = best / opts.n * 1e6
+        speedup = f"{baseline / per_call:5.1f}x" if baseline else "  1.0x"
+        print(f"{label:32s} {per_call:8.3f} us/decode  {speedup}")
+        return per_call
+
+    print(f"payload: {len(payload)} bytes, {opts.n} decodes")
+    baseline = bench("legacy (decode + json.loads)", legacy)
+    for name in (json_decode.BACKEND_JSON, json_decode.BACKEND_ORJSON, json_decode.BACKEND_MSGSPEC):
+        if not json_decode._available(name):
+            print(f"{name}: not installed, skipped")
+            continue
+        json_decode.set_json_backend(name)
+        bench(f"{name} uplink", lambda: json_decode.loads_chirpstack_uplink(payload), baseline)
+        if name == json_decode.BACKEND_MSGSPEC:
+            bench(f"{name} full document", lambda: json_decode.loads(payload), baseline)
+
+
+if __name__ == "__main__":
+    main()
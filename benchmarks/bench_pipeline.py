@@ -0,0 +1,444 @@
+"""
+End-to-end throughput benchmark: synthetic ChirpStack and Loriot uplinks through the real pipeline.
+
+Uplinks are synthesized from test/example.json and test/example_loriot.json (varying devices,
+measurement counts and gateways) and driven through ChirpstackClient (paho on_message, or over
+TCP from a minimal in-process MQTT broker with --transport mqtt) and LoriotInboxWatcher (files or
+spool inbox). The Waggle Plugin is replaced by a stub that records when each measurement reaches
+it, so the run is offline. Reports uplinks/s, p50/p99 latency (uplink injection to plugin publish,
+per measurement) and allocations per uplink (peak transient bytes and net retained blocks, from an
+inline tracemalloc pass), as JSON on stdout or --output.
+
+Usage: python benchmarks/bench_pipeline.py [--scenario all] [--uplinks 20000] [--output results.json]
+"""
+import argparse
+import copy
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+import publisher  # noqa: E402
+from calc import plr_tracker_from_args  # noqa: E402
+from client import ChirpstackClient  # noqa: E402
+from json_decode import get_json_backend, set_json_backend  # noqa: E402
+from loriot_watcher import LoriotInboxWatcher  # noqa: E402
+from measurement_filter import MeasurementFilter  # noqa: E402
+
+TIME_MARK = b'"__TIME__"'
+TS_MARK = b'"__TS__"'
+TOPIC = "application/{app}/device/{eui}/event/up"
+
+
+class StubPlugin:
+    """Stands in for waggle.plugin.Plugin: records (arrival ns, measurement timestamp ns) per publish."""
+
+    published = []
+
+    def __init__(self):
+        self.stop = threading.Event()
+        self.tasks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+
+    def publish(self, name, value, timestamp=None, meta=None):
+        StubPlugin.published.append((time.time_ns(), timestamp))
+
+
+def rfc3339_ns(ns):
+    """ChirpStack-style time string with nanoseconds."""
+    seconds, frac = divmod(ns, 1_000_000_000)
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S") + f".{frac:09d}+00:00"
+
+
+def parse_range(text):
+    low, _, high = text.partition(":")
+    return int(low), int(high or low)
+
+
+def chirpstack_uplinks(opts, rng):
+    """[(topic, payload with TIME_MARK, measurement count)] for opts.uplinks uplinks over opts.devices devices."""
+    with open(os.path.join(ROOT, "test", "example.json"), "rb") as f:
+        template = json.load(f)
+    names = [m["name"] for m in template["object"]["measurements"]]
+    m_low, m_high = parse_range(opts.measurements)
+    g_low, g_high = parse_range(opts.gateways)
+    devices = []
+    for d in range(opts.devices):
+        eui = f"{d:016x}"
+        count = rng.randint(m_low, m_high)
+        devices.append((eui, [f"{names[i % len(names)]}-{i // len(names)}" for i in range(count)], rng.randint(g_low, g_high)))
+    uplinks = []
+    for i in range(opts.uplinks):
+        eui, device_names, gateways = devices[i % opts.devices]
+        uplink = copy.deepcopy(template)
+        uplink["time"] = "__TIME__"
+        uplink["deduplicationId"] = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        uplink["deviceInfo"]["devEui"] = eui
+        uplink["deviceInfo"]["deviceName"] = f"bench node {eui}"
+        uplink["fCnt"] = i // opts.devices + 1
+        uplink["object"]["measurements"] = [
+            {"channelId": 0.0, "name": name, "value": round(rng.uniform(-50, 50), 3)} for name in device_names
+        ]
+        rx = template["rxInfo"][0]
+        uplink["rxInfo"] = [
+            dict(rx, gatewayId=f"gw{g:014x}", rssi=rng.randint(-120, -40), snr=round(rng.uniform(-10, 12), 1))
+            for g in range(gateways)
+        ]
+        payload = json.dumps(uplink, separators=(",", ":")).encode("utf-8").replace(b'"__TIME__"', TIME_MARK)
+        topic = TOPIC.format(app=uplink["deviceInfo"]["applicationId"], eui=eui)
+        signal = 2 + 2 * gateways if opts.signal else 0
+        uplinks.append((topic, payload, len(device_names) + signal))
+    return uplinks
+
+
+def loriot_uplinks(opts, rng):
+    """[(payload with TS_MARK, measurement count)] for opts.uplinks Loriot uplinks."""
+    with open(os.path.join(ROOT, "test", "example_loriot.json"), "rb") as f:
+        template = json.load(f)
+    names = list(template["decoded"]["data"])
+    m_low, m_high = parse_range(opts.measurements)
+    counts = [rng.randint(m_low, m_high) for _ in range(opts.devices)]
+    uplinks = []
+    for i in range(opts.uplinks):
+        d = i % opts.devices
+        uplink = dict(template)
+        uplink["ts"] = "__TS__"
+        uplink["EUI"] = f"{d:016X}"
+        uplink["name"] = f"bench meter {d}"
+        uplink["fcnt"] = i // opts.devices + 1
+        uplink["decoded"] = dict(
+            template["decoded"],
+            data={f"{names[j % len(names)]}{j // len(names)}": round(rng.uniform(0, 100), 3) for j in range(counts[d])},
+        )
+        payload = json.dumps(uplink, separators=(",", ":")).encode("utf-8")
+        signal = 4 if opts.signal else 0
+        uplinks.append((payload, counts[d] + signal))
+    return uplinks
+
+
+class BrokerStandIn:
+    """Minimal MQTT 3.1.1 broker for one subscriber: CONNACK, SUBACK, PINGRESP, then QoS 0 PUBLISH frames."""
+
+    def __init__(self):
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.subscribed = threading.Event()
+        self.conn = None
+        self._send_lock = threading.Lock()
+        threading.Thread(target=self._serve, daemon=True, name="bench-broker").start()
+
+    def _read_packet(self, conn):
+        header = conn.recv(1)
+        if not header:
+            return None, b""
+        length, shift = 0, 0
+        while True:
+            byte = conn.recv(1)[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        body = b""
+        while len(body) < length:
+            chunk = conn.recv(length - len(body))
+            if not chunk:
+                return None, b""
+            body += chunk
+        return header[0], body
+
+    def _serve(self):
+        conn, _ = self.server.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.conn = conn
+        while True:
+            kind, body = self._read_packet(conn)
+            if kind is None or kind == 0xE0:
+                break
+            with self._send_lock:
+                if kind == 0x10:
+                    conn.sendall(b"\x20\x02\x00\x00")
+                elif kind & 0xF0 == 0x80:
+                    conn.sendall(b"\x90\x03" + body[:2] + b"\x00")
+                    self.subscribed.set()
+                elif kind == 0xC0:
+                    conn.sendall(b"\xd0\x00")
+
+    @staticmethod
+    def _remaining_length(n):
+        out = bytearray()
+        while True:
+            byte, n = n & 0x7F, n >> 7
+            out.append(byte | (0x80 if n else 0))
+            if not n:
+                return bytes(out)
+
+    def publish(self, topic, payload):
+        topic_bytes = topic.encode("utf-8")
+        body = len(topic_bytes).to_bytes(2, "big") + topic_bytes + payload
+        with self._send_lock:
+            self.conn.sendall(b"\x30" + self._remaining_length(len(body)) + body)
+
+
+def make_args(opts, inbox_dir=""):
+    args = SimpleNamespace(
+        dry=False,
+        collect=[],
+        ignore=[],
+        signal_strength_indicators=opts.signal,
+        plr=3600,
+        plr_shards=16,
+        plr_max_devices=10000,
+        plr_idle_ttl_sec=86400,
+        workers=opts.workers,
+        queue_size=opts.queue_size,
+        backpressure="block",
+        publish_batch_size=opts.publish_batch_size,
+        publish_max_latency_sec=opts.publish_max_latency_sec,
+        publish_queue_size=max(10000, opts.uplinks * 40),
+        mqtt_server_ip="127.0.0.1",
+        mqtt_server_port=1883,
+        mqtt_subscribe_topic="application/#",
+        loriot_inbox_dir=inbox_dir,
+        loriot_poll_interval_sec=0.05,
+        loriot_watch_mode=opts.loriot_watch_mode,
+        loriot_inbox_format=opts.loriot_inbox_format,
+        dedup_window_sec=opts.dedup_window_sec,
+        dedup_max_entries=20000,
+    )
+    args.measurement_filter = MeasurementFilter(args.collect, args.ignore)
+    return args
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def wait_and_summarize(expected, start_ns, uplinks, timeout):
+    """Wait until expected publishes reached the stub, then compute throughput and latency."""
+    deadline = time.monotonic() + timeout
+    while len(StubPlugin.published) < expected and time.monotonic() < deadline:
+        time.sleep(0.005)
+    records = list(StubPlugin.published)
+    end_ns = max((arrived for arrived, _ in records), default=time.time_ns())
+    latencies = sorted((arrived - ts) / 1e6 for arrived, ts in records)
+    elapsed = (end_ns - start_ns) / 1e9
+    return {
+        "uplinks": uplinks,
+        "measurements_expected": expected,
+        "measurements_published": len(records),
+        "complete": len(records) >= expected,
+        "elapsed_sec": round(elapsed, 4),
+        "uplinks_per_sec": round(uplinks / elapsed, 1) if elapsed > 0 else None,
+        "measurements_per_sec": round(len(records) / elapsed, 1) if elapsed > 0 else None,
+        "latency_ms_p50": round(percentile(latencies, 0.50), 3) if latencies else None,
+        "latency_ms_p99": round(percentile(latencies, 0.99), 3) if latencies else None,
+        "latency_ms_max": round(latencies[-1], 3) if latencies else None,
+    }
+
+
+def start_stub_publisher(args):
+    # Stop (and drain) the previous scenario's publisher before resetting the list, so its
+    # pending publishes are not counted in the next scenario.
+    publisher.stop_publisher()
+    StubPlugin.published = []
+    publisher.Plugin = StubPlugin
+    publisher.start_publisher(args)
+
+
+def allocation_pass(handle, items, count):
+    """Peak transient bytes and net retained blocks per uplink, handling uplinks inline under tracemalloc."""
+    items = items[:count]
+    gc.collect()
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    peaks = 0
+    for item in items:
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        handle(item)
+        peaks += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    gc.collect()
+    return {
+        "alloc_peak_bytes_per_uplink": round(peaks / len(items), 1),
+        "alloc_net_blocks_per_uplink": round((sys.getallocatedblocks() - blocks_before) / len(items), 2),
+    }
+
+
+def bench_chirpstack(opts, rng):
+    uplinks = chirpstack_uplinks(opts, rng)
+    args = make_args(opts)
+    start_stub_publisher(args)
+    client = ChirpstackClient(args, None, plr_tracker_from_args(args))
+    broker = None
+    runner = None
+    if opts.transport == "mqtt":
+        broker = BrokerStandIn()
+        args.mqtt_server_port = broker.port
+        runner = threading.Thread(target=client.run, daemon=True, name="bench-mqtt")
+        runner.start()
+        if not broker.subscribed.wait(10):
+            raise RuntimeError("client did not subscribe to the broker stand-in")
+        send = broker.publish
+    else:
+        if client.pipeline is not None:
+            client.pipeline.start()
+        on_message = client.client.on_message
+
+        def send(topic, payload):
+            on_message(client.client, None, SimpleNamespace(topic=topic, payload=payload))
+
+    expected = sum(count for _, _, count in uplinks)
+    start_ns = time.time_ns()
+    for topic, payload, _ in uplinks:
+        send(topic, payload.replace(TIME_MARK, b'"' + rfc3339_ns(time.time_ns()).encode() + b'"'))
+    result = wait_and_summarize(expected, start_ns, len(uplinks), opts.timeout)
+    if runner is not None:
+        # run() stops the worker pipeline once the client has disconnected.
+        client.client.disconnect()
+        runner.join(opts.timeout)
+    elif client.pipeline is not None:
+        client.pipeline.stop()
+
+    now = rfc3339_ns(time.time_ns()).encode()
+    args.uplink_deduplicator = None  # the tracemalloc pass replays the same uplinks
+    result.update(
+        allocation_pass(
+            lambda item: client.handle_message(item[0], item[1].replace(TIME_MARK, b'"' + now + b'"')),
+            uplinks,
+            opts.alloc_uplinks,
+        )
+    )
+    result["transport"] = opts.transport
+    return result
+
+
+def bench_loriot(opts, rng):
+    uplinks = loriot_uplinks(opts, rng)
+    with tempfile.TemporaryDirectory(prefix="bench-loriot-") as inbox:
+        args = make_args(opts, inbox)
+        start_stub_publisher(args)
+        watcher = LoriotInboxWatcher(inbox, args, None, plr_tracker_from_args(args))
+        watcher.start_daemon()
+        time.sleep(0.2)  # let the watch be set up before the first file
+
+        expected = sum(count for _, count in uplinks)
+        start_ns = time.time_ns()
+        if opts.loriot_inbox_format == "spool":
+            with open(os.path.join(inbox, f"segment-{time.time_ns()}.jsonl"), "ab", buffering=0) as segment:
+                for i, (payload, _) in enumerate(uplinks):
+                    segment.write(payload.replace(TS_MARK, str(time.time_ns() // 1_000_000).encode()) + b"\n")
+        else:
+            for i, (payload, _) in enumerate(uplinks):
+                tmp = os.path.join(inbox, f".{i:09d}.tmp")
+                with open(tmp, "wb") as f:
+                    f.write(payload.replace(TS_MARK, str(time.time_ns() // 1_000_000).encode()))
+                os.rename(tmp, os.path.join(inbox, f"{i:09d}.json"))
+        result = wait_and_summarize(expected, start_ns, len(uplinks), opts.timeout)
+
+        now = str(time.time_ns() // 1_000_000).encode()
+        args.uplink_deduplicator = None  # the tracemalloc pass replays the same uplinks
+        result.update(
+            allocation_pass(
+                lambda item: watcher._process_body(item[0].replace(TS_MARK, now), "bench"),
+                uplinks,
+                opts.alloc_uplinks,
+            )
+        )
+    result["watch_mode"] = opts.loriot_watch_mode
+    result["inbox_format"] = opts.loriot_inbox_format
+    result["note"] = "Loriot ts has millisecond resolution, so latency is rounded down by up to 1 ms"
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "-C", ROOT, "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--scenario", choices=("chirpstack", "loriot", "all"), default="all")
+    ap.add_argument("--uplinks", type=int, default=20000, help="uplinks per scenario")
+    ap.add_argument("--devices", type=int, default=500, help="distinct devices")
+    ap.add_argument("--measurements", default="5:20", help="measurements per uplink, min:max (fixed per device)")
+    ap.add_argument("--gateways", default="1:3", help="gateways per ChirpStack uplink, min:max (fixed per device)")
+    ap.add_argument("--signal", action="store_true", help="enable --signal-strength-indicators")
+    ap.add_argument("--transport", choices=("direct", "mqtt"), default="direct",
+                    help="ChirpStack: call paho on_message directly, or send over TCP from a broker stand-in")
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--queue-size", type=int, default=1000)
+    ap.add_argument("--publish-batch-size", type=int, default=100)
+    ap.add_argument("--publish-max-latency-sec", type=float, default=0.5)
+    ap.add_argument("--loriot-watch-mode", default="auto", choices=("auto", "inotify", "poll"))
+    ap.add_argument("--loriot-inbox-format", default="files", choices=("files", "spool"))
+    ap.add_argument("--json-backend", default="auto")
+    ap.add_argument("--dedup-window-sec", type=float, default=600, help="0 benchmarks without deduplication")
+    ap.add_argument("--alloc-uplinks", type=int, default=2000, help="uplinks in the tracemalloc pass")
+    ap.add_argument("--timeout", type=float, default=300, help="max seconds to wait for a scenario to drain")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--output", help="write JSON results here instead of stdout")
+    opts = ap.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(message)s")
+    rng = random.Random(opts.seed)
+    results = {
+        "benchmark": "pipeline",
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "json_backend": set_json_backend(opts.json_backend),
+        "params": vars(opts),
+        "scenarios": {},
+    }
+    if opts.scenario in ("chirpstack", "all"):
+        results["scenarios"]["chirpstack"] = bench_chirpstack(opts, rng)
+    if opts.scenario in ("loriot", "all"):
+        results["scenarios"]["loriot"] = bench_loriot(opts, rng)
+    publisher.stop_publisher()
+    results["json_backend"] = get_json_backend()
+
+    for name, r in results["scenarios"].items():
+        print(
+            f"{name:10s} {r['uplinks_per_sec']} uplinks/s  p50 {r['latency_ms_p50']} ms  p99 {r['latency_ms_p99']} ms  "
+            f"{r['alloc_peak_bytes_per_uplink']} B peak/uplink  complete={r['complete']}",
+            file=sys.stderr,
+        )
+    text = json.dumps(results, indent=2)
+    if opts.output:
+        with open(opts.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Memory benchmark: PacketLossCalculator state at 10k/100k simulated devices.
+
+Compares the array-backed store with the previous dict-of-dicts layout using tracemalloc.
+Usage: python benchmarks/bench_plr_memory.py [--devices 10000 100000]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+
+from calc import PacketLossCalculator  # noqa: E402
+
+
+def legacy_store(deveuis):
+    """The previous per-device dict layout."""
+    devices = {}
+    for i, deveui in enumerate(deveuis):
+        devices[deveui] = {
+            "fCnt": i + 1,
+            "totalpl": 0,
+            "pckcount": 1,
+            "last_calculation_time": time.time(),
+        }
+    return devices
+
+
+def compact_store(deveuis):
+    calc = PacketLossCalculator(3600, max_devices=0, idle_ttl_sec=0)
+    for i, deveui in enumerate(deveuis):
+        calc.process_packet(deveui, i + 1)
+    return calc
+
+
+def measure(build, deveuis):
+    """Bytes allocated by build(deveuis), excluding the devEui strings themselves."""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    start = time.perf_counter()
+    store = build(deveuis)
+    elapsed = time.perf_counter() - start
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del store
+    return size, elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--devices", type=int, nargs="+", default=[10000, 100000])
+    opts = ap.parse_args()
+    print(f"{'devices':>8} {'legacy MiB':>11} {'compact MiB':>12} {'ratio':>6} {'legacy s':>9} {'compact s':>10}")
+    for count in opts.devices:
+        deveuis = ["%016x" % (0xA000000000000000 + i) for i in range(count)]
+        legacy_size, legacy_time = measure(legacy_store, deveuis)
+        compact_size, compact_time = measure(compact_store, deveuis)
+        print(
+            f"{count:8d} {legacy_size / 2**20:11.2f} {compact_size / 2**20:12.2f} "
+            f"{legacy_size / compact_size:6.1f} {legacy_time:9.3f} {compact_time:10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
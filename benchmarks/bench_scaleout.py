@@ -0,0 +1,234 @@
+"""
+Scale-out check: several ChirpstackClient instances sharing one broker via --mqtt-shared-group
+or --mqtt-partition.
+
+Starts an in-process MQTT 3.1.1 broker stand-in that supports several subscribers, topic
+wildcards and $share/<group>/ subscriptions (round-robin within a group), connects --instances
+clients to it over TCP, and sends synthetic ChirpStack uplinks (see bench_pipeline.py). For
+each mode it reports how many uplinks every instance handled, elapsed time, and how many devices
+were handled by, or have packet loss state in, more than one instance. In partition mode every
+device must stay in exactly one instance; the script exits with status 1 otherwise. The clients
+share one process and the GIL, so this checks the distribution of work, not the speedup of
+separate processes.
+
+Usage: python benchmarks/bench_scaleout.py [--mode all] [--instances 4] [--uplinks 5000]
+"""
+import argparse
+import json
+import random
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+
+import paho.mqtt.client as mqtt
+
+from bench_pipeline import (
+    TIME_MARK,
+    BrokerStandIn,
+    chirpstack_uplinks,
+    make_args,
+    publisher,
+    rfc3339_ns,
+    start_stub_publisher,
+)
+from calc import plr_tracker_from_args
+from client import ChirpstackClient
+
+SHARE_PREFIX = "$share/"
+
+
+class SharedBrokerStandIn:
+    """Minimal MQTT 3.1.1 broker for several subscribers: wildcards, $share groups, QoS 0 PUBLISH only."""
+
+    def __init__(self):
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(16)
+        self.port = self.server.getsockname()[1]
+        self._lock = threading.Condition()
+        self._subscribers = []  # (conn, topic filter)
+        self._groups = {}  # (group, topic filter) -> [conn]
+        self._next = Counter()  # (group, topic filter) -> round-robin position
+        self._send_locks = {}
+        self.subscriptions = 0
+        threading.Thread(target=self._accept, daemon=True, name="bench-broker").start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self.server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._send_locks[conn] = threading.Lock()
+            threading.Thread(target=self._serve, args=(conn,), daemon=True, name="bench-broker-conn").start()
+
+    def _subscribe(self, conn, body):
+        """Register the topic filters of a SUBSCRIBE body; returns the SUBACK frame."""
+        pos, filters = 2, []
+        while pos < len(body):
+            length = int.from_bytes(body[pos:pos + 2], "big")
+            filters.append(body[pos + 2:pos + 2 + length].decode("utf-8"))
+            pos += 2 + length + 1
+        with self._lock:
+            for topic_filter in filters:
+                if topic_filter.startswith(SHARE_PREFIX):
+                    group, _, topic_filter = topic_filter[len(SHARE_PREFIX):].partition("/")
+                    self._groups.setdefault((group, topic_filter), []).append(conn)
+                else:
+                    self._subscribers.append((conn, topic_filter))
+            self.subscriptions += 1
+            self._lock.notify_all()
+        return b"\x90" + bytes([2 + len(filters)]) + body[:2] + b"\x00" * len(filters)
+
+    def _serve(self, conn):
+        read_packet = BrokerStandIn._read_packet
+        while True:
+            kind, body = read_packet(self, conn)
+            if kind is None or kind == 0xE0:
+                break
+            with self._send_locks[conn]:
+                if kind == 0x10:
+                    conn.sendall(b"\x20\x02\x00\x00")
+                elif kind & 0xF0 == 0x80:
+                    conn.sendall(self._subscribe(conn, body))
+                elif kind == 0xC0:
+                    conn.sendall(b"\xd0\x00")
+        with self._lock:
+            self._subscribers = [(c, f) for c, f in self._subscribers if c is not conn]
+            for members in self._groups.values():
+                if conn in members:
+                    members.remove(conn)
+
+    def wait_subscribed(self, count, timeout=10):
+        with self._lock:
+            return self._lock.wait_for(lambda: self.subscriptions >= count, timeout)
+
+    def publish(self, topic, payload):
+        topic_bytes = topic.encode("utf-8")
+        body = len(topic_bytes).to_bytes(2, "big") + topic_bytes + payload
+        frame = b"\x30" + BrokerStandIn._remaining_length(len(body)) + body
+        with self._lock:
+            targets = [c for c, f in self._subscribers if mqtt.topic_matches_sub(f, topic)]
+            for key, members in self._groups.items():
+                if members and mqtt.topic_matches_sub(key[1], topic):
+                    targets.append(members[self._next[key] % len(members)])
+                    self._next[key] += 1
+        for conn in targets:
+            with self._send_locks[conn]:
+                conn.sendall(frame)
+
+
+def run_mode(mode, opts, uplinks):
+    """Run one mode ("shared" or "partition") and return its result dict."""
+    start_stub_publisher(make_args(opts))
+    broker = SharedBrokerStandIn()
+    instances = []
+    for index in range(opts.instances):
+        args = make_args(opts)
+        args.workers = 0
+        args.mqtt_server_port = broker.port
+        args.mqtt_subscribe_topic = "application/+/device/+/event/up"
+        if mode == "shared":
+            args.mqtt_shared_group = "bench"
+        else:
+            args.mqtt_partition = (index, opts.instances)
+        client = ChirpstackClient(args, None, plr_tracker_from_args(args))
+        handled = Counter()
+        handle_message = client.handle_message
+
+        def counted(topic, payload, handled=handled, handle_message=handle_message):
+            handle_message(topic, payload)
+            handled[topic.split("/")[3]] += 1
+
+        client.handle_message = counted
+        threading.Thread(target=client.run, daemon=True, name=f"bench-client-{index}").start()
+        instances.append((client, handled))
+    if not broker.wait_subscribed(opts.instances):
+        raise RuntimeError("not all clients subscribed to the broker stand-in")
+
+    start = time.monotonic()
+    for topic, payload, _ in uplinks:
+        broker.publish(topic, payload.replace(TIME_MARK, b'"' + rfc3339_ns(time.time_ns()).encode() + b'"'))
+    deadline = start + opts.timeout
+    while sum(sum(h.values()) for _, h in instances) < len(uplinks) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = time.monotonic() - start
+    for client, _ in instances:
+        client.client.disconnect()
+
+    owners = Counter()
+    plr_owners = Counter()
+    devices = {topic.split("/")[3] for topic, _, _ in uplinks}
+    for client, handled in instances:
+        owners.update(handled.keys())
+        plr_owners.update(eui for eui in devices if ("local_chirpstack", eui) in client.plr_calc)
+    handled_total = sum(sum(h.values()) for _, h in instances)
+    return {
+        "instances": opts.instances,
+        "uplinks": len(uplinks),
+        "uplinks_handled": handled_total,
+        "uplinks_per_instance": [sum(h.values()) for _, h in instances],
+        "elapsed_sec": round(elapsed, 4),
+        "uplinks_per_sec": round(handled_total / elapsed, 1) if elapsed > 0 else None,
+        "devices": len(devices),
+        "devices_split_across_instances": sum(1 for n in owners.values() if n > 1),
+        "devices_with_plr_state_in_several_instances": sum(1 for n in plr_owners.values() if n > 1),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--mode", choices=("shared", "partition", "all"), default="all")
+    ap.add_argument("--instances", type=int, default=4)
+    ap.add_argument("--uplinks", type=int, default=5000)
+    ap.add_argument("--devices", type=int, default=200)
+    ap.add_argument("--measurements", default="5:20", help="measurements per uplink, min:max (fixed per device)")
+    ap.add_argument("--gateways", default="1:3", help="gateways per uplink, min:max (fixed per device)")
+    ap.add_argument("--timeout", type=float, default=120, help="max seconds to wait for a mode to drain")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--output", help="write JSON results here instead of stdout")
+    opts = ap.parse_args()
+    # Settings make_args() reads from the pipeline benchmark's options.
+    opts.signal = True
+    opts.workers = 0
+    opts.queue_size = 1000
+    opts.publish_batch_size = 100
+    opts.publish_max_latency_sec = 0.5
+    opts.loriot_watch_mode = "auto"
+    opts.loriot_inbox_format = "files"
+    opts.dedup_window_sec = 600
+
+    rng = random.Random(opts.seed)
+    uplinks = chirpstack_uplinks(opts, rng)
+    # Shuffle the device order within each fCnt round, so round-robin delivery in a shared
+    # group does not pin each device to one instance by accident.
+    rounds = [uplinks[i:i + opts.devices] for i in range(0, len(uplinks), opts.devices)]
+    for batch in rounds:
+        rng.shuffle(batch)
+    uplinks = [uplink for batch in rounds for uplink in batch]
+    modes = ("shared", "partition") if opts.mode == "all" else (opts.mode,)
+    results = {mode: run_mode(mode, opts, uplinks) for mode in modes}
+    publisher.stop_publisher()
+
+    ok = True
+    for mode, r in results.items():
+        print(
+            f"{mode:10s} {r['uplinks_handled']}/{r['uplinks']} uplinks  per instance {r['uplinks_per_instance']}  "
+            f"devices split {r['devices_split_across_instances']}  plr split {r['devices_with_plr_state_in_several_instances']}",
+            file=sys.stderr,
+        )
+        if r["uplinks_handled"] != r["uplinks"]:
+            ok = False
+        if mode == "partition" and (r["devices_split_across_instances"] or r["devices_with_plr_state_in_several_instances"]):
+            ok = False
+    text = json.dumps(results, indent=2)
+    if opts.output:
+        with open(opts.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
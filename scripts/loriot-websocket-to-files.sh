@@ -5,6 +5,12 @@
 # path) watches this directory and processes files. Run this on the node (outside
 # the plugin pod); the directory must be the same hostPath mounted into the plugin.
 #
+# With LORIOT_INBOX_FORMAT=spool, messages are instead appended as JSON lines to
+# segment files (segment-<epoch ns>.jsonl), starting a new segment when the current
+# one reaches LORIOT_SEGMENT_MAX_BYTES or LORIOT_SEGMENT_MAX_AGE_SEC. This avoids
+# creating and deleting one file per message; run the plugin with
+# --loriot-inbox-format spool.
+#
 # Requires: websocat (recommended) or curl with WebSocket support (7.86+).
 #   to install on raspberry pi:
 #     sudo wget -O /usr/local/bin/websocat \
@@ -15,11 +21,17 @@
 # Env:
 #   LORIOT_WEBSOCKET_URL  - required, e.g. wss://us1.loriot.io/app?token=...
 #   LORIOT_INBOX_DIR      - required, directory to write message files (or LORAWAN_LORIOT_INBOX)
+#   LORIOT_INBOX_FORMAT   - optional, "files" (default) or "spool"
+#   LORIOT_SEGMENT_MAX_BYTES   - optional, spool segment size before rotating (default 1048576)
+#   LORIOT_SEGMENT_MAX_AGE_SEC - optional, spool segment age before rotating (default 300)
 #
 set -e
 
 URL="${LORIOT_WEBSOCKET_URL:-}"
 INBOX="${LORIOT_INBOX_DIR:-${LORAWAN_LORIOT_INBOX:-}}"
+FORMAT="${LORIOT_INBOX_FORMAT:-files}"
+SEGMENT_MAX_BYTES="${LORIOT_SEGMENT_MAX_BYTES:-1048576}"
+SEGMENT_MAX_AGE_SEC="${LORIOT_SEGMENT_MAX_AGE_SEC:-300}"
 
 if [[ -z "$URL" ]]; then
   echo "LORIOT_WEBSOCKET_URL is not set" >&2
@@ -29,6 +41,10 @@ if [[ -z "$INBOX" ]]; then
   echo "LORIOT_INBOX_DIR or LORAWAN_LORIOT_INBOX is not set" >&2
   exit 1
 fi
+if [[ "$FORMAT" != "files" && "$FORMAT" != "spool" ]]; then
+  echo "LORIOT_INBOX_FORMAT must be files or spool" >&2
+  exit 1
+fi
 
 mkdir -p "$INBOX"
 
@@ -44,6 +60,43 @@ write_line() {
   echo "Message received, wrote $(basename "$f")" >&2
 }
 
+# Spool mode: the current segment stays open on fd 3; a new segment is started when
+# it is too large or too old. The plugin deletes a segment once it has consumed it
+# and a newer segment exists.
+segment_bytes=0
+segment_started=0
+
+open_segment() {
+  local seg="${INBOX}/segment-$(date +%s%N).jsonl"
+  exec 3>>"$seg"
+  segment_bytes=0
+  segment_started=$(date +%s)
+  echo "Started spool segment $(basename "$seg")" >&2
+}
+
+append_line() {
+  local line="$1"
+  [[ -z "$line" ]] && return
+  if (( segment_started == 0 )); then
+    open_segment
+  elif (( segment_bytes >= SEGMENT_MAX_BYTES || $(date +%s) - segment_started >= SEGMENT_MAX_AGE_SEC )); then
+    exec 3>&-
+    open_segment
+  fi
+  printf '%s\n' "$line" >&3
+  # ${#line} counts characters in a UTF-8 locale; in the C locale it counts bytes.
+  local LC_ALL=C
+  segment_bytes=$(( segment_bytes + ${#line} + 1 ))
+}
+
+handle_line() {
+  if [[ "$FORMAT" == "spool" ]]; then
+    append_line "$1"
+  else
+    write_line "$1"
+  fi
+}
+
 # Prefer websocat; fall back to curl if it supports WebSocket (--ws, curl 7.86+).
 check_ws_tool() {
   if command -v websocat &>/dev/null; then
@@ -76,7 +129,7 @@ max_delay=60
 while true; do
   echo "Connecting to Loriot (${SAFE_URL})..."
   while IFS= read -r line; do
-    write_line "$line"
+    handle_line "$line"
   done < <(run_websocket)
   echo "Disconnected; reconnecting in ${delay}s..."
   sleep "$delay"
@@ -0,0 +1,257 @@
+"""
+Test helpers: an in-process MQTT broker stand-in, synthetic ChirpStack uplinks, plugin args
+and a stub Waggle Plugin, so the tests need no broker or Beehive.
+
+Importing this module puts app/ on sys.path.
+"""
+import copy
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+import publisher  # noqa: E402
+from calc import plr_tracker_from_args  # noqa: E402
+from client import ChirpstackClient  # noqa: E402
+from measurement_filter import MeasurementFilter  # noqa: E402
+
+UPLINK_TOPIC = "application/+/device/+/event/up"
+SHARE_PREFIX = "$share/"
+
+
+class StubPlugin:
+    """Stands in for waggle.plugin.Plugin: counts publishes."""
+
+    published = 0
+
+    def __init__(self):
+        self.stop = threading.Event()
+        self.tasks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+
+    def publish(self, name, value, timestamp=None, meta=None):
+        StubPlugin.published += 1
+
+
+def start_stub_publisher(args):
+    """Start the process-wide publisher with StubPlugin, after stopping any previous one."""
+    publisher.stop_publisher()
+    StubPlugin.published = 0
+    publisher.Plugin = StubPlugin
+    publisher.start_publisher(args)
+
+
+class BrokerStandIn:
+    """
+    Minimal MQTT 3.1.1 broker: CONNECT, SUBSCRIBE (wildcards and $share/<group>/ filters,
+    round-robin within a group), PINGREQ, and QoS 0 PUBLISH to the subscribers.
+    """
+
+    def __init__(self):
+        self.server = socket.socket()
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(16)
+        self.port = self.server.getsockname()[1]
+        self._lock = threading.Condition()
+        self._subscribers = []  # (conn, topic filter)
+        self._groups = {}  # (group, topic filter) -> [conn]
+        self._next = Counter()  # (group, topic filter) -> round-robin position
+        self._send_locks = {}
+        self.subscriptions = 0
+        threading.Thread(target=self._accept, daemon=True, name="test-broker").start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self.server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._send_locks[conn] = threading.Lock()
+            threading.Thread(target=self._serve, args=(conn,), daemon=True, name="test-broker-conn").start()
+
+    @staticmethod
+    def _read_packet(conn):
+        header = conn.recv(1)
+        if not header:
+            return None, b""
+        length, shift = 0, 0
+        while True:
+            byte = conn.recv(1)[0]
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        body = b""
+        while len(body) < length:
+            chunk = conn.recv(length - len(body))
+            if not chunk:
+                return None, b""
+            body += chunk
+        return header[0], body
+
+    @staticmethod
+    def _remaining_length(n):
+        out = bytearray()
+        while True:
+            byte, n = n & 0x7F, n >> 7
+            out.append(byte | (0x80 if n else 0))
+            if not n:
+                return bytes(out)
+
+    def _subscribe(self, conn, body):
+        """Register the topic filters of a SUBSCRIBE body; returns the SUBACK frame."""
+        pos, filters = 2, []
+        while pos < len(body):
+            length = int.from_bytes(body[pos:pos + 2], "big")
+            filters.append(body[pos + 2:pos + 2 + length].decode("utf-8"))
+            pos += 2 + length + 1
+        with self._lock:
+            for topic_filter in filters:
+                if topic_filter.startswith(SHARE_PREFIX):
+                    group, _, topic_filter = topic_filter[len(SHARE_PREFIX):].partition("/")
+                    self._groups.setdefault((group, topic_filter), []).append(conn)
+                else:
+                    self._subscribers.append((conn, topic_filter))
+            self.subscriptions += 1
+            self._lock.notify_all()
+        return b"\x90" + bytes([2 + len(filters)]) + body[:2] + b"\x00" * len(filters)
+
+    def _serve(self, conn):
+        while True:
+            kind, body = self._read_packet(conn)
+            if kind is None or kind == 0xE0:
+                break
+            with self._send_locks[conn]:
+                if kind == 0x10:
+                    conn.sendall(b"\x20\x02\x00\x00")
+                elif kind & 0xF0 == 0x80:
+                    conn.sendall(self._subscribe(conn, body))
+                elif kind == 0xC0:
+                    conn.sendall(b"\xd0\x00")
+        with self._lock:
+            self._subscribers = [(c, f) for c, f in self._subscribers if c is not conn]
+            for members in self._groups.values():
+                if conn in members:
+                    members.remove(conn)
+
+    def wait_subscribed(self, count, timeout=10):
+        with self._lock:
+            return self._lock.wait_for(lambda: self.subscriptions >= count, timeout)
+
+    def publish(self, topic, payload):
+        topic_bytes = topic.encode("utf-8")
+        body = len(topic_bytes).to_bytes(2, "big") + topic_bytes + payload
+        frame = b"\x30" + self._remaining_length(len(body)) + body
+        with self._lock:
+            targets = [c for c, f in self._subscribers if mqtt.topic_matches_sub(f, topic)]
+            for key, members in self._groups.items():
+                if members and mqtt.topic_matches_sub(key[1], topic):
+                    targets.append(members[self._next[key] % len(members)])
+                    self._next[key] += 1
+        for conn in targets:
+            with self._send_locks[conn]:
+                conn.sendall(frame)
+
+
+def chirpstack_uplinks(count, devices, rng):
+    """[(topic, payload)] for count uplinks spread over devices devices, built from test/example.json."""
+    with open(os.path.join(ROOT, "test", "example.json"), "rb") as f:
+        template = json.load(f)
+    seconds, frac = divmod(time.time_ns(), 1_000_000_000)
+    now = datetime.fromtimestamp(seconds, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S") + f".{frac:09d}+00:00"
+    uplinks = []
+    for i in range(count):
+        eui = f"{i % devices:016x}"
+        uplink = copy.deepcopy(template)
+        uplink["time"] = now
+        uplink["deduplicationId"] = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        uplink["deviceInfo"]["devEui"] = eui
+        uplink["deviceInfo"]["deviceName"] = f"test node {eui}"
+        uplink["fCnt"] = i // devices + 1
+        payload = json.dumps(uplink, separators=(",", ":")).encode("utf-8")
+        uplinks.append((f"application/{uplink['deviceInfo']['applicationId']}/device/{eui}/event/up", payload))
+    return uplinks
+
+
+def make_args(**overrides):
+    """Plugin args as main() parses them by default, with overrides."""
+    args = SimpleNamespace(
+        dry=False,
+        collect=[],
+        ignore=[],
+        signal_strength_indicators=True,
+        plr=3600,
+        plr_shards=16,
+        plr_max_devices=10000,
+        plr_idle_ttl_sec=86400,
+        workers=0,
+        queue_size=1000,
+        backpressure="block",
+        publish_batch_size=100,
+        publish_max_latency_sec=0.5,
+        publish_queue_size=100000,
+        mqtt_server_ip="127.0.0.1",
+        mqtt_server_port=1883,
+        mqtt_subscribe_topic=UPLINK_TOPIC,
+        mqtt_shared_group="",
+        mqtt_partition=None,
+        loriot_inbox_dir="",
+        dedup_window_sec=600,
+        dedup_max_entries=20000,
+    )
+    for key, value in overrides.items():
+        setattr(args, key, value)
+    args.measurement_filter = MeasurementFilter(args.collect, args.ignore)
+    return args
+
+
+def run_instances(uplinks, instances, timeout=60, **overrides):
+    """
+    Connect instances ChirpstackClients (args from make_args(**overrides), with
+    mqtt_partition set to (i, instances) if overrides has partition=True) to a broker
+    stand-in, publish uplinks and wait until they are handled.
+    Returns [(client, Counter of uplinks handled per devEui)] per instance.
+    """
+    partition = overrides.pop("partition", False)
+    start_stub_publisher(make_args(**overrides))
+    broker = BrokerStandIn()
+    result = []
+    for index in range(instances):
+        args = make_args(mqtt_server_port=broker.port, **overrides)
+        if partition:
+            args.mqtt_partition = (index, instances)
+        client = ChirpstackClient(args, None, plr_tracker_from_args(args))
+        handled = Counter()
+        handle_message = client.handle_message
+
+        def counted(topic, payload, handled=handled, handle_message=handle_message):
+            handle_message(topic, payload)
+            handled[topic.split("/")[3]] += 1
+
+        client.handle_message = counted
+        threading.Thread(target=client.run, daemon=True, name=f"test-client-{index}").start()
+        result.append((client, handled))
+    if not broker.wait_subscribed(instances):
+        raise RuntimeError("not all clients subscribed to the broker stand-in")
+    for topic, payload in uplinks:
+        broker.publish(topic, payload)
+    deadline = time.monotonic() + timeout
+    while sum(sum(h.values()) for _, h in result) < len(uplinks) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    for client, _ in result:
+        client.client.disconnect()
+    return result
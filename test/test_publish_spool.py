@@ -0,0 +1,99 @@
+"""
+Publish spool test: measurements published while Beehive is unreachable are spooled and
+replayed once it is back; invalid measurements are dropped, not spooled.
+
+The Waggle Plugin is the real one without its RabbitMQ thread, so published messages stay
+in its send queue as they do during an outage.
+
+Run: python -m pytest test/test_publish_spool.py (or python -m unittest discover test)
+"""
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+import publisher  # noqa: E402
+from spool import Spool  # noqa: E402
+
+BASE_TS = 1_700_000_000_000_000_000
+
+
+class OutagePlugin(publisher.Plugin):
+    """Plugin whose messages are never sent: Beehive is unreachable."""
+
+    def __enter__(self):
+        return self
+
+
+class ConnectedPlugin(OutagePlugin):
+    """Plugin whose messages are sent as soon as they are published."""
+
+    sent = []
+
+    def publish(self, name, value, meta={}, timestamp=None, scope="all", timeout=None):
+        super().publish(name, value, meta=meta, timestamp=timestamp, scope=scope, timeout=timeout)
+        ConnectedPlugin.sent.append(publisher.wagglemsg.load(self.send.get_nowait().body))
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class PublishSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.plugin_class = publisher.Plugin
+        ConnectedPlugin.sent = []
+
+    def tearDown(self):
+        publisher.Plugin = self.plugin_class
+        self.tmp.cleanup()
+
+    def make_publisher(self, plugin_class):
+        publisher.Plugin = plugin_class
+        spool = Spool(self.tmp.name, segment_bytes=512, fsync_interval_sec=0.05)
+        return publisher.Publisher(batch_size=10, max_latency_sec=0.02, spool=spool, replay_rate=0, backlog_limit=20)
+
+    def test_outage_is_spooled_and_replayed(self):
+        expected = [("env.temperature", float(i), BASE_TS + i, {"devEui": "%016x" % (i % 7)}) for i in range(200)]
+        pub = self.make_publisher(OutagePlugin)
+        pub.start()
+        for item in expected:
+            self.assertTrue(pub.submit(*item))
+        self.assertTrue(wait_for(pub.queue.empty))
+        pub.stop()
+        # Batches over the backlog limit were spooled while running; the backlog at shutdown too.
+        segments = [name for name in os.listdir(self.tmp.name) if name.endswith(".jsonl.gz")]
+        self.assertGreater(len(segments), 1)
+
+        pub = self.make_publisher(ConnectedPlugin)
+        pub.start()
+        self.assertTrue(wait_for(lambda: len(ConnectedPlugin.sent) >= len(expected)))
+        self.assertTrue(wait_for(lambda: pub.spool.pending_bytes() == 0))
+        pub.stop()
+        sent = sorted((msg.name, msg.value, msg.timestamp, msg.meta) for msg in ConnectedPlugin.sent)
+        self.assertEqual(sent, sorted(expected, key=lambda item: item[2]))
+        self.assertEqual([name for name in os.listdir(self.tmp.name) if name.endswith(".jsonl.gz")], [])
+
+    def test_invalid_measurement_is_dropped_not_spooled(self):
+        pub = self.make_publisher(ConnectedPlugin)
+        pub.start()
+        pub.submit("env.bad", [1, 2], BASE_TS, {})
+        pub.submit("env.good", 1.5, BASE_TS + 1, {"devAddr": None, "devEui": "0011223344556677"})
+        self.assertTrue(wait_for(lambda: len(ConnectedPlugin.sent) == 1))
+        pub.stop()
+        msg = ConnectedPlugin.sent[0]
+        self.assertEqual((msg.name, msg.value, msg.meta), ("env.good", 1.5, {"devEui": "0011223344556677"}))
+        self.assertEqual(pub.spool.pending_bytes(), 0)
+        self.assertIsNone(pub.spool.next_segment())
+
+
+if __name__ == "__main__":
+    unittest.main()
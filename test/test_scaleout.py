@@ -0,0 +1,63 @@
+"""
+Scale-out test: --mqtt-partition and --mqtt-shared-group against an in-process broker stand-in
+(test/helpers.py; the Waggle Plugin is stubbed, so no broker or Beehive is needed).
+
+Run: python -m pytest test/test_scaleout.py (or python -m unittest discover test)
+"""
+import random
+import unittest
+from collections import Counter
+
+from helpers import UPLINK_TOPIC, chirpstack_uplinks, make_args, publisher, run_instances
+
+from client import ChirpstackClient, parse_partition
+
+
+class ScaleOutTest(unittest.TestCase):
+    def setUp(self):
+        self.plugin_class = publisher.Plugin
+
+    def tearDown(self):
+        publisher.stop_publisher()
+        publisher.Plugin = self.plugin_class
+
+    def test_partitions_handle_every_uplink_once_per_device(self):
+        uplinks = chirpstack_uplinks(600, 60, random.Random(1))
+        instances = run_instances(uplinks, 3, partition=True)
+        per_instance = [sum(handled.values()) for _, handled in instances]
+        self.assertEqual(sum(per_instance), len(uplinks))
+        self.assertTrue(all(per_instance), per_instance)
+        owners = Counter()
+        plr_owners = Counter()
+        devices = {topic.split("/")[3] for topic, _ in uplinks}
+        for client, handled in instances:
+            owners.update(handled.keys())
+            plr_owners.update(eui for eui in devices if ("local_chirpstack", eui) in client.plr_calc)
+        self.assertEqual(set(owners), devices)
+        self.assertEqual([eui for eui, n in owners.items() if n > 1], [])
+        self.assertEqual([eui for eui, n in plr_owners.items() if n > 1], [])
+
+    def test_shared_group_delivers_each_uplink_to_one_instance(self):
+        uplinks = chirpstack_uplinks(300, 30, random.Random(2))
+        instances = run_instances(uplinks, 3, mqtt_shared_group="lorawan")
+        per_instance = [sum(handled.values()) for _, handled in instances]
+        self.assertEqual(sum(per_instance), len(uplinks))
+        self.assertTrue(all(per_instance), per_instance)
+
+    def test_shared_group_subscription_topic(self):
+        args = make_args(mqtt_shared_group="lorawan")
+        client = ChirpstackClient(args, None, None)
+        self.assertEqual(client.subscription_topic(), "$share/lorawan/" + UPLINK_TOPIC)
+        args.mqtt_shared_group = ""
+        self.assertEqual(client.subscription_topic(), UPLINK_TOPIC)
+
+    def test_parse_partition(self):
+        self.assertEqual(parse_partition("1/4"), (1, 4))
+        self.assertIsNone(parse_partition(""))
+        for bad in ("4/4", "-1/2", "0/0", "x"):
+            with self.assertRaises(ValueError):
+                parse_partition(bad)
+
+
+if __name__ == "__main__":
+    unittest.main()